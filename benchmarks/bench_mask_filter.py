@@ -0,0 +1,125 @@
+"""
+benchmark comparing the per-object shapely mask filtering formerly used
+in rendermodules.rough_align (filter_highres_with_masks and
+points_in_mask) with the bounding box prefiltered and vectorized versions
+on a synthetic masked section
+
+usage: python benchmarks/bench_mask_filter.py [ntiles_side] [npoints] [nrepeat]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import cv2
+import numpy as np
+import pathlib2 as pathlib
+import renderapi
+from shapely.geometry import Point, Polygon
+from six.moves import urllib
+
+from rendermodules.rough_align.apply_rough_alignment_to_montages import (
+    filter_highres_with_masks)
+from rendermodules.rough_align.downsample_mask_handler import (
+    points_in_mask, polygon_list_from_mask)
+
+
+def make_section(nside, mask_dir, tile_size=2048, overlap=0.1,
+                 scale=0.01, nholes=8, seed=0):
+    """montage of nside x nside tiles, a lowres tilespec of the section
+    and a mask with a few masked out (zero) regions
+    """
+    rng = np.random.RandomState(seed)
+    step = tile_size * (1 - overlap)
+    tilespecs = []
+    for i in range(nside):
+        for j in range(nside):
+            tilespecs.append(renderapi.tilespec.TileSpec(
+                tileId='tile_{}_{}'.format(i, j), z=1.0,
+                width=tile_size, height=tile_size,
+                tforms=[renderapi.transform.AffineModel(
+                    B0=i * step, B1=j * step)]))
+    resolved = renderapi.resolvedtiles.ResolvedTiles(
+        tilespecs=tilespecs, transformList=[])
+
+    size = int(np.ceil((nside * step + tile_size) * scale))
+    mask = np.full((size, size), 255, dtype=np.uint8)
+    for k in range(nholes):
+        c = rng.randint(0, size, 2)
+        cv2.circle(mask, (int(c[0]), int(c[1])),
+                   int(rng.randint(size // 40 + 1, size // 10 + 2)), 0, -1)
+    mask_path = os.path.join(mask_dir, 'lowres.png')
+    cv2.imwrite(mask_path, mask)
+
+    lowres = renderapi.tilespec.TileSpec(
+        tileId='lowres', z=1.0, width=size, height=size,
+        tforms=[renderapi.transform.AffineModel(
+            M00=1. / scale, M11=1. / scale)])
+    mask_map = {'lowres': pathlib.Path(mask_path).as_uri()}
+    return resolved, lowres, mask_map, mask
+
+
+def filter_highres_with_masks_loop(resolved_highres, tspec_lowres, mask_map):
+    """reference implementation testing every tile against every polygon"""
+    impath = urllib.parse.unquote(
+                 urllib.parse.urlparse(
+                     mask_map[tspec_lowres.tileId]).path)
+    maskim = cv2.imread(impath, 0)
+    mask_polygons = polygon_list_from_mask(
+            255 - maskim,
+            transforms=tspec_lowres.tforms)
+    new_highres = []
+    for t in resolved_highres.tilespecs:
+        tc = t.bbox_transformed(
+                    reference_tforms=resolved_highres.transforms)
+        tpoly = Polygon(tc).buffer(0)
+        pint = [not p.intersects(tpoly) for p in mask_polygons]
+        if np.all(pint):
+            new_highres.append(t)
+    return new_highres
+
+
+def points_in_mask_loop(mask, pts):
+    """reference implementation building a shapely Point per point"""
+    mask_list = []
+    for maskpoly in polygon_list_from_mask(mask):
+        mask_list += [1.0 if maskpoly.contains(Point(pt)) else 0.0
+                      for pt in np.array(pts).transpose()]
+    return mask_list
+
+
+def main(nside=55, npoints=10000, nrepeat=3):
+    mask_dir = tempfile.mkdtemp()
+    try:
+        resolved, lowres, mask_map, mask = make_section(nside, mask_dir)
+
+        old = filter_highres_with_masks_loop(resolved, lowres, mask_map)
+        new = filter_highres_with_masks(resolved, lowres, mask_map)
+        assert [t.tileId for t in old] == [t.tileId for t in new]
+        print('{} tiles, {} kept'.format(len(resolved.tilespecs), len(new)))
+        for name, func in [('loop', filter_highres_with_masks_loop),
+                           ('prefiltered', filter_highres_with_masks)]:
+            t = min(timeit.repeat(
+                lambda: func(resolved, lowres, mask_map),
+                number=1, repeat=nrepeat))
+            print('  filter_highres_with_masks {:12s} {:8.3f} s'.format(
+                name, t))
+
+        rng = np.random.RandomState(1)
+        pts = (rng.rand(2, npoints) * np.array(mask.shape)[::-1, None]).tolist()
+        old = points_in_mask_loop(mask, pts)
+        new = points_in_mask(mask, pts)
+        assert old == new
+        print('{} points, {} inside'.format(npoints, int(sum(new))))
+        for name, func in [('loop', points_in_mask_loop),
+                           ('vectorized', points_in_mask)]:
+            t = min(timeit.repeat(
+                lambda: func(mask, pts), number=1, repeat=nrepeat))
+            print('  points_in_mask {:12s} {:8.3f} s'.format(name, t))
+    finally:
+        shutil.rmtree(mask_dir)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,52 @@
+"""
+benchmark of the mipmap methods of rendermodules.dataimport.create_mipmaps
+on a synthetic 16-bit tile, including encoding and writing of all levels
+
+usage: python benchmarks/bench_mipmaps.py [size] [nrepeat]
+"""
+import shutil
+import sys
+import tempfile
+import timeit
+
+import numpy
+import pathlib2 as pathlib
+
+from rendermodules.dataimport.create_mipmaps import method_funcs
+from rendermodules.utilities import uri_utils
+from rendermodules.utilities.pillow_utils import Image
+
+runs = [
+    ("PIL", {"ds_filter": "NEAREST"}),
+    ("block_reduce", {"block_func": "mean"}),
+    ("pyramid", {"block_func": "mean"}),
+    ("block_reduce", {"block_func": "median"}),
+    ("pyramid", {"block_func": "median"}),
+    ("pyramid", {"block_func": "min"})]
+
+
+def main(size=4096, nrepeat=3, levels=6):
+    img = numpy.random.RandomState(0).randint(
+        0, 65535, (size, size)).astype('uint16')
+    im = Image.fromarray(img)
+    # register PIL extensions as Image.open would
+    Image.init()
+    outdir = tempfile.mkdtemp()
+    try:
+        prefix = pathlib.Path(outdir).as_uri()
+        for method, kwargs in runs:
+            levels_uri_map = {
+                level: uri_utils.uri_join(
+                    prefix, method, str(level), 'tile.tif')
+                for level in range(1, levels + 1)}
+            t = min(timeit.repeat(
+                lambda: method_funcs[method](
+                    im, levels_uri_map, **kwargs),
+                number=1, repeat=nrepeat))
+            print("%14s %-20s: %8.3f s" % (method, kwargs, t))
+    finally:
+        shutil.rmtree(outdir)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,106 @@
+"""
+micro-benchmark comparing the DMatch loop formerly used in
+rendermodules.pointmatch.generate_point_matches_opencv.ransac_chunk
+with the array-based implementation on synthetic SIFT-like descriptors
+
+usage: python benchmarks/bench_ransac_chunk.py [nfeatures] [nrepeat]
+"""
+import sys
+import timeit
+
+import cv2
+import numpy as np
+
+from rendermodules.pointmatch.generate_point_matches_opencv import (
+    ransac_chunk)
+
+args = {
+    "FLANN_ntree": 5,
+    "FLANN_ncheck": 50,
+    "ratio_of_dist": 0.8,
+    "RANSAC_outlier": 5.0}
+
+
+def make_synthetic(nfeatures, noutlier_frac=0.2, seed=0):
+    """descriptors of tile q are a noisy, shuffled copy of those of
+    tile p with keypoints translated by a fixed offset, plus distractors
+    """
+    rng = np.random.RandomState(seed)
+    des1 = rng.uniform(0, 255, (nfeatures, 128)).astype('float32')
+    k1xy = rng.uniform(0, 2000, (nfeatures, 2))
+    perm = rng.permutation(nfeatures)
+    des2 = des1[perm] + rng.normal(0, 2, des1.shape).astype('float32')
+    k2xy = k1xy[perm] + np.array([150.0, -75.0])
+    nout = int(noutlier_frac * nfeatures)
+    des2 = np.vstack([
+        des2, rng.uniform(0, 255, (nout, 128)).astype('float32')])
+    k2xy = np.vstack([k2xy, rng.uniform(0, 2000, (nout, 2))])
+    return k1xy, k2xy, des1, des2
+
+
+def ransac_chunk_loop(fargs):
+    """reference implementation iterating over DMatch objects"""
+    [k1xy, k2xy, des1, des2, k1ind, args] = fargs
+
+    FLANN_INDEX_KDTREE = 0
+    index_params = dict(
+            algorithm=FLANN_INDEX_KDTREE,
+            trees=args['FLANN_ntree'])
+    search_params = dict(checks=args['FLANN_ncheck'])
+    flann = cv2.FlannBasedMatcher(index_params, search_params)
+    MIN_MATCH_COUNT = 10
+
+    matches = flann.knnMatch(des1[k1ind, :], des2, k=2)
+
+    good = []
+    k1 = []
+    k2 = []
+    for m, n in matches:
+        if m.distance < args['ratio_of_dist']*n.distance:
+            good.append(m)
+    if len(good) > MIN_MATCH_COUNT:
+        src_pts = np.float32(
+                [k1xy[k1ind, :][m.queryIdx] for m in good]).reshape(-1, 1, 2)
+        dst_pts = np.float32(
+                [k2xy[m.trainIdx] for m in good]).reshape(-1, 1, 2)
+        M, mask = cv2.findHomography(
+                src_pts,
+                dst_pts,
+                cv2.RANSAC,
+                args['RANSAC_outlier'])
+        matchesMask = mask.ravel().tolist()
+
+        good = np.array(good)[np.array(matchesMask).astype('bool')]
+        imgIdx = np.array([g.imgIdx for g in good])
+        tIdx = np.array([g.trainIdx for g in good])
+        qIdx = np.array([g.queryIdx for g in good])
+        for i in range(len(tIdx)):
+            if imgIdx[i] == 1:
+                k1.append(k1xy[k1ind, :][tIdx[i]])
+                k2.append(k2xy[qIdx[i]])
+            else:
+                k1.append(k1xy[k1ind, :][qIdx[i]])
+                k2.append(k2xy[tIdx[i]])
+
+    return k1, k2
+
+
+def main(nfeatures=10000, nrepeat=5):
+    k1xy, k2xy, des1, des2 = make_synthetic(nfeatures)
+    k1ind = np.arange(nfeatures)
+    fargs = [k1xy, k2xy, des1, des2, k1ind, args]
+
+    k1_loop, _ = ransac_chunk_loop(fargs)
+    k1_vec, _ = ransac_chunk(fargs)
+    print("%d features: %d (loop) / %d (vectorized) matches" % (
+        nfeatures, len(k1_loop), len(k1_vec)))
+
+    for name, f in [("loop", ransac_chunk_loop),
+                    ("vectorized", ransac_chunk)]:
+        t = min(timeit.repeat(
+            lambda: f(fargs), number=1, repeat=nrepeat))
+        print("%12s: %8.3f s" % (name, t))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
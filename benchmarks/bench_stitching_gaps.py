@@ -0,0 +1,89 @@
+"""
+benchmark comparing the rtree/networkx stitching gap detection formerly
+used in rendermodules.em_montage_qc.detect_montage_defects with the
+sort and sweep overlap counting on synthetic montage grids
+
+usage: python benchmarks/bench_stitching_gaps.py [ntiles_side] [nrepeat]
+"""
+import sys
+import timeit
+
+import networkx as nx
+import numpy as np
+from rtree import index as rindex
+
+from rendermodules.em_montage_qc.detect_montage_defects import (
+    stitching_gap_tiles)
+
+
+def make_grid(nside, tile_size=2048, overlap=0.1, jitter=20.0,
+              ngaps=10, seed=0):
+    """prestitched grid of overlapping tiles and a poststitched copy in
+    which a few tiles are pulled away from their neighbors
+    """
+    rng = np.random.RandomState(seed)
+    step = tile_size * (1 - overlap)
+    ix, iy = np.meshgrid(np.arange(nside), np.arange(nside))
+    xy = np.column_stack([ix.ravel(), iy.ravel()]) * step
+    xy = xy + rng.uniform(-jitter, jitter, xy.shape)
+    pre = np.hstack([xy, xy + tile_size])
+    post = pre + rng.uniform(-jitter, jitter, (len(pre), 1))
+    gaps = rng.choice(len(post), ngaps, replace=False)
+    post[gaps] += tile_size
+    tileIds = ['tile_{}'.format(i) for i in range(len(pre))]
+    return tileIds, pre, post
+
+
+def stitching_gap_tiles_rtree(pre_tileIds, pre_bboxes,
+                              post_tileIds, post_bboxes):
+    """reference implementation using rtree queries and networkx graphs"""
+    pre_ridx = rindex.Index()
+    G1 = nx.Graph()
+    for i, bbox in enumerate(pre_bboxes):
+        pre_ridx.insert(i, bbox)
+    pre_index = {}
+    for i, (tileId, bbox) in enumerate(zip(pre_tileIds, pre_bboxes)):
+        pre_index[tileId] = i
+        nodes = list(pre_ridx.intersection(bbox))
+        nodes.remove(i)
+        [G1.add_edge(i, node) for node in nodes]
+    G2 = nx.Graph()
+    post_ridx = rindex.Index()
+    post = dict(zip(post_tileIds, post_bboxes))
+    shared = set(post) & set(pre_index)
+    [post_ridx.insert(pre_index[t], post[t]) for t in shared]
+    for tileId, bbox in zip(post_tileIds, post_bboxes):
+        try:
+            i = pre_index[tileId]
+        except KeyError:
+            continue
+        nodes = list(post_ridx.intersection(bbox))
+        nodes.remove(i)
+        [G2.add_edge(i, node) for node in nodes]
+    gap_tiles = []
+    for n in G2.nodes():
+        if G1.degree(n) > G2.degree(n):
+            tileId = list(pre_index.keys())[list(pre_index.values()).index(n)]
+            gap_tiles.append(tileId)
+    return gap_tiles
+
+
+def main(nside=70, nrepeat=3):
+    tileIds, pre, post = make_grid(nside)
+    args = (tileIds, pre, tileIds, post)
+
+    gaps_rtree = stitching_gap_tiles_rtree(*args)
+    gaps_sweep = stitching_gap_tiles(*args)
+    print("%d tiles: %d (rtree) / %d (sweep) gap tiles, identical: %s" % (
+        len(tileIds), len(gaps_rtree), len(gaps_sweep),
+        set(gaps_rtree) == set(gaps_sweep)))
+
+    for name, f in [("rtree", stitching_gap_tiles_rtree),
+                    ("sweep", stitching_gap_tiles)]:
+        t = min(timeit.repeat(
+            lambda: f(*args), number=1, repeat=nrepeat))
+        print("%12s: %8.3f s" % (name, t))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
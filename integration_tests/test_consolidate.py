@@ -11,7 +11,7 @@ from test_data import (render_params,
                        cons_ex_tilespec_json, 
                        cons_ex_transform_json)
 from rendermodules.module.render_module import RenderModuleException
-from rendermodules.stack.consolidate_transforms import ConsolidateTransforms, process_z, consolidate_transforms
+from rendermodules.stack.consolidate_transforms import ConsolidateTransforms, process_z, consolidate_transforms, consolidate_section_transforms
 from rendermodules.stack import redirect_mipmaps, remap_zs
 
 EPSILON = .001
@@ -183,3 +183,45 @@ def test_remap_zs(render, test_stack, remap_sectionId):
     else:
         assert ({ts.layout.sectionId for ts in in_tspecs} ==
                 {ts.layout.sectionId for ts in out_tspecs})
+
+
+@pytest.mark.parametrize('keep_ref_tforms', [False, True])
+def test_consolidate_section_transforms(keep_ref_tforms):
+    np.random.seed(0)
+
+    def affine():
+        return renderapi.transform.AffineModel(*np.random.randn(6))
+
+    ref = renderapi.transform.TransformList(
+        tforms=[affine(), affine()], transformId='ref')
+    poly = renderapi.transform.Polynomial2DTransform(
+        params=np.random.randn(2, 6))
+    shared = [affine(), renderapi.transform.ReferenceTransform(refId='ref'),
+              affine(), poly, affine()]
+    tforms_list = [[affine()] + shared for i in range(20)]
+    tforms_list += [shared[2:], [affine()] + shared[2:], [], [affine()]]
+
+    new_tforms_list = consolidate_section_transforms(
+        tforms_list, [ref], keep_ref_tforms=keep_ref_tforms)
+    assert len(new_tforms_list) == len(tforms_list)
+
+    pts = np.random.rand(10, 2) * 100
+    for tforms, new_tforms in zip(tforms_list, new_tforms_list):
+        # same result as consolidating tile by tile
+        single = consolidate_transforms(
+            tforms, [ref], keep_ref_tforms=keep_ref_tforms)
+        assert [type(t) for t in single] == [type(t) for t in new_tforms]
+        # same mapping as the original transforms
+        assert np.allclose(
+            renderapi.transform.estimate_dstpts(
+                tforms, pts, reference_tforms=[ref]),
+            renderapi.transform.estimate_dstpts(
+                new_tforms, pts, reference_tforms=[ref]))
+
+    # leading affines are merged, the polynomial is kept
+    if keep_ref_tforms:
+        assert len(new_tforms_list[0]) == 5
+    else:
+        assert len(new_tforms_list[0]) == 3
+        assert new_tforms_list[0][1] is poly
+    assert new_tforms_list[-2] == []
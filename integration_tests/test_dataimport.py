@@ -11,11 +11,14 @@ from rendermodules.module.render_module import RenderModuleException
 from rendermodules.dataimport import generate_EM_tilespecs_from_metafile
 from rendermodules.dataimport import generate_mipmaps
 from rendermodules.dataimport import apply_mipmaps_to_render
+from rendermodules.dataimport.create_mipmaps import create_mipmaps
 from test_data import (render_params,
                        METADATA_FILE, MIPMAP_TILESPECS_JSON,
                        MIPMAP_TRANSFORMS_JSON, scratch_dir)
 import os
 import copy
+import numpy
+import pathlib2 as pathlib
 
 
 
@@ -201,7 +204,7 @@ def addMipMapsToRender_test(render,generate_params):
 """
 
 
-@pytest.mark.parametrize("method", ["PIL", "block_reduce"])
+@pytest.mark.parametrize("method", ["PIL", "block_reduce", "pyramid"])
 def test_mipmaps(render, input_stack, resolvedtiles_to_mipmap, method, tmpdir,
                  output_stack=None):
     assert isinstance(render, renderapi.render.RenderClient)
@@ -277,3 +280,115 @@ def test_create_mipmap_from_tuple(resolvedtiles_to_mipmap, tmpdir):
     filename=generate_mipmaps.get_filepath_from_tilespec(ts)
     mytuple = (filename,str(tmpdir))
     generate_mipmaps.create_mipmap_from_tuple(mytuple)
+
+
+@pytest.mark.parametrize("block_func", ["mean", "median", "min"])
+def test_pyramid_matches_block_reduce(tmpdir, block_func):
+    img = numpy.random.RandomState(0).randint(
+        0, 65535, (256, 192)).astype('uint16')
+    inputImage = str(tmpdir.join('tile.tif'))
+    Image.fromarray(img).save(inputImage)
+
+    levels = {}
+    for method in ["block_reduce", "pyramid"]:
+        levels[method] = create_mipmaps(
+            inputImage, str(tmpdir.join(method)), method=method,
+            mipmaplevels=[1, 3, 4], convertTo8bit=False,
+            block_func=block_func)
+
+    for level, fn in levels["block_reduce"].items():
+        expected = numpy.array(Image.open(fn))
+        actual = numpy.array(Image.open(levels["pyramid"][level]))
+        assert actual.shape == (256 // 2**level, 192 // 2**level)
+        assert numpy.array_equal(expected, actual)
+
+
+def test_incremental_mipmaps(tmpdir):
+    img = numpy.random.RandomState(0).randint(
+        0, 255, (128, 128)).astype('uint8')
+    inputImage = str(tmpdir.join('tile.tif'))
+    Image.fromarray(img).save(inputImage)
+    mipmap_tuple = (
+        pathlib.Path(inputImage).as_uri(),
+        pathlib.Path(str(tmpdir.join('mm'))).as_uri())
+    kwargs = dict(levels=[1, 2, 3], force_redo=False, method="pyramid",
+                  convertTo8bit=False)
+
+    def create(*args, **kwargs):
+        return generate_mipmaps.create_missing_mipmaps_from_tuple_uri(
+            *args, **kwargs)[0]
+
+    nlevels, bytes_read, bytes_written = (
+        generate_mipmaps.create_missing_mipmaps_from_tuple_uri(
+            mipmap_tuple, **kwargs))
+    assert nlevels == 3
+    assert bytes_read == os.path.getsize(inputImage)
+    assert bytes_written > 0
+    assert create(mipmap_tuple, **kwargs) == 0
+
+    os.remove(str(tmpdir.join('mm', '2', 'tile.tif.tif')))
+    assert create(mipmap_tuple, **kwargs) == 1
+
+    # source newer than its mipmaps
+    mtime = os.path.getmtime(str(tmpdir.join('mm', '1', 'tile.tif.tif')))
+    os.utime(inputImage, (mtime + 10, mtime + 10))
+    assert create(mipmap_tuple, **kwargs) == 0
+    assert create(mipmap_tuple, check_source=True, **kwargs) == 3
+    kwargs['force_redo'] = True
+    assert create(mipmap_tuple, **kwargs) == 3
+
+
+def test_iter_mipmap_args():
+    class MockRender(object):
+        def run(self, f, stack, z):
+            if z == 3:
+                raise renderapi.errors.RenderError("no such section")
+            return [renderapi.tilespec.TileSpec(
+                tileId="{}_{}".format(z, i), z=z,
+                imageUrl="file:///{}_{}.tif".format(z, i))
+                for i in range(4)]
+
+    args = list(generate_mipmaps.iter_mipmap_args(
+        MockRender(), 'stack', 'file:///out', [0, 1, 2],
+        fetch_threads=2, max_queued=3))
+    assert len(args) == 12
+    assert {a[1] for a in args} == {'file:///out'}
+
+    with pytest.raises(renderapi.errors.RenderError):
+        list(generate_mipmaps.iter_mipmap_args(
+            MockRender(), 'stack', 'file:///out', [0, 1, 2, 3]))
+
+
+def test_make_tilespecs_and_cmds(tmpdir):
+    rng = numpy.random.RandomState(0)
+    for z in range(3):
+        for i in range(4):
+            Image.fromarray(rng.randint(0, 255, (64, 64)).astype(
+                'uint8')).save(str(tmpdir.join('{}_{}.tif'.format(z, i))))
+
+    class MockRender(object):
+        def run(self, f, stack, z):
+            return [renderapi.tilespec.TileSpec(
+                tileId="{}_{}".format(z, i), z=z,
+                imageUrl=pathlib.Path(str(tmpdir.join(
+                    '{}_{}.tif'.format(z, i)))).as_uri())
+                for i in range(4 if z < 3 else 1)]
+
+    output_prefix = pathlib.Path(str(tmpdir.join('mm'))).as_uri()
+    mipmap_args, results = generate_mipmaps.make_tilespecs_and_cmds(
+        MockRender(), 'stack', output_prefix, [0, 1, 2], 2, 'tif',
+        False, False, 1, 'pyramid', fetch_threads=2)
+    assert len(mipmap_args) == len(results) == 12
+    assert {r[0] for r in results} == {2}
+    assert sum(r[1] for r in results) == sum(
+        os.path.getsize(str(tmpdir.join('{}_{}.tif'.format(z, i))))
+        for z in range(3) for i in range(4))
+    assert sum(r[2] for r in results) == sum(
+        os.path.getsize(str(tmpdir.join('mm', str(l), f)))
+        for l in [1, 2] for f in os.listdir(str(tmpdir.join('mm', str(l)))))
+
+    # a missing source image fails the run instead of blocking the pool
+    with pytest.raises(Exception):
+        generate_mipmaps.make_tilespecs_and_cmds(
+            MockRender(), 'stack', output_prefix, [0, 1, 2, 3], 2, 'tif',
+            False, True, 1, 'pyramid', fetch_threads=2)
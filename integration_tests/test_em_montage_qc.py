@@ -4,6 +4,10 @@ import logging
 import renderapi
 import json
 import copy
+import numpy as np
+import mock
+import networkx as nx
+from scipy.spatial import cKDTree
 
 from test_data import (PRESTITCHED_STACK_INPUT_JSON,
                        POSTSTITCHED_STACK_INPUT_JSON,
@@ -11,10 +15,209 @@ from test_data import (PRESTITCHED_STACK_INPUT_JSON,
                        render_params,
                        montage_qc_project)
 
-from rendermodules.em_montage_qc.detect_montage_defects import DetectMontageDefectsModule, detect_seams, detect_disconnected_tiles, detect_stitching_gaps
+from rendermodules.em_montage_qc.detect_montage_defects import DetectMontageDefectsModule
 from rendermodules.module.render_module import RenderModuleException
 from rendermodules.em_montage_qc import detect_montage_defects
 from rendermodules.em_montage_qc import plots
+from rendermodules.residuals import compute_residuals as cr
+from rendermodules.em_montage_qc.section_cache import SectionDataCache
+
+
+def test_compute_match_residuals():
+    rng = np.random.RandomState(0)
+    tileIds = ['t{}'.format(i) for i in range(5)]
+    tforms = {}
+    for tileId in tileIds:
+        tform = renderapi.transform.AffineModel(
+            M00=1 + rng.rand() * 0.1, M01=rng.rand() * 0.1,
+            M10=rng.rand() * 0.1, M11=1 + rng.rand() * 0.1,
+            B0=rng.rand() * 100, B1=rng.rand() * 100)
+        tforms[tileId] = [renderapi.transform.AffineModel(), tform]
+    allmatches = []
+    for i in range(12):
+        n = rng.randint(1, 20)
+        allmatches.append({
+            'pId': tileIds[i % 4], 'qId': tileIds[(i * 3 + 1) % 5],
+            'matches': {'p': (rng.rand(2, n) * 1000).tolist(),
+                        'q': (rng.rand(2, n) * 1000).tolist()}})
+    # unknown tile and too few points are skipped
+    allmatches.append(dict(allmatches[0], pId='missing'))
+    allmatches.append({'pId': 't4', 'qId': 't0',
+                       'matches': {'p': [[1.0], [2.0]], 'q': [[1.0], [2.0]]}})
+
+    tile_residuals, tile_rmse, positions = cr.compute_match_residuals(
+        allmatches, tforms, min_points=2)
+
+    # per match reference
+    expected = {}
+    for match in allmatches:
+        pts_p = np.array(match['matches']['p'])
+        if match['pId'] not in tforms or pts_p.shape[1] < 2:
+            continue
+        t_p = tforms[match['pId']][-1].tform(pts_p.T)
+        t_q = tforms[match['qId']][-1].tform(
+            np.array(match['matches']['q']).T)
+        res = np.linalg.norm(t_p - t_q, axis=1)
+        r, m, pos = expected.setdefault(match['pId'], ([], [], []))
+        r.append(res)
+        m.append(res / res.shape[0])
+        pos.append((t_p + t_q) / 2.)
+
+    assert set(tile_residuals) == set(expected)
+    for tileId, (r, m, pos) in expected.items():
+        assert np.allclose(tile_residuals[tileId], np.concatenate(r))
+        assert np.allclose(tile_rmse[tileId], np.concatenate(m))
+        assert positions[tileId].shape == (len(tile_residuals[tileId]), 2)
+        assert np.allclose(positions[tileId], np.concatenate(pos))
+
+
+def test_section_data_cache(tmpdir):
+    tilespecs = []
+    for i in range(4):
+        ts = renderapi.tilespec.TileSpec(
+            tileId='t{}'.format(i), z=1, width=100, height=100,
+            tforms=[renderapi.transform.AffineModel(B0=90 * i, B1=0)])
+        ts.layout.sectionId = '1.0'
+        ts.minX, ts.minY, ts.maxX, ts.maxY = 90 * i, 0, 90 * i + 100, 100
+        tilespecs.append(ts)
+    rng = np.random.RandomState(0)
+    allmatches = [{'pId': 't{}'.format(i), 'qId': 't{}'.format(i + 1),
+                   'pGroupId': '1.0', 'qGroupId': '1.0',
+                   'matches': {'p': (rng.rand(2, n) * 100).tolist(),
+                               'q': (rng.rand(2, n) * 100).tolist(),
+                               'w': [1.0] * n}}
+                  for i, n in zip(range(3), [3, 1, 5])]
+
+    render = mock.Mock(DEFAULT_OWNER='owner')
+    with mock.patch('renderapi.tilespec.get_tile_specs_from_z',
+                    return_value=tilespecs) as get_ts, \
+            mock.patch('renderapi.pointmatch.get_matches_within_group',
+                       return_value=allmatches) as get_pm:
+        cache = SectionDataCache(str(tmpdir), render)
+        for i in range(2):
+            tileIds, bboxes = cache.tilespec_columns('stack', 1)
+            cached_ts = cache.tilespecs('stack', 1)
+            match_counts = cache.section_match_counts(
+                'stack', 1, 'collection')
+            pIds, qIds, counts, p, q = cache.section_match_columns(
+                'stack', 1, 'collection')
+        # each section is fetched from render only once
+        assert get_ts.call_count == 1
+        assert get_pm.call_count == 1
+        get_pm.assert_called_with('collection', '1.0', owner='owner',
+                                  render=render)
+
+    assert list(tileIds) == [ts.tileId for ts in tilespecs]
+    assert isinstance(bboxes, np.memmap)
+    assert np.allclose(bboxes, [ts.bbox for ts in tilespecs])
+    assert [ts.to_dict() for ts in cached_ts] == [
+        ts.to_dict() for ts in tilespecs]
+    assert [ts.bbox for ts in cached_ts] == [ts.bbox for ts in tilespecs]
+    assert list(counts) == [3, 1, 5]
+    assert isinstance(p, np.memmap) and p.shape == (9, 2)
+    assert [list(c) for c in match_counts] == [
+        [m['pId'] for m in allmatches], [m['qId'] for m in allmatches],
+        [3, 1, 5]]
+    assert np.allclose(p, np.concatenate(
+        [np.transpose(m['matches']['p']) for m in allmatches]))
+    assert np.allclose(q, np.concatenate(
+        [np.transpose(m['matches']['q']) for m in allmatches]))
+
+    tforms = {ts.tileId: ts.tforms for ts in tilespecs}
+    expected = cr.compute_match_residuals(allmatches, tforms)
+    result = cr.compute_column_residuals(pIds, qIds, counts, p, q, tforms)
+    for e, r in zip(expected, result):
+        assert set(e) == set(r)
+        for k in e:
+            assert np.allclose(e[k], r[k])
+
+
+def test_per_run_cache_dir(tmpdir):
+    ex = copy.copy(detect_montage_defects.example)
+    ex['render'] = render_params
+    ex['minZ'] = 1
+    ex['maxZ'] = 2
+    ex['plot_sections'] = 'False'
+    ex['out_html_dir'] = None
+    ex['cache_dir'] = str(tmpdir)
+    ex['output_json'] = str(tmpdir.join('output.json'))
+
+    cache_dirs = []
+
+    def run_with_cache(cache, zvalues):
+        cache_dirs.append(cache.cache_dir)
+        open(os.path.join(cache.cache_dir, 'entry'), 'w').close()
+
+    # a cache_dir is only the parent of a fresh cache removed after each run
+    with mock.patch('renderapi.stack.get_z_values_for_stack',
+                    return_value=[1, 2]), \
+            mock.patch.object(DetectMontageDefectsModule, 'run_with_cache',
+                              side_effect=run_with_cache):
+        for i in range(2):
+            DetectMontageDefectsModule(input_data=ex, args=[]).run()
+    assert len(set(cache_dirs)) == 2
+    for cache_dir in cache_dirs:
+        assert os.path.dirname(cache_dir) == str(tmpdir)
+        assert not os.path.exists(cache_dir)
+
+
+@pytest.mark.parametrize("max_pairs", [7, 10000000])
+def test_overlap_degrees(max_pairs):
+    rng = np.random.RandomState(0)
+    xy = rng.randint(0, 50, size=(200, 2)).astype(float)
+    bboxes = np.hstack([xy, xy + rng.randint(1, 10, size=(200, 2))])
+    # touching edges count as overlap
+    bboxes[:2] = [[100, 100, 110, 110], [110, 110, 120, 120]]
+    lo = bboxes[:, None, :2] <= bboxes[None, :, 2:]
+    hi = bboxes[None, :, :2] <= bboxes[:, None, 2:]
+    expected = np.all(lo & hi, axis=2).sum(axis=1) - 1
+    degree = detect_montage_defects.overlap_degrees(
+        bboxes, max_pairs=max_pairs)
+    assert np.array_equal(degree, expected)
+    assert degree[0] == 1
+
+
+def test_stitching_gap_tiles():
+    # 3 x 3 grid of overlapping tiles, the center tile moves away
+    # and one tile is missing after stitching.  Isolated tiles
+    # are not reported as gaps.
+    xy = np.array([[i, j] for j in range(3) for i in range(3)]) * 90.
+    pre = np.hstack([xy, xy + 100])
+    post = pre.copy()
+    post[4] += 1000
+    tileIds = ['t{}'.format(i) for i in range(9)]
+    gaps = detect_montage_defects.stitching_gap_tiles(
+        tileIds, pre, tileIds[:8], post[:8])
+    assert set(gaps) == {'t0', 't1', 't2', 't3', 't5', 't6', 't7'}
+
+
+def test_cluster_centroids():
+    rng = np.random.RandomState(0)
+    centers = np.array([[0, 0], [1000, 0], [0, 1000]])
+    sizes = [40, 25, 10]
+    pts = np.vstack([c + rng.normal(0, 10, (n, 2))
+                     for c, n in zip(centers, sizes)] +
+                    [rng.uniform(3000, 9000, (20, 2))])
+
+    # networkx reference
+    G = nx.Graph()
+    G.add_edges_from(cKDTree(pts).query_pairs(r=60))
+    nodes = sorted(nx.connected_components(G), key=len, reverse=True)
+    expected = [pts[list(nn)].mean(axis=0) for nn in nodes if len(nn) > 12]
+
+    centroids = detect_montage_defects.cluster_centroids(pts, 60, 12)
+    assert np.allclose(centroids, expected)
+    assert np.allclose(centroids, centers[:2], atol=10)
+
+    # binning merges points while keeping cluster sizes and centroids
+    binned, counts = detect_montage_defects.bin_points(pts, 5.)
+    assert counts.sum() == len(pts)
+    binned_centroids = detect_montage_defects.cluster_centroids(
+        binned, 60, 12, weights=counts)
+    assert np.allclose(binned_centroids, centroids, atol=1)
+
+    assert len(detect_montage_defects.cluster_centroids(
+        np.empty((0, 2)), 60, 12)) == 0
 
 
 @pytest.fixture(scope='module')
@@ -218,7 +421,5 @@ def test_stack_in_loading_state(render,
     ex['min_cluster_size'] = 12
     ex['output_json'] = os.path.join(output_directory, 'output.json')
 
-    #status, new_stack = detect_montage_defects.check_status_of_stack(render, poststitched_stack, [1028, 1029])
-
     mod = DetectMontageDefectsModule(input_data=ex, args=[])
     mod.run()
@@ -2,9 +2,11 @@ import os
 import pytest
 import renderapi
 import json
+import zipfile
 import numpy as np
 from rendermodules.pointmatch_filter.filter_point_matches \
-        import FilterMatches, filter_plot
+        import (FilterMatches, filter_plot, fit_affine_batch,
+                write_filter_npz, read_filter_npz)
 from matplotlib.figure import Figure
 from test_data import (PRESTITCHED_STACK_INPUT_JSON,
                        MONTAGE_QC_POINT_MATCH_JSON,
@@ -12,6 +14,70 @@ from test_data import (PRESTITCHED_STACK_INPUT_JSON,
                        montage_qc_project)
 
 
+def test_fit_affine_batch():
+    rng = np.random.RandomState(0)
+    counts = np.array([50, 3, 2, 20, 10])
+    p = rng.uniform(0, 4000, (counts.sum(), 2)) + 1e5
+    q = p + rng.normal(0, 2, p.shape) + [300, -200]
+    # collinear points need the least squares fallback
+    p[-10:, 1] = 7.0
+    tvec, residuals = fit_affine_batch(p, q, counts)
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    for k, (s, e) in enumerate(zip(starts[:-1], starts[1:])):
+        A = p[s:e]
+        B = q[s:e]
+        expected = renderapi.transform.AffineModel.fit(A, B).ravel()
+        fit = np.column_stack([
+            tvec[k, 0] * A[:, 0] + tvec[k, 1] * A[:, 1] + tvec[k, 4],
+            tvec[k, 2] * A[:, 0] + tvec[k, 3] * A[:, 1] + tvec[k, 5]])
+        assert np.isclose(residuals[k], np.sum((B - fit) ** 2))
+        if counts[k] >= 3 and k < len(counts) - 1:
+            assert np.allclose(tvec[k], expected, rtol=1e-6, atol=1e-4)
+            if counts[k] > 3:
+                _, res, _, _ = renderapi.transform.AffineModel.fit(
+                    A, B, return_all=True)
+                assert np.isclose(residuals[k], res[0], rtol=1e-5)
+
+
+def test_fit_affine_batch_empty():
+    rng = np.random.RandomState(1)
+    counts = np.array([0, 12, 0, 0, 5, 0])
+    p = rng.uniform(0, 4000, (counts.sum(), 2))
+    q = p + rng.normal(0, 2, p.shape) + [30, 20]
+    tvec, residuals = fit_affine_batch(p, q, counts)
+    nonempty = counts > 0
+    expected_tvec, expected_residuals = fit_affine_batch(
+        p, q, counts[nonempty])
+    assert np.allclose(tvec[nonempty], expected_tvec)
+    assert np.allclose(residuals[nonempty], expected_residuals)
+    assert np.array_equal(tvec[~nonempty], np.tile([1, 0, 0, 1, 0, 0], (4, 1)))
+    assert np.array_equal(residuals[~nonempty], np.zeros(4))
+
+    tvec, residuals = fit_affine_batch(
+        np.empty((0, 2)), np.empty((0, 2)), [0, 0])
+    assert tvec.shape == (2, 6) and np.all(residuals == 0)
+    tvec, residuals = fit_affine_batch(np.empty((0, 2)), np.empty((0, 2)), [])
+    assert tvec.shape == (0, 6) and residuals.shape == (0,)
+
+
+def test_filter_npz_roundtrip(tmpdir):
+    results = [
+        {'z': z, 'filter': [
+            {'pId': 'p%d' % i, 'qId': 'q%d' % i, 'nres': 0.1 * i,
+             'translation': 2.0 * i, 'count': 10 + i, 'weight': 1.0}
+            for i in range(n)]}
+        for z, n in [(12, 3), (2, 1), (7, 0)]]
+    fname = str(tmpdir.join('filter.npz'))
+    with zipfile.ZipFile(fname, 'w') as zf:
+        for result in results:
+            write_filter_npz(zf, result)
+    out = read_filter_npz(fname)
+    assert out['z'].tolist() == [2, 12, 12, 12]
+    assert out['pId'].tolist() == ['p0', 'p0', 'p1', 'p2']
+    assert out['count'].tolist() == [10, 10, 11, 12]
+    assert np.allclose(out['nres'], [0, 0, 0.1, 0.2])
+
+
 @pytest.fixture(scope='module')
 def render():
     render_params['project'] = montage_qc_project
@@ -140,6 +206,21 @@ def test_filter_basic(example):
         assert np.all(np.isclose(weights, 0.0) | np.isclose(weights, 1.0))
 
 
+def test_filter_npz(example):
+    params = dict(example)
+    fmod = run_and_check_output(params)
+    with open(fmod.args['filter_output_file'], 'r') as f:
+        fj = json.load(f)
+    params['filter_output_format'] = 'npz'
+    params['filter_output_file'] = params['filter_output_file'] + '.npz'
+    fmod = run_and_check_output(params)
+    out = read_filter_npz(fmod.args['filter_output_file'])
+    assert len(out['nres']) == sum([len(f['filter']) for f in fj])
+    assert np.allclose(
+        np.sort(out['nres']),
+        np.sort([tp['nres'] for f in fj for tp in f['filter']]))
+
+
 def test_filter_inverse(example):
     params = dict(example)
     params['inverse_weighting'] = True
@@ -6,10 +6,14 @@ import renderapi
 import tifffile
 import numpy as np
 import random
+import mock
 from test_data import (MULTIPLICATIVE_INPUT_JSON, multiplicative_correction_example_dir,
                        render_params)
-from rendermodules.intensity_correction.calculate_multiplicative_correction import MakeMedian
-from rendermodules.intensity_correction.apply_multiplicative_correction import MultIntensityCorr, getImage, process_tile
+from rendermodules.intensity_correction.calculate_multiplicative_correction import MakeMedian, median_image
+from rendermodules.intensity_correction.apply_multiplicative_correction import (
+    MultIntensityCorr, getImage, process_tile, intensity_corr,
+    save_correction_factor, get_correction_factor, apply_correction_factor,
+    iter_z_tilespecs, init_writer, _worker_writer)
 
 
 @pytest.fixture(scope='module')
@@ -46,6 +50,121 @@ def mini_raw_stack(render,test_tilespecs):
     renderapi.stack.delete_stack(stack, render=render)
 
 
+@pytest.mark.parametrize("numimages", [7, 8])
+@pytest.mark.parametrize("memory_budget", [2**30, 4096])
+def test_median_image_bounded(numimages, memory_budget, tmpdir):
+    # a small budget forces the memory mapped stack and single row blocks
+    rng = np.random.RandomState(0)
+    imgs = rng.randint(0, 65535, size=(numimages, 37, 23)).astype(np.uint16)
+    med = median_image(iter(imgs), numimages, imgs.shape[1:], imgs.dtype,
+                       memory_budget, scratch_dir=str(tmpdir))
+    expected = np.median(imgs, axis=0).astype(imgs.dtype)
+    assert med.dtype == imgs.dtype
+    assert np.array_equal(med, expected)
+
+
+def test_intensity_corr_float32(tmpdir):
+    rng = np.random.RandomState(1)
+    ff = rng.randint(1000, 5000, size=(64, 48)).astype(np.uint16)
+    img = rng.randint(0, 30000, size=(64, 48)).astype(np.uint16)
+
+    # float64 reference of the original implementation
+    fac = np.amax(ff.astype(float)) / (ff.astype(float) + 0.0001)
+    expected = img * fac
+    expected *= np.mean(img) / np.mean(expected)
+    expected = np.clip(expected / 2.0, 0, 65535).astype(img.dtype)
+
+    result = intensity_corr(img, ff, True, 2.0, 0, 65535)
+    assert result.dtype == img.dtype
+    assert np.max(np.abs(result.astype(int) - expected)) <= 1
+
+    # memory mapped factors give the same result
+    facfile = save_correction_factor(ff, str(tmpdir.join('C.npy')))
+    mmfac = get_correction_factor(facfile)
+    assert get_correction_factor(facfile) is mmfac
+    assert np.array_equal(
+        apply_correction_factor(img, mmfac, True, 2.0, 0, 65535), result)
+
+
+def test_iter_z_tilespecs():
+    zs = [3, 1, 2, 5]
+    with mock.patch('renderapi.tilespec.get_tile_specs_from_z',
+                    side_effect=lambda stack, z, render=None: [(stack, z)]):
+        result = list(iter_z_tilespecs(None, 'stack', zs, nthreads=3))
+    assert result == [(z, [('stack', z)]) for z in zs]
+
+
+def test_process_tile_worker_writer(tmpdir):
+    rng = np.random.RandomState(2)
+    ff = rng.randint(1000, 5000, size=(32, 24)).astype(np.uint16)
+    tilespecs = []
+    for i in range(3):
+        fn = str(tmpdir.join('tile_{}.tif'.format(i)))
+        tifffile.imsave(fn, rng.randint(0, 30000, size=(32, 24)).astype(
+            np.uint16))
+        tilespecs.append(renderapi.tilespec.TileSpec(
+            tileId=str(i), z=1, imageUrl='file://' + fn))
+
+    # tiles processed by a worker share the writer started by the initializer
+    init_writer()
+    writer = _worker_writer['writer']
+    try:
+        for ts in tilespecs:
+            process_tile(ff, str(tmpdir), 'out', True, 1.0, 0, 65535, ts)
+            assert _worker_writer['writer'] is writer
+    finally:
+        _worker_writer.pop('writer').close()
+        writer.join()
+    for i, ts in enumerate(tilespecs):
+        assert os.path.basename(ts.ip[0].imageUrl) == 'out_0001_tile_{}.tif'.format(i)
+        assert os.path.isfile(ts.ip[0].imageUrl)
+
+
+def test_mult_intensity_corr_bounded(tmpdir):
+    rng = np.random.RandomState(3)
+    ff = str(tmpdir.join('ff.tif'))
+    tifffile.imsave(ff, rng.randint(1000, 5000, size=(16, 16)).astype(np.uint16))
+
+    def get_tile_specs_from_z(stack, z, render=None, **kwargs):
+        if stack == 'correction':
+            return [renderapi.tilespec.TileSpec(
+                tileId='ff', z=z, imageUrl='file://' + ff)]
+        tilespecs = []
+        for i in range(5):
+            fn = str(tmpdir.join('tile_{}_{}.tif'.format(z, i)))
+            if not (z == 3 and i == 2):
+                tifffile.imsave(fn, rng.randint(0, 30000, size=(16, 16)).astype(
+                    np.uint16))
+            tilespecs.append(renderapi.tilespec.TileSpec(
+                tileId='{}_{}'.format(z, i), z=z, imageUrl='file://' + fn))
+        return tilespecs
+
+    def run(zValues):
+        imported = []
+        mod = MultIntensityCorr(input_data=dict(
+            render=render_params, input_stack='input',
+            correction_stack='correction', output_stack='output',
+            output_directory=str(tmpdir.join('out')), zValues=zValues,
+            pool_size=1, import_batch_size=3, close_stack=False,
+            overwrite_zlayer=False), args=[])
+        with mock.patch('renderapi.stack.create_stack'), \
+                mock.patch('renderapi.tilespec.get_tile_specs_from_z',
+                           side_effect=get_tile_specs_from_z), \
+                mock.patch('renderapi.client.import_tilespecs_parallel',
+                           side_effect=lambda stack, tilespecs, **kwargs:
+                           imported.extend(tilespecs)):
+            mod.run()
+        return imported
+
+    imported = run([1, 2])
+    assert sorted(ts.tileId for ts in imported) == sorted(
+        '{}_{}'.format(z, i) for z in [1, 2] for i in range(5))
+
+    # a failing tile stops the run instead of blocking the pool
+    with pytest.raises(Exception):
+        run([1, 2, 3, 4, 5])
+
+
 @pytest.fixture(scope='module')
 def test_median_stack(raw_stack, render, tmpdir_factory):
     median_stack = 'median_stack'
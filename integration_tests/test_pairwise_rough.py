@@ -2,10 +2,12 @@ import os
 import pytest
 import renderapi
 import json
+import mock
 from test_data import TEST_DATA_ROOT, render_params
 from rendermodules.module.render_module import RenderModuleException
 from rendermodules.rough_align.pairwise_rigid_rough import \
-        PairwiseRigidRoughAlignment
+        PairwiseRigidRoughAlignment, MatchIndex, chain_transforms, \
+        average_transforms
 from rendermodules.rough_align.make_anchor_stack import \
         MakeAnchorStack
 import numpy as np
@@ -328,3 +330,98 @@ def test_pairwise_rigid_alignment_coverage(
     assert(len(outj['residuals']) == 199)
     os.remove(ex['output_json'])
     renderapi.stack.delete_stack(outj['output_stack'], render=render)
+
+
+def test_match_index():
+    def match(p, q):
+        return {'pGroupId': p, 'qGroupId': q,
+                'pId': 't' + p, 'qId': 't' + q,
+                'matches': {'p': [[0], [0]], 'q': [[0], [0]], 'w': [1]}}
+
+    # matchesOutsideGroup returns matches with the group on either side
+    pairs = [('1.0', '2.0'), ('1.0', '3.0'), ('2.0', '3.0'),
+             ('3.0', '4.0'), ('4.0', '5.0')]
+
+    def outside(c, g, **kw):
+        return [match(p, q) for p, q in pairs if g in (p, q)]
+
+    def spec(g):
+        return renderapi.tilespec.TileSpec(
+            tileId='t' + g, z=float(g), sectionId=g)
+
+    pw = 'rendermodules.rough_align.pairwise_rigid_rough.renderapi.pointmatch.'
+    with mock.patch(pw + 'get_matches_outside_group',
+                    side_effect=outside) as mog, \
+            mock.patch(pw + 'get_matches_from_group_to_group',
+                       return_value=[]) as mgg:
+        index = MatchIndex('collection', None)
+        index.prefetch([('2.0', '1.0'), ('2.0', '3.0'), ('1.0', '3.0')])
+        assert sorted(c[0][1] for c in mog.call_args_list) == ['1.0', '2.0']
+
+        # shared by later lookups, no refetch
+        index.prefetch([('3.0', '1.0')])
+        assert mog.call_count == 2
+
+        m = index.tile_matches(spec('3.0'), spec('2.0'))
+        assert len(m) == 1
+        assert (m[0]['pGroupId'], m[0]['qGroupId']) == ('2.0', '3.0')
+        assert len(index.tile_matches(spec('1.0'), spec('3.0'))) == 1
+        mgg.assert_not_called()
+
+        # overlapping groups of a chain of sections
+        index.prefetch([('3.0', '4.0'), ('4.0', '5.0')])
+        assert mog.call_count == 4
+        for p, q in pairs:
+            assert len(index.tile_matches(spec(p), spec(q))) == 1
+            assert len(index.tile_matches(spec(q), spec(p))) == 1
+        mgg.assert_not_called()
+
+        # missing pairs fall back to a group to group request once
+        assert index.tile_matches(spec('5.0'), spec('6.0')) == []
+        assert index.tile_matches(spec('6.0'), spec('5.0')) == []
+        assert mgg.call_count == 1
+
+
+def rigid(theta, tx, ty):
+    return np.array([
+        [np.cos(theta), -np.sin(theta), tx],
+        [np.sin(theta), np.cos(theta), ty],
+        [0, 0, 1]])
+
+
+@pytest.mark.parametrize('n', [0, 1, 2, 7, 64])
+def test_chain_transforms(n):
+    np.random.seed(n)
+    M0 = rigid(0.3, 10, -4)
+    Ms = [rigid(*np.random.randn(3)) for i in range(n)]
+
+    M = M0
+    expected = []
+    for m in Ms:
+        M = M.dot(m)
+        expected.append(M)
+
+    chained = chain_transforms(M0, Ms)
+    assert chained.shape == (n, 3, 3)
+    assert np.allclose(chained, np.array(expected).reshape(-1, 3, 3))
+
+
+def test_average_transforms():
+    np.random.seed(3)
+    zs = np.array([5, 4, 3, 5, 6, 7, 7, 8])
+    dists = np.array([0, 1, 2, 0, 1, 2, 1, 0])
+    Ms = np.array([rigid(*np.random.randn(3)) for z in zs])
+
+    first, M = average_transforms(zs, dists, Ms)
+
+    for unz, i, m in zip(np.unique(zs), first, M):
+        ind = np.argwhere(zs == unz).flatten()
+        assert i == ind[0]
+        dsum = dists[ind].sum()
+        if (ind.size == 1) | (dsum == 0):
+            assert np.allclose(m, Ms[ind[0]])
+        else:
+            expected = np.zeros((3, 3))
+            for j in ind:
+                expected += (dsum - dists[j]) / float(dsum) * Ms[j]
+            assert np.allclose(m, expected)
@@ -1,4 +1,6 @@
+import gzip
 import os
+import mock
 import pytest
 import renderapi
 import json
@@ -167,3 +169,207 @@ def test_pt_match_opencv(
         tpjs = json.load(f)
 
     assert(js['pairCount'] == len(tpjs['neighborPairs']))
+
+
+def test_ransac_chunk_synthetic():
+    rng = np.random.RandomState(0)
+    n = 500
+    des1 = rng.uniform(0, 255, (n, 128)).astype('float32')
+    k1xy = rng.uniform(0, 1000, (n, 2))
+    perm = rng.permutation(n)
+    des2 = des1[perm]
+    k2xy = k1xy[perm] + np.array([100.0, -50.0])
+    args = {
+        "FLANN_ntree": 5,
+        "FLANN_ncheck": 50,
+        "ratio_of_dist": 0.8,
+        "RANSAC_outlier": 5.0}
+
+    matcher = cv2.BFMatcher()
+    idx, dist = knn_match_arrays(matcher.knnMatch(des1, des2, k=2))
+    assert idx.shape == (n, 3)
+    assert dist.shape == (n, 2)
+    assert np.all(perm[idx[:, 1]] == idx[:, 0])
+
+    k1ind = np.argwhere(k1xy[:, 0] < 500).flatten()
+    k1, k2 = ransac_chunk([k1xy, k2xy, des1, des2, k1ind, args])
+    assert k1.shape == (k1ind.size, 2)
+    assert np.allclose(k2 - k1, [100.0, -50.0])
+
+    k1, k2 = ransac_chunk([k1xy, k2xy, des1, des2, k1ind[0:5], args])
+    assert k1.shape == k2.shape == (0, 2)
+
+
+def test_feature_cache(tmpdir):
+    rng = np.random.RandomState(0)
+    im = cv2.GaussianBlur(
+        rng.randint(0, 255, (400, 600)).astype('uint8'), (7, 7), 2)
+    imfile = os.path.join(str(tmpdir), 'tile.png')
+    cv2.imwrite(imfile, im)
+    impath = [pathlib.Path(imfile).as_uri(), None]
+
+    args = dict(pt_match_opencv_example)
+    args['feature_cache_dir'] = str(tmpdir.mkdir('features'))
+
+    fpath = extract_features([impath, args])
+    assert fpath == feature_cache_path(impath, args)
+    kxy, des, shape = load_features(fpath)
+    assert kxy.shape[0] == des.shape[0] > 0
+    assert shape == (120, 180)
+
+    # cached features are not recomputed
+    mtime = os.path.getmtime(fpath)
+    assert extract_features([impath, args]) == fpath
+    assert os.path.getmtime(fpath) == mtime
+
+    args['SIFT_sigma'] = 2.0
+    assert feature_cache_path(impath, args) != fpath
+
+
+def test_match_writer_batches():
+    calls = []
+
+    def flaky_import(collection, matches, **kwargs):
+        calls.append(len(matches))
+        if len(calls) == 2:
+            raise renderapi.errors.RenderError("temporary failure")
+
+    with mock.patch('renderapi.pointmatch.import_matches',
+                    side_effect=flaky_import):
+        writer = MatchWriter(None, 'collection', batch_size=4,
+                             retries=2, backoff=0.01)
+        writer.start()
+        for i in range(10):
+            writer.put({'pId': str(i)})
+        writer.close()
+    # second batch is retried once
+    assert calls == [4, 4, 4, 2]
+    assert writer.count == 10
+
+    with mock.patch('renderapi.pointmatch.import_matches',
+                    side_effect=renderapi.errors.RenderError("down")):
+        writer = MatchWriter(None, 'collection', batch_size=4,
+                             retries=1, backoff=0.01)
+        writer.start()
+        with pytest.raises(renderapi.errors.RenderError):
+            for i in range(10):
+                writer.put({'pId': str(i)})
+            writer.close()
+
+
+def test_partition_keypoints():
+    rng = np.random.RandomState(1)
+    shape = (300, 500)
+    ndiv = 4
+    kxy = rng.uniform(0, 1, (1000, 2)) * [shape[1], shape[0]]
+    order, bounds = partition_keypoints(kxy, shape, ndiv)
+    assert np.array_equal(np.sort(order), np.arange(kxy.shape[0]))
+    assert bounds[0] == 0
+    assert bounds[-1] == kxy.shape[0]
+    for i in range(ndiv):
+        for j in range(ndiv):
+            n = i * ndiv + j
+            cell = kxy[order[bounds[n]:bounds[n + 1]]]
+            assert np.all(cell[:, 1] >= shape[0] * i / ndiv)
+            assert np.all(cell[:, 1] < shape[0] * (i + 1) / ndiv)
+            assert np.all(cell[:, 0] >= shape[1] * j / ndiv)
+            assert np.all(cell[:, 0] < shape[1] * (j + 1) / ndiv)
+
+
+def test_pair_ledger(tmpdir):
+    ledger_file = os.path.join(str(tmpdir), 'ledger.sqlite')
+    phash = PairLedger.hash_parameters(pt_match_opencv_example)
+    ledger = PairLedger(ledger_file, phash)
+    ledger.add([('b', 'a'), ('c', 'd')])
+    ledger.add([('a', 'b')])
+    ledger.close()
+
+    ledger = PairLedger(ledger_file, phash)
+    assert ledger.completed() == {('a', 'b'), ('c', 'd')}
+    ledger.close()
+
+    args = dict(pt_match_opencv_example)
+    args['ratio_of_dist'] = 0.5
+    ledger = PairLedger(ledger_file, PairLedger.hash_parameters(args))
+    assert ledger.completed() == set()
+    ledger.close()
+
+
+def test_pair_ledger_seed(tmpdir):
+    ledger = PairLedger(
+        os.path.join(str(tmpdir), 'ledger.sqlite'), 'phash')
+    render = renderapi.connect(
+        host='http://render', port=8080, owner='o', project='p',
+        client_scripts='/tmp')
+    matches = [{'pId': 'b', 'qId': 'a'}, {'pId': 'c', 'qId': 'd'}]
+    with mock.patch('renderapi.pointmatch.get_match_groupIds',
+                    return_value=['1.0', '3.0']), \
+            mock.patch('renderapi.utils.get_json',
+                       return_value=matches) as get_json:
+        n = ledger.seed_from_collection(render, 'coll', ['1.0', '2.0'])
+    assert n == 2
+    assert ledger.completed() == {('a', 'b'), ('c', 'd')}
+
+    # only pairs are requested, not the match points
+    assert get_json.call_count == 1
+    url = get_json.call_args[0][1]
+    assert url.endswith('/owner/o/matchCollection/coll/pGroup/1.0/matches')
+    assert get_json.call_args[1]['params'] == {
+        'excludeMatchDetails': 'true'}
+    ledger.close()
+
+
+def test_load_tilespecs_bulk_and_sparse():
+    sections = {
+        's1': [renderapi.tilespec.TileSpec(tileId='s1_%d' % i, z=1.0)
+               for i in range(5)],
+        's2': [renderapi.tilespec.TileSpec(tileId='s2_%d' % i, z=2.0)
+               for i in range(5)]}
+    alltiles = {t.tileId: t for ts in sections.values() for t in ts}
+    unique_ids = np.array(['s1_0', 's1_1', 's1_2', 's2_3'])
+    groupIds = {tid: tid.split('_')[0] for tid in unique_ids}
+
+    with mock.patch('renderapi.stack.get_section_z_value',
+                    side_effect=lambda stack, g, **kw: g), \
+            mock.patch('renderapi.resolvedtiles.get_resolved_tiles_from_z',
+                       side_effect=lambda stack, z, **kw:
+                       renderapi.resolvedtiles.ResolvedTiles(
+                           tilespecs=sections[z])) as bulk, \
+            mock.patch('renderapi.tilespec.get_tile_spec_raw',
+                       side_effect=lambda stack, tid, **kw:
+                       alltiles[tid]) as single:
+        tspecs = load_tilespecs(
+            None, 'stack', unique_ids, groupIds=groupIds,
+            nthreads=2, bulk_fetch_min_tiles=2)
+    assert [t.tileId for t in tspecs] == list(unique_ids)
+    assert bulk.call_count == 1
+    assert single.call_count == 1
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_stream_tilepairs(tmpdir, compress):
+    tpjson = render_json_template(
+        example_env, 'pt_match_opts_tilepairs.json',
+        owner='owner', project='project', stack='stack')
+    fname = os.path.join(str(tmpdir), 'tilepairs.json')
+    if compress:
+        fname += '.gz'
+        with gzip.open(fname, 'wt') as f:
+            json.dump(tpjson, f, indent=2)
+    else:
+        with open(fname, 'w') as f:
+            json.dump(tpjson, f, indent=2)
+
+    for chunk_size in [7, 2**20]:
+        assert list(stream_tilepairs(
+            fname, chunk_size=chunk_size)) == tpjson['neighborPairs']
+
+    unique_ids, tile_index, groupIds = load_tilepairs(fname)
+    ref_ids, ref_index = parse_tileids(tpjson)
+    assert np.array_equal(unique_ids, ref_ids)
+    assert np.array_equal(tile_index, ref_index)
+    for m in tpjson['neighborPairs']:
+        assert groupIds[m['p']['id']] == m['p']['groupId']
+    tile_ids = np.array([[m['p']['id'], m['q']['id']]
+                         for m in tpjson['neighborPairs']])
+    assert np.array_equal(unique_ids[tile_index], tile_ids)
@@ -9,6 +9,8 @@ import copy
 import re
 import marshmallow as mm
 import six
+import mock
+import cv2
 from six.moves import urllib
 from test_data import (
         ROUGH_MONTAGE_TILESPECS_JSON,
@@ -32,7 +34,9 @@ from rendermodules.dataimport.make_montage_scapes_stack import MakeMontageScapeS
 from rendermodules.solver.solve import Solve_stack
 from rendermodules.rough_align.apply_rough_alignment_to_montages import (ApplyRoughAlignmentTransform,
                                                                          #example as ex1,
-                                                                         apply_rough_alignment)
+                                                                         apply_rough_alignment,
+                                                                         stack_section_bounds,
+                                                                         filter_highres_with_masks)
 from rendermodules.solver.solve import Solve_stack
 import shutil
 import numpy as np
@@ -1192,3 +1196,65 @@ def test_multiple_transform_apply_rough(
             a_lpt = aligned_tId_to_lpts[tId]
             assert np.linalg.norm(
                 np.array(a_lpt['local'][:2]) - np.array(r_lpt['local'][:2])) < 1
+
+
+def test_stack_section_bounds():
+    render = mock.MagicMock()
+    render.run.side_effect = lambda f, *args, **kwargs: f(*args, **kwargs)
+    sectionData = [
+        {'z': 1.0, 'sectionId': '1.0', 'minX': 0, 'minY': 5, 'maxX': 10, 'maxY': 20},
+        {'z': 1.0, 'sectionId': '1.1', 'minX': -3, 'minY': 6, 'maxX': 8, 'maxY': 25},
+        {'z': 2.0, 'sectionId': '2.0', 'minX': None, 'minY': None, 'maxX': None, 'maxY': None}]
+    bounds2 = {'minX': 1, 'minY': 2, 'maxX': 3, 'maxY': 4}
+
+    def get_bounds_from_z(stack, z, **kwargs):
+        if z == 3:
+            raise renderapi.errors.RenderError("no section z=3")
+        return bounds2
+
+    with mock.patch('renderapi.stack.get_stack_sectionData',
+                    return_value=sectionData), \
+            mock.patch('renderapi.stack.get_bounds_from_z',
+                       side_effect=get_bounds_from_z) as get_bounds:
+        bounds = stack_section_bounds(render, 'stack', [1, 2, 3])
+
+    assert get_bounds.call_count == 2
+    assert get_bounds.call_args_list[0][0][:2] == ('stack', 2)
+    assert bounds[2] == bounds2
+    # a missing section is reported per z instead of failing all
+    assert isinstance(bounds[3], renderapi.errors.RenderError)
+    assert [bounds[1][k] for k in ['minX', 'minY', 'maxX', 'maxY']] == \
+        [-3, 5, 10, 25]
+
+
+def test_filter_highres_with_masks(tmpdir):
+    # 10 x 10 tiles of size 100 overlapping by 10
+    tilespecs = [renderapi.tilespec.TileSpec(
+        tileId='%d_%d' % (i, j), z=1.0, width=100, height=100,
+        tforms=[renderapi.transform.AffineModel(B0=90 * i, B1=90 * j)])
+        for i in range(10) for j in range(10)]
+    resolved = renderapi.resolvedtiles.ResolvedTiles(
+        tilespecs=tilespecs, transformList=[])
+
+    # lowres mask at scale 0.1 masking out x < 300 and a block
+    # around (600, 600)
+    mask = np.full((100, 100), 255, dtype='uint8')
+    mask[:, :30] = 0
+    mask[58:62, 58:62] = 0
+    mask_path = str(tmpdir.join('mask.png'))
+    cv2.imwrite(mask_path, mask)
+    lowres = renderapi.tilespec.TileSpec(
+        tileId='lowres', z=1.0, width=100, height=100,
+        tforms=[renderapi.transform.AffineModel(M00=10.0, M11=10.0)])
+
+    kept = filter_highres_with_masks(
+        resolved, lowres, {'lowres': 'file://' + mask_path})
+    kept = set(t.tileId for t in kept)
+    expected = set(
+        t.tileId for t in tilespecs
+        if (t.tforms[0].B0 > 300) and not (
+            (t.tforms[0].B0 < 620) & (t.tforms[0].B0 + 100 > 580) &
+            (t.tforms[0].B1 < 620) & (t.tforms[0].B1 + 100 > 580)))
+    assert kept == expected
+
+    assert len(filter_highres_with_masks(resolved, lowres, {})) == 100
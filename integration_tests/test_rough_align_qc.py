@@ -4,6 +4,9 @@ import logging
 import renderapi
 import json
 import glob
+import numpy as np
+from shapely.geometry import Polygon
+from shapely.ops import cascaded_union
 from six.moves import urllib
 from test_data import (MONTAGE_SCAPES_TSPECS,
                        ROUGH_QC_TEST_PT_MATCHES,
@@ -15,7 +18,8 @@ from test_data import (MONTAGE_SCAPES_TSPECS,
 
 from rendermodules.module.render_module import RenderModuleException
 from rendermodules.dataimport.make_montage_scapes_stack import MakeMontageScapeSectionStack, create_montage_scape_tile_specs
-from rendermodules.em_montage_qc.rough_align_qc import RoughAlignmentQC
+from rendermodules.em_montage_qc.rough_align_qc import (
+    RoughAlignmentQC, compute_raster_metrics, compute_ious, compute_distortion)
 from rendermodules.solver.solve import Solve_stack
 
 
@@ -95,3 +99,66 @@ def test_rough_align_qc(render, downsample_stack, outstack, tmpdir_factory):
     assert(any([n.endswith("html") for n in items]))
 
 
+def test_raster_metrics_match_polygons():
+    # 3x3 grid of overlapping 100x100 tiles per section, shifted and
+    # rotated after alignment, with z=3 missing
+    zvalues = [1, 2, 4]
+    square = np.array([[0, 0], [100, 0], [100, 100], [0, 100]], dtype=float)
+
+    def section(offset, theta):
+        c, s = np.cos(theta), np.sin(theta)
+        R = np.array([[c, -s], [s, c]])
+        tiles = [square + [90 * i, 90 * j] for i in range(3) for j in range(3)]
+        return np.array([t.dot(R.T) + offset for t in tiles], dtype=np.float32)
+
+    pre = [section([0, 0], 0) for z in zvalues]
+    post = [section([10 * z, -5 * z], 0.02 * z) for z in zvalues]
+
+    ious, distortion, pre_polys, post_polys, dio, doi = \
+        compute_raster_metrics(pre, post, zvalues, raster_size=1024)
+
+    def union(outlines):
+        return cascaded_union([Polygon(o) for o in outlines])
+
+    exact_ious = compute_ious(
+        {z: union(o) for z, o in zip(zvalues, post)}, zvalues)
+    assert ious.shape == exact_ious.shape
+    assert np.allclose(ious, exact_ious, atol=0.01)
+    assert ious[0, 2] > 0 and ious[2, 0] == 0
+
+    for z, a, b, d in zip(zvalues, pre, post, distortion):
+        exact = compute_distortion(union(a), union(b), z)[2]
+        assert np.isclose(d, exact, atol=0.01)
+
+    assert len(pre_polys) == len(post_polys) == len(dio) == len(doi) == 3
+    assert all(isinstance(p, Polygon) for p in post_polys[0])
+    assert np.isclose(sum(p.area for p in pre_polys[0]), 280 * 280, rtol=0.01)
+
+
+def test_raster_metrics_misplaced_section():
+    # a single post section far off must not coarsen the other sections
+    zvalues = [1, 2, 3, 4]
+    square = np.array([[0, 0], [100, 0], [100, 100], [0, 100]], dtype=float)
+
+    def section(offset, theta):
+        c, s = np.cos(theta), np.sin(theta)
+        R = np.array([[c, -s], [s, c]])
+        tiles = [square + [90 * i, 90 * j] for i in range(3) for j in range(3)]
+        return np.array([t.dot(R.T) + offset for t in tiles], dtype=np.float32)
+
+    pre = [section([0, 0], 0) for z in zvalues]
+    post = [section([10 * z, -5 * z], 0.02 * z) for z in zvalues]
+    post[2] = section([20000, 0], 0.05)
+
+    ious, distortion, pre_polys, post_polys, dio, doi = \
+        compute_raster_metrics(pre, post, zvalues, raster_size=1024)
+
+    def union(outlines):
+        return cascaded_union([Polygon(o) for o in outlines])
+
+    exact_ious = compute_ious(
+        {z: union(o) for z, o in zip(zvalues, post)}, zvalues)
+    assert np.allclose(ious, exact_ious, atol=0.005)
+    for z, a, b, d in zip(zvalues, pre, post, distortion):
+        exact = compute_distortion(union(a), union(b), z)[2]
+        assert np.isclose(d, exact, atol=0.005)
@@ -1,4 +1,5 @@
 import io
+from multiprocessing.pool import ThreadPool
 import os
 
 import numpy
@@ -49,7 +50,9 @@ def writeImage(img, outpath, force_redo):
 
     imgio = io.BytesIO()
     img.save(imgio, format=imgfmt)
-    uri_utils.uri_writebytes(outpath, imgio.getvalue())
+    imgbytes = imgio.getvalue()
+    uri_utils.uri_writebytes(outpath, imgbytes)
+    return len(imgbytes)
     # try:
     #     os.makedirs(os.path.dirname(outpath), 0o775)
     # except OSError as e:
@@ -78,6 +81,7 @@ def mipmap_block_reduce(im, levels_file_map, block_func="mean",
     tempimg = numpy.array(im)
     target_dtype = tempimg.dtype
     lastlevel = 0
+    bytes_written = 0
     for level, outpath in levels_file_map.items():
         for i in xrange(lastlevel, level):
             tempimg = block_reduce(tempimg, (2, 2), func=reduce_func).astype(
@@ -88,7 +92,9 @@ def mipmap_block_reduce(im, levels_file_map, block_func="mean",
         #     tempimg, (2 * (level - lastlevel), 2 * (level - lastlevel)),
         #     func=reduce_func)
         lastlevel = level
-        writeImage(Image.fromarray(tempimg), outpath, force_redo)
+        bytes_written += writeImage(
+            Image.fromarray(tempimg), outpath, force_redo)
+    return bytes_written
 
 
 def mipmap_PIL(im, levels_file_map, ds_filter="NEAREST",
@@ -99,22 +105,218 @@ def mipmap_PIL(im, levels_file_map, ds_filter="NEAREST",
         raise CreateMipMapException("invalid PIL filter {}".format(e))
 
     origsize = im.size
+    bytes_written = 0
     for level, outpath in levels_file_map.items():
         newsize = tuple(map(lambda x: x//(2**level), origsize))
         dwnImage = im.resize(newsize, resample=PIL_filter)
-        writeImage(dwnImage, outpath, force_redo)
+        bytes_written += writeImage(dwnImage, outpath, force_redo)
+    return bytes_written
+
+
+def _accumulator_dtype(dtype):
+    if numpy.issubdtype(dtype, numpy.integer):
+        return numpy.int64 if dtype.itemsize > 2 else numpy.int32
+    return numpy.float64
+
+
+def reduce_mean_2x2(a, b, c, d, out, acc):
+    numpy.add(a, b, out=acc, dtype=acc.dtype)
+    acc += c
+    acc += d
+    if numpy.issubdtype(out.dtype, numpy.integer):
+        # truncate like block_reduce(...).astype(dtype)
+        acc >>= 2
+    else:
+        acc /= 4
+    out[...] = acc
+
+
+def reduce_median_2x2(a, b, c, d, out, acc):
+    # median of four values is the mean of the larger of the two pairwise
+    # minima and the smaller of the two pairwise maxima
+    lo = numpy.minimum(a, b)
+    numpy.maximum(lo, numpy.minimum(c, d, out=out), out=lo)
+    hi = numpy.maximum(a, b)
+    numpy.minimum(hi, numpy.maximum(c, d, out=out), out=hi)
+    numpy.add(lo, hi, out=acc, dtype=acc.dtype)
+    if numpy.issubdtype(out.dtype, numpy.integer):
+        acc >>= 1
+    else:
+        acc /= 2
+    out[...] = acc
+
+
+def reduce_min_2x2(a, b, c, d, out, acc):
+    numpy.minimum(a, b, out=out)
+    numpy.minimum(out, c, out=out)
+    numpy.minimum(out, d, out=out)
+
+
+pyramid_funcs = {
+    'mean': reduce_mean_2x2,
+    'median': reduce_median_2x2,
+    'min': reduce_min_2x2
+}
+
+
+def downsample_2x2(img, reduce_func, acc=None):
+    """downsample an image by 2 in each dimension, dropping a trailing
+    odd row or column
+
+    Parameters
+    ==========
+    img: numpy.ndarray
+        2D image
+    reduce_func: function
+        one of pyramid_funcs, reducing the four pixels of each 2x2
+        block into out using the scratch array acc
+    acc: numpy.ndarray
+        scratch array at least half the size of img in each dimension,
+        allocated if None
+
+    Returns
+    =======
+    numpy.ndarray
+        downsampled image of the same dtype as img
+    """
+    h, w = img.shape[0] // 2, img.shape[1] // 2
+    if acc is None:
+        acc = numpy.empty((h, w), dtype=_accumulator_dtype(img.dtype))
+    out = numpy.empty((h, w), dtype=img.dtype)
+    reduce_func(
+        img[0:2 * h:2, 0:2 * w:2], img[0:2 * h:2, 1:2 * w:2],
+        img[1:2 * h:2, 0:2 * w:2], img[1:2 * h:2, 1:2 * w:2],
+        out, acc[:h, :w])
+    return out
+
+
+def mipmap_pyramid(im, levels_file_map, block_func="mean",
+                   force_redo=True, **kwargs):
+    """derive each mipmap level from the previous one by 2x2 reduction,
+    writing level n in a background thread while computing level n+1.
+    Output sizes match mipmap_PIL (odd rows and columns are dropped).
+    """
+    try:
+        reduce_func = pyramid_funcs[block_func]
+    except KeyError as e:
+        raise CreateMipMapException(
+            "invalid pyramid function {}".format(e))
+
+    tempimg = numpy.asarray(im)
+    # scratch space sized for the first level is reused by all levels
+    acc = numpy.empty(
+        (tempimg.shape[0] // 2, tempimg.shape[1] // 2),
+        dtype=_accumulator_dtype(tempimg.dtype))
+
+    writer = ThreadPool(1)
+    try:
+        pending = []
+        for level in xrange(0, max(list(levels_file_map.keys()) + [0]) + 1):
+            if level > 0:
+                tempimg = downsample_2x2(tempimg, reduce_func, acc)
+            if level in levels_file_map:
+                pending.append(writer.apply_async(
+                    writeImage, (Image.fromarray(tempimg),
+                                 levels_file_map[level], force_redo)))
+        return sum(p.get() for p in pending)
+    finally:
+        writer.close()
+        writer.join()
 
 
 method_funcs = {
     'PIL': mipmap_PIL,
-    'block_reduce': mipmap_block_reduce
+    'block_reduce': mipmap_block_reduce,
+    'pyramid': mipmap_pyramid
 }
 
 
+def get_levels_uri_map(inputImage, outputDirectory, mipmaplevels,
+                       outputformat='tif'):
+    """uris of the mipmaps of an input image by level"""
+    inputImagepath = urllib.parse.urlparse(inputImage).path
+    return {int(level): uri_utils.uri_join(
+        outputDirectory, str(level), '{basename}.{fmt}'.format(
+            basename=os.path.basename(inputImagepath), fmt=outputformat))
+            for level in mipmaplevels}
+
+
+def get_missing_levels(inputImage, levels_uri_map, check_source=False):
+    """find mipmap levels which have to be (re)generated
+
+    Parameters
+    ==========
+    inputImage: str
+        uri of input image
+    levels_uri_map: dict
+        uri of the mipmap by level
+    check_source: boolean
+        whether to also regenerate mipmaps older than the input image
+
+    Returns
+    =======
+    list
+        sorted levels whose mipmap does not exist, is empty or
+        (with check_source) was modified before the input image
+    """
+    source_mtime = None
+    if check_source:
+        source_mtime = uri_utils.uri_stat(inputImage)[0]
+
+    missing = []
+    for level, uri in levels_uri_map.items():
+        stat = uri_utils.uri_stat(uri)
+        if ((stat is None) or (stat[1] == 0) or
+                ((source_mtime is not None) and (stat[0] < source_mtime))):
+            missing.append(level)
+    return sorted(missing)
+
+
+def mipmap_uri(inputImage, levels_uri_map, method="block_reduce",
+               convertTo8bit=True, **kwargs):
+    """read an input image and write the given mipmap levels
+
+    Parameters
+    ==========
+    inputImage: str
+        uri of input image
+    levels_uri_map: dict
+        uri of the mipmap to (over)write by level
+    method: str
+        string corresponding to downsampling method
+    convertTo8bit: boolean
+        whether to convert the image to 8 bit, dividing each value by 255
+
+    Returns
+    =======
+    tuple
+        number of bytes read and number of bytes written
+    """
+    # Need to check if the level 0 image exists
+    # TODO this is for uri implementation
+    imgbytes = uri_utils.uri_readbytes(inputImage)
+    im = Image.open(io.BytesIO(imgbytes))
+    # im = Image.open(inputImage)
+
+    # TODO: proper type checks and then convert
+    if convertTo8bit:
+        table = [i//256 for i in range(65536)]
+        im = im.convert('I')
+        im = im.point(table, 'L')
+
+    try:
+        mipmap_func = method_funcs[method]
+    except KeyError as e:
+        raise CreateMipMapException("invalid method {}".format(e))
+    bytes_written = mipmap_func(
+        im, levels_uri_map, force_redo=True, **kwargs)
+    return len(imgbytes), bytes_written
+
+
 def create_mipmaps_uri(inputImage, outputDirectory=None, method="block_reduce",
                        mipmaplevels=[1, 2, 3], outputformat='tif',
                        convertTo8bit=True, force_redo=True,
-                       **kwargs):
+                       check_source=False, **kwargs):
     """function to create downsampled images from an input image
 
     Parameters
@@ -131,6 +333,9 @@ def create_mipmaps_uri(inputImage, outputDirectory=None, method="block_reduce",
         whether to convert the image to 8 bit, dividing each value by 255
     force_redo: boolean
         whether to recreate mip map images if they already exist
+    check_source: boolean
+        if not force_redo, whether to also recreate mip map images
+        older than the input image
     method: str
         string corresponding to downsampling method
     block_func: str
@@ -148,35 +353,26 @@ def create_mipmaps_uri(inputImage, outputDirectory=None, method="block_reduce",
     MipMapException
         if an image cannot be created for some reason
     """
-    # Need to check if the level 0 image exists
-    # TODO this is for uri implementation
-    inputImagepath = urllib.parse.urlparse(inputImage).path
-    im = Image.open(io.BytesIO(uri_utils.uri_readbytes(inputImage)))
-    # im = Image.open(inputImage)
-    
-    # TODO: proper type checks and then convert
-    if convertTo8bit:
-        table = [i//256 for i in range(65536)]
-        im = im.convert('I')
-        im = im.point(table, 'L')    
-    
-    levels_uri_map = {int(level): uri_utils.uri_join(
-        outputDirectory, str(level), '{basename}.{fmt}'.format(
-            basename=os.path.basename(inputImagepath), fmt=outputformat))
-                       for level in mipmaplevels}
+    levels_uri_map = get_levels_uri_map(
+        inputImage, outputDirectory, mipmaplevels, outputformat)
     # levels_file_map = {int(level): os.path.join(
     #     outputDirectory, str(level), '{basename}.{fmt}'.format(
     #         basename=inputImage.lstrip(os.sep), fmt=outputformat))
     #                    for level in mipmaplevels}
     # levels_uri_map = levels_file_map
 
-    try:
-        method_funcs[method](
-            im, levels_uri_map, force_redo=force_redo, **kwargs)
-    except KeyError as e:
-        raise CreateMipMapException("invalid method {}".format(e))
-        
-        
+    if force_redo:
+        todo_uri_map = levels_uri_map
+    else:
+        todo_uri_map = {
+            level: levels_uri_map[level] for level in get_missing_levels(
+                inputImage, levels_uri_map, check_source=check_source)}
+        if not todo_uri_map:
+            # existing mipmaps are kept without decoding the image
+            return levels_uri_map
+
+    mipmap_uri(inputImage, todo_uri_map, method=method,
+               convertTo8bit=convertTo8bit, **kwargs)
     return levels_uri_map
 
 
@@ -1,7 +1,13 @@
+import collections
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
 import renderapi
-from six.moves import urllib
+from six.moves import queue, urllib
 from rendermodules.dataimport.create_mipmaps import (
-    create_mipmaps, create_mipmaps_uri)
+    create_mipmaps, create_mipmaps_uri, get_levels_uri_map,
+    get_missing_levels, mipmap_uri)
 from functools import partial
 from rendermodules.module.render_module import StackInputModule, RenderModuleException
 from rendermodules.dataimport.schemas import (
@@ -52,6 +58,32 @@ def create_mipmap_from_tuple_uri(mipmap_tuple, levels=[1, 2, 3],
                               force_redo=force_redo, **kwargs)
 
 
+def create_missing_mipmaps_from_tuple_uri(
+        mipmap_tuple, levels=[1, 2, 3], imgformat='tif',
+        convertTo8bit=True, force_redo=True, check_source=False,
+        **kwargs):
+    """create the mipmaps of a tile which do not exist yet
+
+    Returns
+    -------
+    tuple
+        number of mipmap levels generated, bytes read and bytes written
+    """
+    (filepath, downdir) = mipmap_tuple
+    levels_uri_map = get_levels_uri_map(filepath, downdir, levels, imgformat)
+    missing = levels
+    if not force_redo:
+        missing = get_missing_levels(
+            filepath, levels_uri_map, check_source=check_source)
+    if not missing:
+        return 0, 0, 0
+
+    bytes_read, bytes_written = mipmap_uri(
+        filepath, {level: levels_uri_map[level] for level in missing},
+        convertTo8bit=convertTo8bit, **kwargs)
+    return len(missing), bytes_read, bytes_written
+
+
 def get_filepath_from_tilespec(ts):
     mml = ts.ip[0]
 
@@ -61,30 +93,129 @@ def get_filepath_from_tilespec(ts):
     return filepath_in
 
 
-def make_tilespecs_and_cmds(render, inputStack, output_prefix, zvalues, levels,
-                            imgformat, convert_to_8bit, force_redo, pool_size,
-                            method):
-    mipmap_args = []
+def iter_mipmap_args(render, inputStack, output_prefix, zvalues,
+                     fetch_threads=4, max_queued=10000):
+    """generate mipmap arguments for the tiles of a set of sections
+
+    Sections are fetched by a producer thread keeping up to fetch_threads
+    requests in flight, feeding a queue of at most max_queued tiles.
+    """
+    tasks = queue.Queue(maxsize=max_queued)
+    done = object()
+
+    def get_tilespecs(z):
+        return render.run(
+            renderapi.tilespec.get_tile_specs_from_z, inputStack, z)
 
-    for z in zvalues:
-        tilespecs = render.run(renderapi.tilespec.get_tile_specs_from_z,
-                               inputStack, z)
+    def produce():
+        tpool = ThreadPool(fetch_threads)
+        try:
+            # rolling window: the next section is requested as soon as
+            # the oldest pending one has been queued
+            pending = collections.deque()
+            for z in zvalues:
+                if len(pending) >= fetch_threads:
+                    for ts in pending.popleft().get():
+                        tasks.put((ts.ip[0].imageUrl, output_prefix))
+                pending.append(tpool.apply_async(get_tilespecs, (z,)))
+            while pending:
+                for ts in pending.popleft().get():
+                    tasks.put((ts.ip[0].imageUrl, output_prefix))
+        except Exception as e:
+            tasks.put(e)
+        finally:
+            tpool.close()
+            tasks.put(done)
 
-        for ts in tilespecs:
-            # filepath_in = get_filepath_from_tilespec(ts)
-            # mipmap_args.append((filepath_in, output_dir))
-            mipmap_args.append((ts.ip[0].imageUrl, output_prefix))
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    while True:
+        task = tasks.get()
+        if task is done:
+            break
+        if isinstance(task, Exception):
+            raise task
+        yield task
+    producer.join()
 
+
+class MipMapProgress(object):
+    """log tile, read and write throughput of mipmap generation"""
+    def __init__(self, logger, interval=30.):
+        self.logger = logger
+        self.interval = interval
+        self.start = self.last = time.time()
+        self.tiles = self.tiles_generated = 0
+        self.bytes_read = self.bytes_written = 0
+
+    def update(self, result):
+        nlevels, bytes_read, bytes_written = result
+        self.tiles += 1
+        self.tiles_generated += (nlevels > 0)
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        if time.time() - self.last > self.interval:
+            self.report()
+
+    def report(self):
+        self.last = time.time()
+        dt = max(self.last - self.start, 1e-6)
+        self.logger.info(
+            "{} tiles ({} generated) in {:.0f} s: {:.1f} tiles/s, "
+            "read {:.1f} MB/s, written {:.1f} MB/s".format(
+                self.tiles, self.tiles_generated, dt, self.tiles / dt,
+                self.bytes_read / dt / 1e6, self.bytes_written / dt / 1e6))
+
+
+def make_tilespecs_and_cmds(render, inputStack, output_prefix, zvalues, levels,
+                            imgformat, convert_to_8bit, force_redo, pool_size,
+                            method, fetch_threads=4, progress=None, **kwargs):
     mypartial = partial(
-        create_mipmap_from_tuple_uri, method=method,
+        create_missing_mipmaps_from_tuple_uri, method=method,
         levels=list(range(1, levels + 1)),
         convertTo8bit=convert_to_8bit, force_redo=force_redo,
-        imgformat=imgformat)
+        imgformat=imgformat, **kwargs)
+
+    mipmap_args = []
+    results = []
+    # the pool's task handler consumes its input eagerly, so tasks are
+    # only handed over while fewer than max_in_flight results are pending
+    max_in_flight = 10 * pool_size
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    stopped = threading.Event()
 
+    def throttle(tasks):
+        for args in tasks:
+            in_flight.acquire()
+            if stopped.is_set():
+                return
+            mipmap_args.append(args)
+            yield args
+
+    # mipmapping starts as soon as the first section is fetched
+    tasks = iter_mipmap_args(
+        render, inputStack, output_prefix, list(zvalues),
+        fetch_threads=fetch_threads, max_queued=max_in_flight)
     with renderapi.client.WithPool(pool_size) as pool:
-        results = pool.map(mypartial, mipmap_args)
+        try:
+            for result in pool.imap_unordered(mypartial, throttle(tasks)):
+                in_flight.release()
+                results.append(result)
+                if progress is not None:
+                    progress.update(result)
+        finally:
+            # unblock the task handler so that the pool can be joined
+            # after a failed tile
+            stopped.set()
+            try:
+                in_flight.release()
+            except ValueError:
+                pass
 
-    return mipmap_args
+    if progress is not None:
+        progress.report()
+    return mipmap_args, results
 
 
 '''
@@ -118,7 +249,7 @@ class GenerateMipMaps(StackInputModule):
 
         self.logger.debug("Creating mipmaps...")
 
-        mipmap_args = make_tilespecs_and_cmds(self.render,
+        mipmap_args, generated = make_tilespecs_and_cmds(self.render,
                                               self.args['input_stack'],
                                               self.args['output_prefix'],
                                               zvalues,
@@ -127,10 +258,23 @@ class GenerateMipMaps(StackInputModule):
                                               self.args['convert_to_8bit'],
                                               self.args['force_redo'],
                                               self.args['pool_size'],
-                                              self.args['method'])
+                                              self.args['method'],
+                                              block_func=self.args['block_func'],
+                                              ds_filter=self.args['PIL_filter'],
+                                              check_source=self.args['check_source'],
+                                              fetch_threads=self.args['fetch_threads'],
+                                              progress=MipMapProgress(
+                                                  self.logger,
+                                                  self.args['progress_interval']))
+
+        tiles_generated = sum(1 for r in generated if r[0] > 0)
+        self.logger.debug("mipmaps generated for {} tiles, {} skipped".format(
+            tiles_generated, len(generated) - tiles_generated))
 
         self.output({"levels": self.args["levels"],
-                     "output_prefix": self.args["output_prefix"]})
+                     "output_prefix": self.args["output_prefix"],
+                     "tiles_generated": tiles_generated,
+                     "tiles_skipped": len(generated) - tiles_generated})
 
 
 if __name__ == "__main__":
@@ -14,6 +14,12 @@ class GenerateMipMapsOutput(DefaultSchema):
     levels = Int(required=True)
     # output_dir = Str(required=True)
     output_prefix = Str(required=True)
+    tiles_generated = Int(
+        required=False,
+        description="number of tiles for which mipmaps were generated")
+    tiles_skipped = Int(
+        required=False,
+        description="number of tiles whose mipmaps all existed")
 
 
 class GenerateMipMapsParameters(InputStackParameters):
@@ -24,11 +30,13 @@ class GenerateMipMapsParameters(InputStackParameters):
         required=True, description=("uri prefix for generated mipmaps"))
     method = mm.fields.Str(
         required=True, default="block_reduce",
-        validator=mm.validate.OneOf(["PIL", "block_reduce"]),
+        validator=mm.validate.OneOf(["PIL", "block_reduce", "pyramid"]),
         description=(
             "method to downsample mipmapLevels, "
             "'PIL' for PIL Image (currently NEAREST) filtered resize, "
-            "can be 'block_reduce' for skimage based area downsampling"))
+            "can be 'block_reduce' for skimage based area downsampling, "
+            "'pyramid' for area downsampling of each level from "
+            "the previous one"))
 # "'render' for render-ws based rendering.  "
     convert_to_8bit = mm.fields.Boolean(
         required=False, default=True,
@@ -45,21 +53,34 @@ class GenerateMipMapsParameters(InputStackParameters):
     force_redo = mm.fields.Boolean(
         required=False, default=True,
         description='force re-generation of existing mipmaps')
+    check_source = mm.fields.Boolean(
+        required=False, default=False,
+        description=('if not force_redo, also re-generate existing '
+                     'mipmaps older than their source image'))
+    fetch_threads = mm.fields.Int(
+        required=False, default=4,
+        description='number of sections whose tilespecs are fetched '
+                    'concurrently while mipmaps are generated')
+    progress_interval = mm.fields.Float(
+        required=False, default=30.,
+        description='seconds between progress and throughput reports')
     PIL_filter = Str(required=False, default='NEAREST',
                      validator=mm.validate.OneOf([
                          'NEAREST', 'BOX', 'BILINEAR',
                          'HAMMING', 'BICUBIC', 'LANCZOS']),
                      description=('filter to be used in PIL resize'))
     block_func = Str(required=False, default='mean',
-                     validator=mm.validate.OneOf(['mean', 'median']),
+                     validator=mm.validate.OneOf(['mean', 'median', 'min']),
                      description=("function to represent blocks in "
-                                  "area downsampling with block_reduce"))
+                                  "area downsampling with block_reduce "
+                                  "or pyramid"))
 
     @classmethod
     def validationOptions(cls, options):
         excluded_fields = {
             'PIL': [''],
             'block_reduce': [''],
+            'pyramid': [''],
             'render': ['']
         }
         exc_fields = excluded_fields[options['method']]
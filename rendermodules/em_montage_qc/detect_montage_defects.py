@@ -1,16 +1,16 @@
 from functools import partial
-from rtree import index as rindex
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from scipy.spatial import cKDTree
-import networkx as nx
 import numpy as np
 import renderapi
-import time
-import requests
-from six import viewkeys
+import shutil
+import tempfile
 from rendermodules.residuals import compute_residuals as cr
 from rendermodules.em_montage_qc.schemas import DetectMontageDefectsParameters, DetectMontageDefectsParametersOutput
 from rendermodules.module.render_module import RenderModule, RenderModuleException
 from rendermodules.em_montage_qc.plots import plot_section_maps
+from rendermodules.em_montage_qc.section_cache import SectionDataCache
 
 example = {
     "render":{
@@ -31,192 +31,247 @@ example = {
 }
 
 
-def detect_seams(render, stack, match_collection, match_owner, z, residual_threshold=8, distance=60, min_cluster_size=15, tspecs=None):
-    # seams will always be computed for montages using montage point matches
-    # but the input stack can be either montage, rough, or fine
-    # Compute residuals and other stats for this z
-    stats, allmatches = cr.compute_residuals_within_group(render, stack, match_owner, match_collection, z, tilespecs=tspecs)
-
+def bin_points(pts, bin_size):
+    """merge points falling in the same bin_size grid cell
+
+    Parameters
+    ----------
+    pts : numpy.ndarray
+        N x 2 array of points
+    bin_size : float
+        grid cell size
+
+    Returns
+    -------
+    centroids : numpy.ndarray
+        M x 2 mean position of the points in each occupied cell
+    counts : numpy.ndarray
+        length M number of points in each occupied cell
+    """
+    cells = np.floor(pts / bin_size).astype(np.int64)
+    _, inv, counts = np.unique(
+        cells, axis=0, return_inverse=True, return_counts=True)
+    inv = inv.ravel()
+    centroids = np.column_stack([
+        np.bincount(inv, pts[:, 0]), np.bincount(inv, pts[:, 1])])
+    return centroids / counts[:, None], counts
+
+
+def cluster_centroids(pts, distance, min_cluster_size, weights=None):
+    """centroids of clusters of points linked by neighbors within distance
+
+    Parameters
+    ----------
+    pts : numpy.ndarray
+        N x 2 array of points
+    distance : float
+        maximum distance between neighboring points of a cluster
+    min_cluster_size : float
+        clusters of total weight not above this are ignored
+    weights : numpy.ndarray
+        length N weight (number of points) of each point, default 1
+
+    Returns
+    -------
+    numpy.ndarray
+        K x 2 weighted centroids of the clusters, largest first
+    """
+    pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+    n = len(pts)
+    weights = np.ones(n) if weights is None else np.asarray(weights, dtype=float)
+    pairs = (cKDTree(pts).query_pairs(r=distance, output_type='ndarray')
+             if n > 1 else np.empty((0, 2), dtype=int))
+    if len(pairs) == 0:
+        return np.empty((0, 2))
+    graph = coo_matrix(
+        (np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    ncomp, labels = connected_components(graph, directed=False)
+    # points without neighbors do not form clusters
+    linked = np.zeros(n, dtype=bool)
+    linked[pairs.ravel()] = True
+    labels = labels[linked]
+    w = weights[linked]
+    size = np.bincount(labels, w, minlength=ncomp)
+    keep = np.flatnonzero(size > min_cluster_size)
+    keep = keep[np.argsort(-size[keep], kind='mergesort')]
+    cx = np.bincount(labels, w * pts[linked, 0], minlength=ncomp)
+    cy = np.bincount(labels, w * pts[linked, 1], minlength=ncomp)
+    return np.column_stack([cx[keep], cy[keep]]) / size[keep, None]
+
+
+def seam_centroids_from_residuals(stats, residual_threshold=8, distance=60, min_cluster_size=15, bin_size=0):
+    if not stats['tile_residuals']:
+        return []
     # get mean positions of the point matches as numpy array
     pt_match_positions = np.concatenate(list(stats['pt_match_positions'].values()), 0)
     # get the tile residuals
     tile_residuals = np.concatenate(list(stats['tile_residuals'].values()))
 
     # threshold the points based on residuals
-    new_pts = pt_match_positions[np.where(tile_residuals >= residual_threshold),:][0]
-
-    # construct a KD Tree using these points
-    tree = cKDTree(new_pts)
-    # construct a networkx graph
-    G = nx.Graph()
-    # find the pairs of points within a distance to each other
-    pairs = tree.query_pairs(r=distance)
-    G.add_edges_from(pairs)
-    # get the connected subraphs from G
-    #Gc = nx.connected_component_subgraphs(G)
-    Gc = nx.connected_components(G)
-    # get the list of nodes in each component
-    nodes = sorted(Gc, key=len, reverse=True)
-    # filter nodes list with min_cluster_size
-    fnodes = [list(nn) for nn in nodes if len(nn) > min_cluster_size]
-    # get pts list for each filtered node list
-    points_list = [new_pts[mm, :] for mm in fnodes]
-    centroids = [[np.sum(pt[:,0])/len(pt), np.sum(pt[:,1])/len(pt)] for pt in points_list]
-    return centroids, allmatches, stats
-
-
-def detect_disconnected_tiles(render, prestitched_stack, poststitched_stack,
-                              z, pre_tilespecs=None, post_tilespecs=None):
-    session = requests.session()
-    # get the tilespecs for both prestitched_stack and poststitched_stack
-
-    if pre_tilespecs is None:
-        pre_tilespecs = render.run(
-                            renderapi.tilespec.get_tile_specs_from_z,
-                            prestitched_stack,
-                            z,
-                            session=session)
-    if post_tilespecs is None:
-        post_tilespecs = render.run(
-                            renderapi.tilespec.get_tile_specs_from_z,
-                            poststitched_stack,
-                            z,
-                            session=session)
-    # pre tile_ids
-    pre_tileIds = []
-    pre_tileIds = [ts.tileId for ts in pre_tilespecs]
-    # post tile_ids
-    post_tileIds = []
-    post_tileIds = [ts.tileId for ts in post_tilespecs]
-    missing_tileIds = list(set(pre_tileIds) - set(post_tileIds))
-    session.close()
-    return missing_tileIds
-
-
-def detect_stitching_gaps(render, prestitched_stack, poststitched_stack,
-                          z, pre_tilespecs=None, tilespecs=None):
-    session = requests.session()
-    # setup an rtree to find overlapping tiles
-    pre_ridx = rindex.Index()
-    # setup a graph to store overlapping tiles
-    G1 = nx.Graph()
-    # get the tilespecs for both prestitched_stack and poststitched_stack
-    if pre_tilespecs is None:
-        pre_tilespecs = render.run(
-                            renderapi.tilespec.get_tile_specs_from_z,
-                            prestitched_stack,
-                            z,
-                            session=session)
-    if tilespecs is None:
-        tilespecs = render.run(
-                            renderapi.tilespec.get_tile_specs_from_z,
-                            poststitched_stack,
-                            z,
-                            session=session)
-    # insert the prestitched_tilespecs into rtree with their bounding boxes to find overlaps
-    for i, ts in enumerate(pre_tilespecs):
-        pre_ridx.insert(i, ts.bbox)
-
-    pre_tileIds = {}
-    for i, ts in enumerate(pre_tilespecs):
-        pre_tileIds[ts.tileId] = i
-        nodes = list(pre_ridx.intersection(ts.bbox))
-        nodes.remove(i)
-        [G1.add_edge(i, node) for node in nodes]
-    # G1 contains the prestitched_stack tile)s and the degree of each node representing
-    # the number of tiles that overlap
-    # This overlap count has to match in the poststitched_stack
-    G2 = nx.Graph()
-    post_ridx = rindex.Index()
-    tileId_to_ts = {ts.tileId: ts for ts in tilespecs}
-    shared_tileIds = viewkeys(tileId_to_ts) & viewkeys(pre_tileIds)
-    [post_ridx.insert(pre_tileIds[tId], tileId_to_ts[tId].bbox) for tId in shared_tileIds]
-    for ts in tilespecs:
-        try:
-            i = pre_tileIds[ts.tileId]
-        except KeyError:
-            continue
-        # i = pre_tileIds[ts.tileId]
-        nodes = list(post_ridx.intersection(ts.bbox))
-        nodes.remove(i)
-        [G2.add_edge(i, node) for node in nodes]
-    # Now G1 and G2 have the same index for the same tileId
-    # comparing the degree of each node pre and post stitching should reveal stitching gaps
-    #tileIds = nx.get_node_attributes(G2, 'tileId')
-    gap_tiles = []
-    for n in G2.nodes():
-        if G1.degree(n) > G2.degree(n):
-            tileId = list(pre_tileIds.keys())[list(pre_tileIds.values()).index(n)]
-            gap_tiles.append(tileId)
-    session.close()
-    return gap_tiles
-
-
-def get_pre_post_tspecs(render, prestitched_stack, poststitched_stack, z):
-    session = requests.session()
-    pre_tilespecs = render.run(
-                        renderapi.tilespec.get_tile_specs_from_z,
-                        prestitched_stack,
-                        z,
-                        session=session)
-    post_tilespecs = render.run(
-                        renderapi.tilespec.get_tile_specs_from_z,
-                        poststitched_stack,
-                        z,
-                        session=session)
-    session.close()
-    return pre_tilespecs, post_tilespecs
+    new_pts = pt_match_positions[tile_residuals >= residual_threshold, :]
+
+    # optionally merge nearby points to bound the size of large sections
+    weights = None
+    if bin_size > 0 and len(new_pts):
+        new_pts, weights = bin_points(new_pts, bin_size)
+
+    # clusters of points within a distance to each other
+    return cluster_centroids(
+        new_pts, distance, min_cluster_size, weights=weights).tolist()
+
+
+def detect_seams_from_cache(cache, stack, match_collection, match_owner, z, residual_threshold=8, distance=60, min_cluster_size=15, bin_size=0):
+    # seams will always be computed for montages using montage point matches
+    # but the input stack can be either montage, rough, or fine.
+    # tilespecs and columnar matches are read from a SectionDataCache
+    tforms = {ts.tileId: ts.tforms for ts in cache.tilespecs(stack, z)}
+    tile_residuals, tile_rmse, pt_match_positions = cr.compute_column_residuals(
+        *cache.section_match_columns(stack, z, match_collection, match_owner),
+        tforms=tforms)
+    stats = {'tile_rmse': tile_rmse,
+             'z': z,
+             'tile_residuals': tile_residuals,
+             'pt_match_positions': pt_match_positions}
+    centroids = seam_centroids_from_residuals(
+        stats, residual_threshold=residual_threshold, distance=distance,
+        min_cluster_size=min_cluster_size, bin_size=bin_size)
+    return centroids, stats
+
+
+def overlap_degrees(bboxes, max_pairs=10000000):
+    """number of other boxes overlapping each box, counting touching
+    edges as overlap, by a sort and sweep along the axis with fewer
+    candidate pairs
+
+    Parameters
+    ----------
+    bboxes : numpy.ndarray
+        N x 4 array of (minX, minY, maxX, maxY)
+    max_pairs : int
+        maximum number of candidate pairs tested at once
+
+    Returns
+    -------
+    numpy.ndarray
+        length N integer array of overlap counts
+    """
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    n = len(bboxes)
+    degree = np.zeros(n, dtype=int)
+    if n < 2:
+        return degree
+
+    # sweep along the axis with the fewest candidates
+    sweeps = []
+    for ax in (0, 1):
+        order = np.argsort(bboxes[:, ax], kind='mergesort')
+        lo = bboxes[order, ax]
+        # boxes after i in sweep order starting before box i ends
+        ncand = np.searchsorted(lo, bboxes[order, ax + 2], side='right') - \
+            np.arange(1, n + 1)
+        sweeps.append((ncand.sum(), ax, order, np.maximum(ncand, 0)))
+    total, ax, order, ncand = min(sweeps, key=lambda x: x[0])
+    other = 1 - ax
+    b = bboxes[order]
+
+    # candidate pairs in chunks of at most max_pairs
+    ends = np.cumsum(ncand)
+    start = 0
+    while start < n:
+        stop = max(start + 1, np.searchsorted(
+            ends, (ends[start - 1] if start else 0) + max_pairs, side='right'))
+        counts = ncand[start:stop]
+        i = np.repeat(np.arange(start, stop), counts)
+        # j runs over i + 1 ... i + ncand[i]
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        j = i + 1 + offsets
+        hit = ((b[j, other] <= b[i, other + 2]) &
+               (b[i, other] <= b[j, other + 2]))
+        degree += np.bincount(order[i[hit]], minlength=n)
+        degree += np.bincount(order[j[hit]], minlength=n)
+        start = stop
+    return degree
+
+
+def stitching_gap_tiles(pre_tileIds, pre_bboxes, post_tileIds, post_bboxes):
+    """tiles overlapping fewer tiles after stitching than before
+
+    Parameters
+    ----------
+    pre_tileIds : list of str
+        tileIds of the prestitched section
+    pre_bboxes : numpy.ndarray
+        N x 4 bounding boxes of the prestitched tiles
+    post_tileIds : list of str
+        tileIds of the poststitched section
+    post_bboxes : numpy.ndarray
+        M x 4 bounding boxes of the poststitched tiles
+
+    Returns
+    -------
+    list of str
+        tileIds of gap tiles
+    """
+    pre_index = {tileId: i for i, tileId in enumerate(pre_tileIds)}
+    post_index = {tileId: i for i, tileId in enumerate(post_tileIds)
+                  if tileId in pre_index}
+    shared = list(post_index.keys())
+    if not shared:
+        return []
+    pre_degree = overlap_degrees(pre_bboxes)
+    # the poststitched overlaps are counted among shared tiles only
+    post_degree = overlap_degrees(
+        np.asarray(post_bboxes)[[post_index[t] for t in shared]])
+    pre_degree = pre_degree[[pre_index[t] for t in shared]]
+    gaps = (post_degree > 0) & (pre_degree > post_degree)
+    return [t for t, gap in zip(shared, gaps) if gap]
 
 
 def run_analysis(render, prestitched_stack, poststitched_stack, match_collection,
                  match_collection_owner, residual_threshold, neighbor_distance,
-                 min_cluster_size, z):
-    pre_tspecs, post_tspecs = get_pre_post_tspecs(
-        render, prestitched_stack, poststitched_stack, z)
-    disconnected_tiles = detect_disconnected_tiles(
-        render, prestitched_stack, poststitched_stack, z, pre_tspecs,
-        post_tspecs)
-    gap_tiles = detect_stitching_gaps(
-        render, prestitched_stack, poststitched_stack, z,
-        pre_tspecs, post_tspecs)
-    seam_centroids, matches, stats = detect_seams(
-        render, poststitched_stack,  match_collection, match_collection_owner,
+                 min_cluster_size, cache, z, seam_bin_size=0):
+    # section data is read from the cache, only small summaries are returned
+    pre_tileIds, pre_bboxes = cache.tilespec_columns(prestitched_stack, z)
+    post_tileIds, post_bboxes = cache.tilespec_columns(poststitched_stack, z)
+    pre_tileIds = pre_tileIds.tolist()
+    post_tileIds = post_tileIds.tolist()
+    disconnected_tiles = list(set(pre_tileIds) - set(post_tileIds))
+    gap_tiles = stitching_gap_tiles(
+        pre_tileIds, pre_bboxes, post_tileIds, post_bboxes)
+    seam_centroids, stats = detect_seams_from_cache(
+        cache, poststitched_stack, match_collection, match_collection_owner,
         z, residual_threshold=residual_threshold, distance=neighbor_distance,
-        min_cluster_size=min_cluster_size, tspecs=post_tspecs)
+        min_cluster_size=min_cluster_size, bin_size=seam_bin_size)
+    summary = {
+        'z': z,
+        'tile_residual_mean': (
+            cr.compute_mean_tile_residuals(stats['tile_residuals'])
+            if stats['tile_residuals'] else {})}
 
-    return disconnected_tiles, gap_tiles, seam_centroids, post_tspecs, matches, stats
+    return disconnected_tiles, gap_tiles, seam_centroids, summary
 
 
-def detect_stitching_mistakes(render, prestitched_stack, poststitched_stack, match_collection, match_collection_owner, residual_threshold, neighbor_distance, min_cluster_size, zvalues, pool_size=20):
+def detect_stitching_mistakes(render, prestitched_stack, poststitched_stack, match_collection, match_collection_owner, residual_threshold, neighbor_distance, min_cluster_size, zvalues, pool_size=20, cache=None, seam_bin_size=0):
+    cache_dir = None
+    if cache is None:
+        cache_dir = tempfile.mkdtemp()
+        cache = SectionDataCache(cache_dir, render)
     mypartial0 = partial(
         run_analysis, render, prestitched_stack, poststitched_stack,
         match_collection, match_collection_owner, residual_threshold,
-        neighbor_distance, min_cluster_size)
-
-    with renderapi.client.WithPool(pool_size) as pool:
-        disconnected_tiles, gap_tiles, seam_centroids, post_tspecs, matches, stats = zip(*pool.map(
-            mypartial0, zvalues))
+        neighbor_distance, min_cluster_size, cache,
+        seam_bin_size=seam_bin_size)
+
+    try:
+        with renderapi.client.WithPool(pool_size) as pool:
+            disconnected_tiles, gap_tiles, seam_centroids, stats = zip(*pool.map(
+                mypartial0, zvalues))
+    finally:
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir)
     
-    return disconnected_tiles, gap_tiles, seam_centroids, post_tspecs, matches, stats
-
-
-def check_status_of_stack(render, stack, zvalues):
-    status = render.run(renderapi.stack.get_full_stack_metadata,
-                        stack)
-    new_stack = stack
-
-    if status['state'] == 'LOADING':
-        # clone the stack
-        new_stack = "{}_zs{}_ze{}_t{}".format(stack,
-                                           min(zvalues),
-                                           max(zvalues),
-                                           time.strftime("%m%d%y_%H%M%S"))
-        renderapi.stack.clone_stack(stack,
-                                    new_stack,
-                                    zs=zvalues,
-                                    render=render)
-
-    return status['state'], new_stack
+    return disconnected_tiles, gap_tiles, seam_centroids, stats
 
 
 class DetectMontageDefectsModule(RenderModule):
@@ -230,26 +285,29 @@ class DetectMontageDefectsModule(RenderModule):
         if len(zvalues) == 0:
             raise RenderModuleException('No valid zvalues found in stack for given range {} - {}'.format(self.args['minZ'], self.args['maxZ']))
 
-        # check if pre or post stitched stack is in LOADING state.
-        # if so, clone them to new stacks
-        status1, new_prestitched = check_status_of_stack(self.render,
-                                                self.args['prestitched_stack'],
-                                                zvalues)
-
-        status2, new_poststitched = check_status_of_stack(self.render,
-                                                 self.args['poststitched_stack'],
-                                                 zvalues)
-        disconnected_tiles, gap_tiles, seam_centroids, post_tspecs, matches, stats = detect_stitching_mistakes(
-                                                                                    self.render,
-                                                                                    new_prestitched,
-                                                                                    new_poststitched,
-                                                                                    self.args['match_collection'],
-                                                                                    self.args['match_collection_owner'],
-                                                                                    self.args['residual_threshold'],
-                                                                                    self.args['neighbors_distance'],
-                                                                                    self.args['min_cluster_size'],
-                                                                                    zvalues,
-                                                                                    pool_size=self.args['pool_size'])
+        # sections are read once into a per run cache shared by all stages.
+        # tilespecs of LOADING stacks can be read directly, so they are not cloned
+        cache_dir = tempfile.mkdtemp(dir=self.args['cache_dir'])
+        cache = SectionDataCache(cache_dir, self.render)
+        try:
+            self.run_with_cache(cache, zvalues)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def run_with_cache(self, cache, zvalues):
+        disconnected_tiles, gap_tiles, seam_centroids, stats = detect_stitching_mistakes(
+                                                                self.render,
+                                                                self.args['prestitched_stack'],
+                                                                self.args['poststitched_stack'],
+                                                                self.args['match_collection'],
+                                                                self.args['match_collection_owner'],
+                                                                self.args['residual_threshold'],
+                                                                self.args['neighbors_distance'],
+                                                                self.args['min_cluster_size'],
+                                                                zvalues,
+                                                                pool_size=self.args['pool_size'],
+                                                                cache=cache,
+                                                                seam_bin_size=self.args['seam_bin_size'])
         
         # find the indices of sections having holes
         hole_indices = [i for i, dt in enumerate(disconnected_tiles) if len(dt) > 0]
@@ -266,14 +324,17 @@ class DetectMontageDefectsModule(RenderModule):
         if self.args['plot_sections']:
             self.args['output_html'] = plot_section_maps(self.render, 
                                                          self.args['poststitched_stack'], 
-                                                         post_tspecs, 
-                                                         matches,
+                                                         None, 
+                                                         None,
                                                          disconnected_tiles, 
                                                          gap_tiles, 
                                                          seam_centroids,
                                                          stats, 
                                                          zvalues, 
-                                                         out_html_dir=self.args['out_html_dir'])
+                                                         out_html_dir=self.args['out_html_dir'],
+                                                         cache=cache,
+                                                         match_collection=self.args['match_collection'],
+                                                         match_owner=self.args['match_collection_owner'])
 
         self.output({'output_html':self.args['output_html'],
                      'qc_passed_sections': qc_passed_sections,
@@ -282,13 +343,6 @@ class DetectMontageDefectsModule(RenderModule):
                      'seam_sections':seams,
                      'seam_centroids':np.array(centroids)})
 
-        # delete the stacks that were cloned
-        if status1 == 'LOADING':
-            self.render.run(renderapi.stack.delete_stack, new_prestitched)
-
-        if status2 == 'LOADING':
-            self.render.run(renderapi.stack.delete_stack, new_poststitched)
-
 if __name__ == "__main__":
     mod = DetectMontageDefectsModule(input_data=example)
     mod.run()
@@ -25,11 +25,22 @@ except NameError:
     xrange = range
 
 
+def match_counts(matches):
+    """pIds, qIds and number of points of render match dictionaries"""
+    return ([m['pId'] for m in matches], [m['qId'] for m in matches],
+            [len(m['matches']['q'][0]) for m in matches])
+
+
 def point_match_plot(tilespecsA, matches, tilespecsB=None):
+    return point_match_count_plot(
+        tilespecsA, *match_counts(matches), tilespecsB=tilespecsB)
+
+
+def point_match_count_plot(tilespecsA, pIds, qIds, counts, tilespecsB=None):
     if tilespecsB is None:
         tilespecsB = tilespecsA
 
-    if len(matches) > 0:
+    if len(counts) > 0:
         x1, y1, id1 = cr.get_tile_centers(tilespecsA)
         x2, y2, id2 = cr.get_tile_centers(tilespecsB)
 
@@ -51,15 +62,15 @@ def point_match_plot(tilespecsA, matches, tilespecsB=None):
         else:
             clist.append(200)
 
-        for k in np.arange(len(matches)):
-            t1 = np.argwhere(id1 == matches[k]['qId']).flatten()
-            t2 = np.argwhere(id2 == matches[k]['pId']).flatten()
+        for pId, qId, count in zip(pIds, qIds, counts):
+            t1 = np.argwhere(id1 == qId).flatten()
+            t2 = np.argwhere(id2 == pId).flatten()
             if (t1.size != 0) & (t2.size != 0):
                 t1 = t1[0]
                 t2 = t2[0]
                 xs.append([x1[t1], x2[t2]])
                 ys.append([y1[t1], y2[t2]])
-                clist.append(len(matches[k]['matches']['q'][0]))
+                clist.append(int(count))
 
         mapper = LinearColorMapper(palette=Plasma256, low=min(clist), high=max(clist))
         colorbar = ColorBar(color_mapper=mapper, label_standoff=12, location=(0,0))
@@ -102,8 +113,17 @@ def plot_residual(xs, ys, residual):
 
 
 def plot_defects(render, stack, out_html_dir, args):
+    tspecs, matches, dis_tiles, gap_tiles, seam_centroids, stats, z = args
+    return plot_defects_with_counts(
+        render, stack, out_html_dir,
+        (tspecs, match_counts(matches), dis_tiles, gap_tiles,
+         seam_centroids, stats, z))
+
+
+def plot_defects_with_counts(render, stack, out_html_dir, args):
+    # as plot_defects, with matches given as (pIds, qIds, counts)
     tspecs = args[0]
-    matches = args[1]
+    pIds, qIds, counts = args[1]
     dis_tiles = args[2]
     gap_tiles = args[3]
     seam_centroids = np.array(args[4])
@@ -111,7 +131,10 @@ def plot_defects(render, stack, out_html_dir, args):
     z = args[6]
 
     # Tile residual mean
-    tile_residual_mean = cr.compute_mean_tile_residuals(stats['tile_residuals'])
+    if 'tile_residual_mean' in stats:
+        tile_residual_mean = stats['tile_residual_mean']
+    else:
+        tile_residual_mean = cr.compute_mean_tile_residuals(stats['tile_residuals'])
 
     tile_positions = []
     tile_ids = []
@@ -209,7 +232,7 @@ def plot_defects(render, stack, out_html_dir, args):
     source.callback = CustomJS(args=dict(div=div), code=jscode%('names'))
 
     # add point match plot in another tab
-    plot = point_match_plot(tspecs, matches)
+    plot = point_match_count_plot(tspecs, pIds, qIds, counts)
 
     # montage statistics plots in other tabs
 
@@ -227,13 +250,28 @@ def plot_defects(render, stack, out_html_dir, args):
     return out_html
 
 
-def plot_section_maps(render, stack, post_tspecs, matches, disconnected_tiles, gap_tiles, seam_centroids, stats, zvalues, out_html_dir=None, pool_size=5):
+def plot_cached_defects(cache, match_collection, match_owner, render, stack, out_html_dir, args):
+    # read the section tilespecs and match point counts from a
+    # SectionDataCache rather than receiving them from the parent process
+    dis_tiles, gap_tiles, seam_centroids, stats, z = args
+    tspecs = cache.tilespecs(stack, z)
+    counts = cache.section_match_counts(stack, z, match_collection, match_owner)
+    return plot_defects_with_counts(
+        render, stack, out_html_dir,
+        (tspecs, counts, dis_tiles, gap_tiles, seam_centroids, stats, z))
+
+
+def plot_section_maps(render, stack, post_tspecs, matches, disconnected_tiles, gap_tiles, seam_centroids, stats, zvalues, out_html_dir=None, pool_size=5, cache=None, match_collection=None, match_owner=None):
     if out_html_dir is None:
         out_html_dir = tempfile.mkdtemp()
 
-    mypartial = partial(plot_defects, render, stack, out_html_dir)
-
-    args = zip(post_tspecs, matches, disconnected_tiles, gap_tiles, seam_centroids, stats, zvalues)
+    if cache is None:
+        mypartial = partial(plot_defects, render, stack, out_html_dir)
+        args = zip(post_tspecs, matches, disconnected_tiles, gap_tiles, seam_centroids, stats, zvalues)
+    else:
+        mypartial = partial(plot_cached_defects, cache, match_collection,
+                            match_owner, render, stack, out_html_dir)
+        args = zip(disconnected_tiles, gap_tiles, seam_centroids, stats, zvalues)
 
     with renderapi.client.WithPool(pool_size) as pool:
         html_files = pool.map(mypartial, args)
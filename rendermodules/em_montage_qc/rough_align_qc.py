@@ -1,6 +1,7 @@
 
 import renderapi
 import numpy as np
+import cv2
 from math import pi
 from shapely.geometry import Polygon
 from shapely.ops import cascaded_union
@@ -48,18 +49,175 @@ example = {
 
 
 
-def get_poly(stack, render, z):
+def get_tile_outlines(stack, render, z):
+    """transformed outline of each tile of a section
+
+    Returns
+    -------
+    numpy.ndarray
+        ntiles x npts x 2 float32 array of tile outlines
+    """
     s = requests.Session()
     s.mount('http://', requests.adapters.HTTPAdapter(max_retries=5))
     z = float(z) / 1.0
     rts = renderapi.resolvedtiles.get_resolved_tiles_from_z(stack, z, render=render, session=s)
-    outpolys = []
-    for tile in rts.tilespecs:
-        bbox = tile.bbox_transformed(ndiv_inner=2, reference_tforms=rts.transforms)
-        outpolys.append(Polygon(bbox))
+    outlines = [tile.bbox_transformed(ndiv_inner=2, reference_tforms=rts.transforms)
+                for tile in rts.tilespecs]
+    return np.array(outlines, dtype=np.float32).reshape(len(outlines), -1, 2)
+
+
+def get_poly(stack, render, z):
+    outpolys = [Polygon(bbox) for bbox in get_tile_outlines(stack, render, z)]
     return cascaded_union(outpolys)
 
 
+def section_footprint(render, engine, job):
+    """exact union polygon ('polygon' engine) or tile outlines to be
+    rasterized ('raster' engine) of the section z of stack in job"""
+    stack, z = job
+    if engine == 'polygon':
+        return get_poly(stack, render, z)
+    return get_tile_outlines(stack, render, z)
+
+
+def raster_grid(outlines, raster_size):
+    """grid covering the tile outlines of a few sections
+
+    Parameters
+    ----------
+    outlines : list of numpy.ndarray
+        ntiles x npts x 2 tile outlines of each section
+    raster_size : int
+        number of grid cells along the longest side
+
+    Returns
+    -------
+    origin : numpy.ndarray
+        world coordinates of the grid origin
+    cell : float
+        grid cell size
+    shape : tuple
+        (rows, columns) of the grid
+    """
+    pts = [o.reshape(-1, 2) for o in outlines if o.size]
+    if not pts:
+        return np.zeros(2), 1., (1, 1)
+    mins = np.min([p.min(axis=0) for p in pts], axis=0).astype(float)
+    maxs = np.max([p.max(axis=0) for p in pts], axis=0).astype(float)
+    cell = max(np.max(maxs - mins) / raster_size, np.finfo(float).eps)
+    ncells = np.ceil((maxs - mins) / cell).astype(int) + 1
+    return mins, cell, (ncells[1], ncells[0])
+
+
+def rasterize_outlines(outlines, origin, cell, shape):
+    """occupancy mask of the union of tile outlines"""
+    mask = np.zeros(shape, dtype=np.uint8)
+    pts = np.round((outlines - origin) / cell).astype(np.int32)
+    # fill tiles one at a time, fillPoly treats a list of polygons as one
+    # polygon and would leave tile overlaps unfilled
+    for tile in pts:
+        cv2.fillPoly(mask, [tile], 1)
+    return mask.astype(bool)
+
+
+def mask_to_polygons(mask, origin, cell):
+    """outer boundary polygons of an occupancy mask in world coordinates"""
+    contours = cv2.findContours(
+        mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    return [Polygon(c.reshape(-1, 2) * cell + origin)
+            for c in contours if len(c) >= 3]
+
+
+def raster_area(outlines, raster_size):
+    """area of the union of tile outlines on a grid covering them"""
+    origin, cell, shape = raster_grid([outlines], raster_size)
+    mask = rasterize_outlines(outlines, origin, cell, shape)
+    return np.count_nonzero(mask) * cell ** 2
+
+
+def raster_intersection_area(outlines1, outlines2, raster_size):
+    """area of the intersection of the unions of two sets of tile outlines
+    on a grid covering the overlap of their bounding boxes"""
+    pts1 = outlines1.reshape(-1, 2)
+    pts2 = outlines2.reshape(-1, 2)
+    if not (len(pts1) and len(pts2)):
+        return 0.
+    mins = np.maximum(pts1.min(axis=0), pts2.min(axis=0))
+    maxs = np.minimum(pts1.max(axis=0), pts2.max(axis=0))
+    if np.any(maxs <= mins):
+        return 0.
+    origin, cell, shape = raster_grid([np.array([mins, maxs])], raster_size)
+    mask = rasterize_outlines(outlines1, origin, cell, shape)
+    mask &= rasterize_outlines(outlines2, origin, cell, shape)
+    return np.count_nonzero(mask) * cell ** 2
+
+
+def compute_raster_metrics(pre_outlines, post_outlines, zvalues, raster_size=2048):
+    """IoU of adjacent post sections and pre/post distortion computed on
+    occupancy grids local to each footprint and to the overlap of each
+    pair of footprints, so that the resolution does not depend on the
+    spread between sections
+
+    Parameters
+    ----------
+    pre_outlines : list of numpy.ndarray
+        tile outlines (see get_tile_outlines) before alignment for each z
+    post_outlines : list of numpy.ndarray
+        tile outlines after alignment for each z
+    zvalues : list
+        sorted z values
+    raster_size : int
+        number of grid cells along the longest side of each grid
+
+    Returns
+    -------
+    ious : numpy.ndarray
+        as returned by compute_ious
+    distortion : list of float
+        as returned by compute_distortion for each z
+    pre_polys, post_polys, dio, doi : list
+        lists of footprint and difference polygons of each z for plotting
+    """
+    diff = [(y+x)//2 for x, y in zip(zvalues, zvalues[1:]) if abs(x-y) > 1]
+    ious = np.zeros((len(zvalues)+len(diff), 3))
+    distortion = []
+    pre_polys = []
+    post_polys = []
+    dio = []
+    doi = []
+
+    prev_z = None
+    for z, pre_o, post_o in zip(zvalues, pre_outlines, post_outlines):
+        pre_area = raster_area(pre_o, raster_size)
+        post_area = raster_area(post_o, raster_size)
+
+        if prev_z is not None and abs(z - prev_z) == 1:
+            inter = raster_intersection_area(prev_o, post_o, raster_size)
+            union = prev_area + post_area - inter
+            iou = inter / union if union else 0
+            ious[int(prev_z-min(zvalues)), int(z-prev_z+1)] = iou
+            ious[int(z-min(zvalues)), int(prev_z-z+1)] = iou
+        prev_z, prev_o, prev_area = z, post_o, post_area
+
+        inter = raster_intersection_area(pre_o, post_o, raster_size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distortion.append(np.round(
+                (pre_area + post_area - 2 * inter) / np.float64(pre_area), 5))
+
+        # difference polygons for plotting on a grid covering both
+        origin, cell, shape = raster_grid([pre_o, post_o], raster_size)
+        pre = rasterize_outlines(pre_o, origin, cell, shape)
+        post = rasterize_outlines(post_o, origin, cell, shape)
+        di = pre & ~post
+        do = post & ~pre
+        pre_polys.append(mask_to_polygons(pre, origin, cell))
+        post_polys.append(mask_to_polygons(post, origin, cell))
+        dio.append(mask_to_polygons(di, origin, cell))
+        doi.append(mask_to_polygons(do, origin, cell))
+
+    return ious, distortion, pre_polys, post_polys, dio, doi
+
+
 def plot_poly(axis, p, face, edge, alpha):
     (x1, xh) = axis.get_xlim()
     (y1, yh) = axis.get_ylim()
@@ -99,7 +257,7 @@ def plot_bokeh_poly(p):
         yy = np.array([y[1] for y in coords])
         xs.append(xx)
         ys.append(yy)
-        nc.append(colors[i])
+        nc.append(colors[i % len(colors)])
 
     source = ColumnDataSource(data=dict(xs=xs, ys=ys))
 
@@ -402,40 +560,45 @@ class RoughAlignmentQC(RenderModule):
         if len(zvalues) == 0:
             raise RenderModuleException('No valid zvalues found in stack for given range {} - {}'.format(self.args['minZ'], self.args['maxZ']))
 
-        # get the boundary polygon for each section
-        mypartial1 = partial(get_poly, self.args['output_downsampled_stack'], self.render)
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
-            boundary_polygons = pool.map(mypartial1, zvalues)
-
-        post_polys = {}
-        for poly, z in zip(boundary_polygons, zvalues):
-            post_polys[z] = poly
-
-        mypartial2 = partial(get_poly, self.args['input_downsampled_stack'], self.render)
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
-            pre_boundary_polygons = pool.map(mypartial2, zvalues)
-
-        pre_polys = {}
-        for poly, z in zip(pre_boundary_polygons, zvalues):
-            pre_polys[z] = poly
-
         if self.args['output_dir'] is None:
             self.args['output_dir'] = tempfile.mkdtemp()
 
-        # compute ious
-        ious = compute_ious(post_polys, zvalues)
-        #iou_plot = plot_ious(ious, zrange, self.args['output_dir'])
-
-        # compute distortion
-        distortion = []
-        dio = []
-        doi = []
-
-        for i, z in enumerate(zvalues):
-            di, do, dist = compute_distortion(pre_boundary_polygons[i], boundary_polygons[i], z)
-            dio.append(di)
-            doi.append(do)
-            distortion.append(dist)
+        # get the footprint of each section of both stacks in one job
+        engine = self.args['footprint_engine']
+        stacks = [self.args['output_downsampled_stack'],
+                  self.args['input_downsampled_stack']]
+        mypartial = partial(section_footprint, self.render, engine)
+        with renderapi.client.WithPool(self.args['pool_size']) as pool:
+            footprints = pool.map(
+                mypartial, [(stack, z) for stack in stacks for z in zvalues])
+        boundary_polygons = footprints[:len(zvalues)]
+        pre_boundary_polygons = footprints[len(zvalues):]
+
+        if engine == 'raster':
+            # ious and distortion on occupancy grids
+            (ious, distortion, pre_boundary_polygons, boundary_polygons,
+             dio, doi) = compute_raster_metrics(
+                pre_boundary_polygons, boundary_polygons, zvalues,
+                raster_size=self.args['raster_size'])
+        else:
+            post_polys = {}
+            for poly, z in zip(boundary_polygons, zvalues):
+                post_polys[z] = poly
+
+            # compute ious
+            ious = compute_ious(post_polys, zvalues)
+            #iou_plot = plot_ious(ious, zrange, self.args['output_dir'])
+
+            # compute distortion
+            distortion = []
+            dio = []
+            doi = []
+
+            for i, z in enumerate(zvalues):
+                di, do, dist = compute_distortion(pre_boundary_polygons[i], boundary_polygons[i], z)
+                dio.append(di)
+                doi.append(do)
+                distortion.append(dist)
 
         dist_plt_name = None
         iou_plt_name = None
@@ -3,7 +3,7 @@ import marshmallow as mm
 from marshmallow import post_load
 from ..module.schemas import (RenderParameters, ZValueParameters,
                               ProcessPoolParameters)
-from argschema.fields import Bool, Int, Str, InputDir, OutputFile, OutputDir
+from argschema.fields import Bool, Float, Int, Str, InputDir, OutputFile, OutputDir
 
 
 class DetectMontageDefectsParameters(
@@ -37,6 +37,12 @@ class DetectMontageDefectsParameters(
         default=12,
         missing=12,
         description='minimum number of point matches required in each cluster for taking it into account for seam detection (default = 7)')
+    seam_bin_size = Float(
+        required=False,
+        default=0,
+        missing=0,
+        description='grid size in pixels for merging high residual points before seam clustering '
+                    'on very large sections, 0 to cluster every point (default = 0)')
     plot_sections = Bool(
         required=False,
         default=True,
@@ -47,6 +53,13 @@ class DetectMontageDefectsParameters(
         default=None,
         missing=None,
         description="Folder to save the Bokeh plot defaults to /tmp directory")
+    cache_dir = Str(
+        required=False,
+        default=None,
+        missing=None,
+        description="Parent directory of the per run section tilespec and "
+                    "point match cache shared by all stages, which is removed "
+                    "after the run. Defaults to the system temporary directory")
 
     @post_load
     def add_match_collection_owner(self, data):
@@ -111,6 +124,19 @@ class RoughQCSchema(RenderParameters):
         required=False,
         default="pdf",
         description="Do you want the output to be bokeh plots in html (option = 'html') or pdf files for plots (option = 'pdf', default)")
+    footprint_engine = Str(
+        validator=mm.validate.OneOf(['raster', 'polygon']),
+        required=False,
+        default="polygon",
+        missing="polygon",
+        description="Compute section footprints, IoU and distortion from exact polygon unions (option = 'polygon', default) "
+                    "or on occupancy grids (option = 'raster', faster, approximate)")
+    raster_size = Int(
+        required=False,
+        default=2048,
+        missing=2048,
+        description="Number of grid cells along the longest side of each section or pair of adjacent sections "
+                    "for the raster footprint engine")
     
 
 class RoughQCOutputSchema(argschema.schemas.DefaultSchema):
@@ -0,0 +1,171 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import renderapi
+from six.moves import urllib
+
+from rendermodules.residuals import compute_residuals as cr
+
+
+class SectionDataCache(object):
+    """on-disk columnar store of section tilespecs and point matches
+
+    Section data is fetched from render once, stored under cache_dir
+    keyed by (stack, z) and (owner, collection, groupId), and read back
+    with numeric columns memory mapped.  Instances only hold the cache
+    directory and render connection, so they are cheap to pass to
+    worker processes, which then read the sections from disk.
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory of the cache, created if it does not exist
+    render : renderapi.render.RenderClient
+        render connection used to fill the cache
+    """
+    def __init__(self, cache_dir, render):
+        self.cache_dir = cache_dir
+        self.render = render
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _path(self, *keys):
+        return os.path.join(self.cache_dir, *[
+            urllib.parse.quote(str(k), safe='') for k in keys])
+
+    @staticmethod
+    def _store(path, arrays, tilespecs=None):
+        # write to a temporary directory and rename, so that concurrent
+        # readers only ever see complete entries
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        tmp = tempfile.mkdtemp(dir=parent)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), arr)
+        if tilespecs is not None:
+            with open(os.path.join(tmp, 'tilespecs.json'), 'w') as f:
+                json.dump([ts.to_dict() for ts in tilespecs], f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # stored by another process in the meantime
+            shutil.rmtree(tmp)
+            if not os.path.isdir(path):
+                raise
+
+    @staticmethod
+    def _load(path, name, mmap_mode='r'):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+    def _tilespec_path(self, stack, z):
+        path = self._path('tilespecs', stack, float(z))
+        if not os.path.isdir(path):
+            tilespecs = renderapi.tilespec.get_tile_specs_from_z(
+                stack, z, render=self.render)
+            bboxes = np.array([ts.bbox for ts in tilespecs],
+                              dtype=float).reshape(-1, 4)
+            self._store(path, {
+                'tileIds': np.array([ts.tileId for ts in tilespecs],
+                                    dtype=np.str_),
+                'sectionIds': np.array(
+                    [str(getattr(ts.layout, 'sectionId', None))
+                     for ts in tilespecs], dtype=np.str_),
+                'bboxes': bboxes}, tilespecs=tilespecs)
+        return path
+
+    def tilespec_columns(self, stack, z):
+        """tileIds and memory mapped N x 4 bounding boxes of a section
+
+        Returns
+        -------
+        tileIds : numpy.ndarray
+            str array of tileIds
+        bboxes : numpy.ndarray
+            N x 4 array of (minX, minY, maxX, maxY)
+        """
+        path = self._tilespec_path(stack, z)
+        return (self._load(path, 'tileIds', mmap_mode=None),
+                self._load(path, 'bboxes'))
+
+    def tilespecs(self, stack, z):
+        """list of renderapi.tilespec.TileSpec of a section"""
+        path = self._tilespec_path(stack, z)
+        with open(os.path.join(path, 'tilespecs.json'), 'r') as f:
+            tilespecs = [renderapi.tilespec.TileSpec(json=d)
+                         for d in json.load(f)]
+        # TileSpec.to_dict does not serialize the bounding box
+        for ts, bbox in zip(tilespecs, self._load(path, 'bboxes')):
+            ts.minX, ts.minY, ts.maxX, ts.maxY = [float(b) for b in bbox]
+        return tilespecs
+
+    def section_groupIds(self, stack, z):
+        """point match groupIds (sectionIds) of the tiles of a section"""
+        sectionIds = np.unique(self._load(
+            self._tilespec_path(stack, z), 'sectionIds', mmap_mode=None))
+        if 'None' in sectionIds:
+            return [self.render.run(
+                renderapi.stack.get_sectionId_for_z, stack, z)]
+        return list(sectionIds)
+
+    def _match_path(self, collection, groupId, owner=None):
+        owner = self.render.DEFAULT_OWNER if owner is None else owner
+        path = self._path('matches', owner, collection, groupId)
+        if not os.path.isdir(path):
+            allmatches = renderapi.pointmatch.get_matches_within_group(
+                collection, groupId, owner=owner, render=self.render)
+            pIds, qIds, counts, p, q = cr.match_columns(allmatches)
+            self._store(path, {
+                'pIds': pIds.astype(np.str_), 'qIds': qIds.astype(np.str_),
+                'counts': counts, 'p': p, 'q': q})
+        return path
+
+    def match_columns(self, collection, groupId, owner=None):
+        """columnar point matches within a group
+
+        Returns
+        -------
+        pIds : numpy.ndarray
+            str array of the p tileId of each match
+        qIds : numpy.ndarray
+            str array of the q tileId of each match
+        counts : numpy.ndarray
+            number of points in each match
+        p : numpy.ndarray
+            memory mapped sum(counts) x 2 array of p points in match order
+        q : numpy.ndarray
+            memory mapped sum(counts) x 2 array of q points in match order
+        """
+        path = self._match_path(collection, groupId, owner)
+        return (self._load(path, 'pIds', mmap_mode=None),
+                self._load(path, 'qIds', mmap_mode=None),
+                self._load(path, 'counts', mmap_mode=None),
+                self._load(path, 'p'),
+                self._load(path, 'q'))
+
+    def section_match_columns(self, stack, z, collection, owner=None):
+        """match_columns of all groups of a section"""
+        cols = [self.match_columns(collection, groupId, owner)
+                for groupId in self.section_groupIds(stack, z)]
+        if len(cols) == 1:
+            return cols[0]
+        return tuple(np.concatenate(c) for c in zip(*cols))
+
+    def section_match_counts(self, stack, z, collection, owner=None):
+        """pIds, qIds and number of points of the matches of a section,
+        without reading the points"""
+        cols = []
+        for groupId in self.section_groupIds(stack, z):
+            path = self._match_path(collection, groupId, owner)
+            cols.append(tuple(self._load(path, name, mmap_mode=None)
+                              for name in ('pIds', 'qIds', 'counts')))
+        if len(cols) == 1:
+            return cols[0]
+        return tuple(np.concatenate(c) for c in zip(*cols))
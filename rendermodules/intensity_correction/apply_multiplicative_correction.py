@@ -1,6 +1,10 @@
 if __name__ == "__main__" and __package__ is None:
     __package__ = "rendermodules.intensity_correction.apply_muliplicative_correction"
+from multiprocessing.pool import ThreadPool
 import os
+import shutil
+import tempfile
+import threading
 import renderapi
 from functools import partial
 import numpy as np
@@ -29,6 +33,54 @@ example_input = {
 }
 
 
+def correction_factor(ff):
+    """compute the multiplicative correction factor of a flatfield
+    fac = max(ff) / (ff + .0001)
+
+    Parameters
+    ==========
+    ff: numpy.array
+        N,M array of flatfield correction, could be of any type
+
+    Returns
+    =======
+    numpy.array
+        N,M float32 array of correction factors
+    """
+    fac = ff.astype(np.float32)
+    fac += np.float32(0.0001)
+    np.divide(np.float32(np.amax(ff)), fac, out=fac)
+    return fac
+
+
+def apply_correction_factor(img, fac, clip, scale_factor, clip_min, clip_max):
+    """correct an image with a precomputed correction factor
+    (see correction_factor), preserving the mean intensity of img
+
+    Parameters
+    ==========
+    img: numpy.array
+        N,M array to correct, could be any type
+    fac: numpy.array
+        N,M float32 array of correction factors
+
+    Returns
+    =======
+    numpy.array
+        N,M  numpy array of the same type as img but now corrected
+    """
+    result = img.astype(np.float32)
+    mean_in = result.mean(dtype=np.float64)
+    result *= fac
+    # mean normalization and scaling in a single pass
+    result *= np.float32(
+        mean_in / result.mean(dtype=np.float64) / scale_factor)
+    if (clip):
+        np.clip(result, clip_min, clip_max, out=result)
+    # convert back to original type
+    return result.astype(img.dtype)
+
+
 def intensity_corr(img, ff,clip,scale_factor,clip_min,clip_max):
     """utility function to correct an image with a flatfield correction
     will take img and return
@@ -47,20 +99,31 @@ def intensity_corr(img, ff,clip,scale_factor,clip_min,clip_max):
     numpy.array
         N,M  numpy array of the same type as img but now corrected
     """
-    img_type = img.dtype
-    img = img.astype(float)
-    ff = ff.astype(float)
-    num = np.ones((ff.shape[0], ff.shape[1]))
-    fac = np.divide(num * np.amax(ff), ff + 0.0001)
-    result = np.multiply(img, fac)
-    result = np.multiply(result, np.mean(img) / np.mean(result))
-    # add clipping or scaling
-    result = result/scale_factor
-    if (clip):
-        np.clip(result, clip_min, clip_max, out=result)
-    # convert back to original type
-    result_int = result.astype(img_type)
-    return result_int
+    return apply_correction_factor(
+        img, correction_factor(ff), clip, scale_factor, clip_min, clip_max)
+
+
+_factor_cache = {}
+
+
+def save_correction_factor(ff, outfile):
+    """save the correction factor of flatfield ff as .npy so
+    that workers can memory map it rather than receive a copy"""
+    np.save(outfile, correction_factor(ff))
+    return outfile
+
+
+def get_correction_factor(C):
+    """correction factor for C, which is either a flatfield array or
+    the path of a factor saved by save_correction_factor.
+    Saved factors are memory mapped once per process."""
+    if isinstance(C, np.ndarray):
+        return correction_factor(C)
+    try:
+        return _factor_cache[C]
+    except KeyError:
+        fac = _factor_cache[C] = np.load(C, mmap_mode='r')
+        return fac
 
 
 def getImage(ts, channel=None):
@@ -104,14 +167,23 @@ def write_image(dirout, orig_imageurl, Res, stackname, z):
     tifffile.imsave(outImage, Res)
     return outImage
 
+_worker_writer = {}
+
+
+def init_writer():
+    """pool initializer starting one background image writer per worker"""
+    _worker_writer['writer'] = ThreadPool(1)
+
+
 def process_tile(C, dirout, stackname, clip, scale_factor, clip_min, clip_max, input_ts, corr_dict=None):
     """function to correct each tile in the input_ts with the matrix C,
     and potentially move the original tiles to a new location.abs
 
     Parameters
     ==========
-    C: numpy.array
-        a 2d numpy array of uint16 or uint8 that represents the correction to apply
+    C: numpy.array or str
+        a 2d numpy array of uint16 or uint8 that represents the correction to apply,
+        or the path of its correction factor saved with save_correction_factor
     corr_dict: dict or None
         a dictionary with keys of strings of channel names and values of corrections (as with C).
         If None, C will be applied to each channel, if they exist.
@@ -120,84 +192,186 @@ def process_tile(C, dirout, stackname, clip, scale_factor, clip_min, clip_max, i
     input_ts: renderapi.tilespec.TileSpec
         the tilespec with the tiles to be corrected
     """
-    [N1, M1, I] = getImage(input_ts)
-    Res = intensity_corr(I, C, clip, scale_factor, clip_min, clip_max)
-    outImage = write_image(dirout, input_ts.ip[0].imageUrl, Res, stackname, input_ts.z)
-    
-    output_ts = input_ts
-    mm = renderapi.image_pyramid.MipMap(imageUrl=outImage)
+    # writes run in the background while the next channel is read and corrected
+    writer = _worker_writer.get('writer')
+    own_writer = writer is None
+    if own_writer:
+        writer = ThreadPool(1)
+    try:
+        [N1, M1, I] = getImage(input_ts)
+        Res = apply_correction_factor(
+            I, get_correction_factor(C), clip, scale_factor, clip_min, clip_max)
+        writes = [writer.apply_async(
+            write_image, (dirout, input_ts.ip[0].imageUrl, Res, stackname, input_ts.z))]
+        
+        output_ts = input_ts
+        if output_ts.channels is not None:
+            for chan in output_ts.channels:
+                [N1, M1, I] = getImage(output_ts, chan.name)
+                if corr_dict:
+                    CC = corr_dict[chan.name]
+                else:
+                    CC = C
+                CRes = apply_correction_factor(
+                    I, get_correction_factor(CC), clip, scale_factor, clip_min, clip_max)
+                writes.append(writer.apply_async(
+                    write_image, (dirout, chan.ip[0].imageUrl, CRes, stackname, input_ts.z)))
+        outImages = [w.get() for w in writes]
+    finally:
+        if own_writer:
+            writer.close()
+            writer.join()
+
+    mm = renderapi.image_pyramid.MipMap(imageUrl=outImages[0])
     output_ts.ip = renderapi.image_pyramid.ImagePyramid()
     output_ts.ip[0] = mm
 
     if output_ts.channels is not None:
-        for chan in output_ts.channels:
-            [N1, M1, I] = getImage(output_ts, chan.name)
-            if corr_dict:
-                CC = corr_dict[chan.name]
-            else:
-                CC = C
-            CRes = intensity_corr(I, CC, clip, scale_factor, clip_min, clip_max)
-            chan_outImage = write_image(dirout, chan.ip[0].imageUrl, CRes, stackname, input_ts.z)
+        for chan, chan_outImage in zip(output_ts.channels, outImages[1:]):
             mm = renderapi.image_pyramid.MipMap(imageUrl = chan_outImage)
             chan.ip = renderapi.image_pyramid.ImagePyramid()
             chan.ip[0]=mm
 
     return output_ts
 
+def process_tile_task(dirout, stackname, clip, scale_factor, clip_min, clip_max, task):
+    """process_tile for a task tuple (C, corr_dict, input_ts)"""
+    C, corr_dict, input_ts = task
+    return process_tile(C, dirout, stackname, clip, scale_factor, clip_min, clip_max,
+                        input_ts, corr_dict=corr_dict)
+
+
+def iter_z_tilespecs(render, stack, zValues, nthreads=4):
+    """fetch tilespecs of each z concurrently
+
+    Parameters
+    ==========
+    render: renderapi.render.RenderClient
+        render connection
+    stack: str
+        stack to get tilespecs from
+    zValues: list of float
+        z values to fetch
+    nthreads: int
+        number of concurrent requests
+
+    Returns
+    =======
+    generator
+        (z, list of renderapi.tilespec.TileSpec) in the order of zValues
+    """
+    tpool = ThreadPool(nthreads)
+    try:
+        for z, tilespecs in zip(zValues, tpool.imap(
+                lambda z: renderapi.tilespec.get_tile_specs_from_z(
+                    stack, z, render=render), zValues)):
+            yield z, tilespecs
+    finally:
+        tpool.close()
+        tpool.join()
+
+
 class MultIntensityCorr(StackTransitionModule):
     default_schema = MultIntensityCorrParams
 
-    def run(self):
-        # get tilespecs
-        # Z = self.args['z_index']
-        Z = self.zValues[0]
-        inp_tilespecs = renderapi.tilespec.get_tile_specs_from_z(
-            self.args['input_stack'], Z, render=self.render)
-        corr_tilespecs = renderapi.tilespec.get_tile_specs_from_z(
-            self.args['correction_stack'], Z, render=self.render)
-        # mult intensity correct each tilespecs and return tilespecs
-        corr_ts = corr_tilespecs[0]
-
-        N, M, C = getImage(corr_ts)
+    def correction_factors(self, corr_ts, factor_dir, factor_files):
+        """saved correction factors for the default image and channels of
+        corr_ts, computed once per correction image url"""
+        def factor_file(url, chan=None):
+            if url not in factor_files:
+                N, M, C = getImage(corr_ts, chan)
+                factor_files[url] = save_correction_factor(
+                    C, os.path.join(factor_dir, 'C_{}.npy'.format(len(factor_files))))
+            return factor_files[url]
 
+        C = factor_file(corr_ts.ip[0].imageUrl)
         # construct a dictionary with the correction factors
         corr_dict = {}
         if corr_ts.channels is not None:
             for chan in corr_ts.channels:
-                Nc, Mc, CC = getImage(corr_ts, chan.name)
-                corr_dict[chan.name] = CC
-        
-        outdir = self.args['output_directory']
+                corr_dict[chan.name] = factor_file(chan.ip[0].imageUrl, chan.name)
+        return C, corr_dict
+
+    def run(self):
+        zValues = sorted(self.zValues)
+
+        renderapi.stack.create_stack(
+            self.args['output_stack'], cycleNumber=self.args['cycle_number'],
+            cycleStepNumber=self.args['cycle_step_number'], render=self.render)
+        if self.args['overwrite_zlayer']:
+            self.delete_zValues(zValues=zValues)
+
+        # correction factors are computed once per correction image
+        # and memory mapped by workers
+        factor_dir = tempfile.mkdtemp(dir=self.args['output_directory'])
+        factor_files = {}
+
+        # the pool's task handler consumes tile_tasks eagerly, so it may
+        # only run ahead of the finished tiles by max_in_flight tasks
+        max_in_flight = 4 * self.args['pool_size']
+        in_flight = threading.BoundedSemaphore(max_in_flight)
+        stopped = threading.Event()
+
+        def tile_tasks():
+            # get tilespecs
+            for (z, inp_tilespecs), (cz, corr_tilespecs) in zip(
+                    iter_z_tilespecs(self.render, self.args['input_stack'], zValues,
+                                     self.args['fetch_threads']),
+                    iter_z_tilespecs(self.render, self.args['correction_stack'], zValues,
+                                     self.args['fetch_threads'])):
+                self.logger.debug('correcting {} tiles at z={}'.format(
+                    len(inp_tilespecs), z))
+                C, corr_dict = self.correction_factors(
+                    corr_tilespecs[0], factor_dir, factor_files)
+                for ts in inp_tilespecs:
+                    in_flight.acquire()
+                    if stopped.is_set():
+                        return
+                    yield C, corr_dict, ts
 
         mypartial = partial(
-            process_tile,
-            C,
+            process_tile_task,
             self.args['output_directory'],
             self.args['output_stack'],
             self.args['clip'],
             self.args['scale_factor'],
             self.args['clip_min'],
-            self.args['clip_max'],
-            corr_dict=corr_dict)
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
-            output_tilespecs = pool.map(mypartial, inp_tilespecs)
+            self.args['clip_max'])
 
-        # upload to render
-        renderapi.stack.create_stack(
-            self.args['output_stack'], cycleNumber=self.args['cycle_number'],
-            cycleStepNumber=self.args['cycle_step_number'], render=self.render)
+        def import_batch(tilespecs):
+            renderapi.client.import_tilespecs_parallel(
+                self.args['output_stack'], tilespecs,
+                poolsize=self.args['pool_size'], render=self.render,
+                close_stack=False)
 
-        if self.args['overwrite_zlayer']:
-            try:
-                renderapi.stack.delete_section(
-                    self.args['output_stack'], self.zValues[0],  # self.args['z_index'],
-                    render=self.render)
-            except renderapi.errors.RenderError as e:
-                self.logger.error(e)
-
-        renderapi.client.import_tilespecs_parallel(
-            self.args['output_stack'], output_tilespecs,
-            poolsize = self.args['pool_size'],render=self.render,close_stack=self.args['close_stack'])
+        try:
+            # mult intensity correct each tilespecs and upload in batches
+            output_tilespecs = []
+            with renderapi.client.WithPool(
+                    self.args['pool_size'], initializer=init_writer) as pool:
+                try:
+                    for ts in pool.imap_unordered(mypartial, tile_tasks()):
+                        in_flight.release()
+                        output_tilespecs.append(ts)
+                        if len(output_tilespecs) >= self.args['import_batch_size']:
+                            import_batch(output_tilespecs)
+                            output_tilespecs = []
+                finally:
+                    # unblock the task handler so that the pool can be
+                    # joined after a failure
+                    stopped.set()
+                    try:
+                        in_flight.release()
+                    except ValueError:
+                        pass
+            if output_tilespecs:
+                import_batch(output_tilespecs)
+        finally:
+            shutil.rmtree(factor_dir)
+
+        if self.args['close_stack']:
+            renderapi.stack.set_stack_state(
+                self.args['output_stack'], 'COMPLETE', render=self.render)
 
 
 if __name__ == "__main__":
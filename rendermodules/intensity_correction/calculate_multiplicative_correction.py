@@ -1,12 +1,15 @@
 if __name__ == "__main__" and __package__ is None:
     __package__ = "rendermodules.intensity_correction.calculate_multiplicative_correction"
+import collections
 import os
+import tempfile
 import renderapi
 from functools import partial
 import numpy as np
 import tifffile
 from scipy.ndimage.filters import gaussian_filter
-from rendermodules.intensity_correction.apply_multiplicative_correction import getImage
+from rendermodules.intensity_correction.apply_multiplicative_correction import (
+    getImage, iter_z_tilespecs)
 from rendermodules.intensity_correction.schemas import MakeMedianParams
 from rendermodules.module.render_module import RenderModule
 
@@ -49,26 +52,80 @@ def randomly_subsample_tilespecs(alltilespecs, numtiles):
     # make a tilespec for each z with median image as default image pyramid
 
 
-def make_median_image(alltilespecs, numtiles, outImage, pool_size, chan=None, gauss_size=10):
+def imap_bounded(pool, func, iterable, prefetch):
+    """ordered pool.imap keeping at most prefetch results in flight"""
+    pending = collections.deque()
+    for arg in iterable:
+        pending.append(pool.apply_async(func, (arg,)))
+        if len(pending) >= prefetch:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def median_image(images, numimages, shape, dtype, memory_budget,
+                 scratch_dir=None):
+    """exact per pixel median of a sequence of images in bounded memory
+
+    Images are stacked in memory if the stack fits in half of
+    memory_budget, otherwise in a temporary memory mapped file.
+    The median is then computed in blocks of rows within memory_budget.
+
+    Parameters
+    ==========
+    images: iterable of numpy.array
+        numimages images of the given shape
+    numimages: int
+        number of images
+    shape: tuple
+        (N, M) shape of each image
+    dtype: numpy.dtype
+        type of images and of the returned median
+    memory_budget: int
+        approximate memory limit in bytes
+    scratch_dir: str
+        directory for the temporary file, system default if None
+
+    Returns
+    =======
+    numpy.array
+        N,M median image of type dtype, even numbers of images
+        yield the mean of the two central values
+    """
+    N, M = shape
+    itemsize = np.dtype(dtype).itemsize
+    if numimages * N * M * itemsize <= memory_budget // 2:
+        stack = np.empty((numimages, N, M), dtype=dtype)
+    else:
+        stack = np.memmap(tempfile.TemporaryFile(dir=scratch_dir),
+                          dtype=dtype, mode='w+', shape=(numimages, N, M))
+    for i, img in enumerate(images):
+        stack[i] = img
+
+    # a block is copied and reduced to float64 by np.median
+    rows = max(1, int(memory_budget // (numimages * M * itemsize + M * 8)))
+    med = np.empty((N, M), dtype=dtype)
+    for r in range(0, N, rows):
+        block = np.array(stack[:, r:r + rows, :])
+        med[r:r + rows, :] = np.median(block, axis=0, overwrite_input=True)
+    del stack
+    return med
+
+
+def make_median_image(alltilespecs, numtiles, outImage, pool_size, chan=None,
+                      gauss_size=10, memory_budget=2 * 1024**3, prefetch=None):
+    numtiles = min(numtiles, len(alltilespecs))
+    prefetch = 2 * pool_size if prefetch is None else prefetch
     # read images and create stack
     N, M, img0 = getImage(alltilespecs[0], channel=chan)
-    stack = np.zeros((N, M, numtiles), dtype=img0.dtype)
     mypartial = partial(getImageFromTilespecs, alltilespecs, channel = chan)
     indexes = range(0, numtiles)
     with renderapi.client.WithPool(pool_size) as pool:
-        images = pool.map(mypartial, indexes)
-
-    # calculate median
-    for i in range(0, len(images)):
-        stack[:, :, i] = images[i]
-    np.median(stack, axis=2, overwrite_input=True)
-    (A, B, C) = stack.shape
-    if (numtiles % 2 == 0):
-        med1 = stack[:, :, numtiles // 2 - 1]
-        med2 = stack[:, :, numtiles // 2 + 1]
-        med = (med1 + med2) // 2
-    else:
-        med = stack[:, :, (numtiles - 1) // 2]
+        # images are consumed as read, at most prefetch are held at once
+        med = median_image(
+            imap_bounded(pool, mypartial, indexes, prefetch),
+            numtiles, (N, M), img0.dtype, memory_budget,
+            scratch_dir=os.path.dirname(outImage))
     med = gaussian_filter(med, gauss_size)
 
     tifffile.imsave(outImage, med)
@@ -89,9 +146,10 @@ class MakeMedian(RenderModule):
 
         # get tilespecs for z
 
-        for z in range(self.args['minZ'], self.args['maxZ'] + 1):
-            tilespecs = self.render.run(
-                renderapi.tilespec.get_tile_specs_from_z, self.args['input_stack'], z)
+        for z, tilespecs in iter_z_tilespecs(
+                self.render, self.args['input_stack'],
+                range(self.args['minZ'], self.args['maxZ'] + 1),
+                self.args['fetch_threads']):
             alltilespecs.extend(tilespecs)
             # used for easy creation of tilespecs for output stack
             firstts.append(tilespecs[0])
@@ -131,7 +189,10 @@ class MakeMedian(RenderModule):
                               numtiles,
                               outImage,
                               self.args['pool_size'],
-                              chan=chan_name)
+                              chan=chan_name,
+                              memory_budget=int(
+                                  self.args['memory_budget_mb'] * 1024**2),
+                              prefetch=self.args['prefetch_images'])
             out_images.append(outImage)
 
         for ind, z in enumerate(range(self.args['minZ'], self.args['maxZ'] + 1)):
@@ -9,6 +9,15 @@ class MakeMedianParams(StackTransitionParameters):
                                  description='Output Directory for saving median image')
     num_images = Int (required=False,default=-1,
                              description="Number of images to randomly subsample to generate median")
+    memory_budget_mb = Float(required=False, default=2048.,
+                             description="Approximate memory limit in MB for the median computation. "
+                                         "Larger image stacks are buffered in a temporary file "
+                                         "in output_directory")
+    prefetch_images = Int(required=False, default=None, allow_none=True,
+                          description="Maximum number of images read ahead of the median computation "
+                                      "(default 2 * pool_size)")
+    fetch_threads = Int(required=False, default=4,
+                        description="Number of z values whose tilespecs are fetched concurrently")
 
 class MultIntensityCorrParams(StackTransitionParameters):
     correction_stack = Str(required=True,
@@ -28,6 +37,10 @@ class MultIntensityCorrParams(StackTransitionParameters):
                   description='Min Clip value')
     clip_max = Int(required=False, default=65535,
                   description='Max Clip value')
+    fetch_threads = Int(required=False, default=4,
+                        description="Number of z values whose tilespecs are fetched concurrently")
+    import_batch_size = Int(required=False, default=5000,
+                            description="Number of corrected tilespecs to upload to output_stack at once")
 
     # move_input = Bool(required=False, default=False,
     #                   description="whether to move input tiles to new location")
@@ -1,13 +1,25 @@
+import gzip
+import hashlib
+import io
 import json
 import logging
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 
 from argschema import ArgSchemaParser
 import cv2
 import numpy as np
 import pathlib2 as pathlib
 import renderapi
-from six.moves import urllib
+import requests
+from six.moves import queue, urllib
 
 from rendermodules.pointmatch.schemas import \
         PointMatchOpenCVParameters, \
@@ -44,6 +56,28 @@ example = {
         }
 
 
+def knn_match_arrays(matches):
+    """convert the output of a k=2 cv2 knnMatch to arrays
+
+    Parameters
+    ----------
+    matches : list of list of cv2.DMatch
+        output of cv2.DescriptorMatcher.knnMatch with k=2
+
+    Returns
+    -------
+    idx : numpy.ndarray
+        N x 3 int array of queryIdx, trainIdx, imgIdx of the best match
+    dist : numpy.ndarray
+        N x 2 float array of best and second best match distances
+    """
+    a = np.array(
+            [(m.queryIdx, m.trainIdx, m.imgIdx, m.distance, n.distance)
+             for m, n in (mn for mn in matches if len(mn) == 2)],
+            dtype='float64').reshape(-1, 5)
+    return a[:, 0:3].astype('int'), a[:, 3:5]
+
+
 def ransac_chunk(fargs):
     [k1xy, k2xy, des1, des2, k1ind, args] = fargs
 
@@ -55,38 +89,41 @@ def ransac_chunk(fargs):
     flann = cv2.FlannBasedMatcher(index_params, search_params)
     MIN_MATCH_COUNT = 10
 
+    k1 = np.empty((0, 2))
+    k2 = np.empty((0, 2))
+    # k1ind may be an index array or a slice of cell-sorted keypoints
+    k1sub = k1xy[k1ind, :]
+    if (k1sub.shape[0] == 0) | (des2.shape[0] < 2):
+        return k1, k2
+
     matches = flann.knnMatch(des1[k1ind, :], des2, k=2)
+    idx, dist = knn_match_arrays(matches)
 
     # store all the good matches as per Lowe's ratio test.
-    good = []
-    k1 = []
-    k2 = []
-    for m, n in matches:
-        if m.distance < args['ratio_of_dist']*n.distance:
-            good.append(m)
-    if len(good) > MIN_MATCH_COUNT:
-        src_pts = np.float32(
-                [k1xy[k1ind, :][m.queryIdx] for m in good]).reshape(-1, 1, 2)
-        dst_pts = np.float32(
-                [k2xy[m.trainIdx] for m in good]).reshape(-1, 1, 2)
+    good = dist[:, 0] < args['ratio_of_dist'] * dist[:, 1]
+    if np.count_nonzero(good) > MIN_MATCH_COUNT:
+        qIdx, tIdx, imgIdx = idx[good].T
+        src_pts = np.float32(k1sub[qIdx]).reshape(-1, 1, 2)
+        dst_pts = np.float32(k2xy[tIdx]).reshape(-1, 1, 2)
         M, mask = cv2.findHomography(
                 src_pts,
                 dst_pts,
                 cv2.RANSAC,
                 args['RANSAC_outlier'])
-        matchesMask = mask.ravel().tolist()
-
-        good = np.array(good)[np.array(matchesMask).astype('bool')]
-        imgIdx = np.array([g.imgIdx for g in good])
-        tIdx = np.array([g.trainIdx for g in good])
-        qIdx = np.array([g.queryIdx for g in good])
-        for i in range(len(tIdx)):
-            if imgIdx[i] == 1:
-                k1.append(k1xy[k1ind, :][tIdx[i]])
-                k2.append(k2xy[qIdx[i]])
-            else:
-                k1.append(k1xy[k1ind, :][qIdx[i]])
-                k2.append(k2xy[tIdx[i]])
+        if mask is None:
+            return k1, k2
+
+        inliers = mask.ravel().astype('bool')
+        qIdx = qIdx[inliers]
+        tIdx = tIdx[inliers]
+        swap = imgIdx[inliers] == 1
+        # query/train indices are reversed for matches against image 1
+        k1 = np.empty((qIdx.size, 2))
+        k2 = np.empty((qIdx.size, 2))
+        k1[~swap] = k1sub[qIdx[~swap]]
+        k2[~swap] = k2xy[tIdx[~swap]]
+        k1[swap] = k1sub[tIdx[swap]]
+        k2[swap] = k2xy[qIdx[swap]]
 
     return k1, k2
 
@@ -94,7 +131,7 @@ def ransac_chunk(fargs):
 def read_downsample_equalize_mask_uri(
         impath, scale, CLAHE_grid=None, CLAHE_clip=None):
     # im = cv2.imread(impath[0], 0)
-    im = cv2.imdecode(np.fromstring(uri_utils.uri_readbytes(impath[0]), np.uint8), 0)
+    im = cv2.imdecode(np.frombuffer(uri_utils.uri_readbytes(impath[0]), np.uint8), 0)
 
     im = cv2.resize(im, (0, 0),
                     fx=scale,
@@ -110,7 +147,7 @@ def read_downsample_equalize_mask_uri(
         im = cv2.equalizeHist(im)
 
     if impath[1] is not None:
-        mask = cv2.imdecode(np.fromstring(uri_utils.uri_readbytes(impath[1]), np.uint8), 0)
+        mask = cv2.imdecode(np.frombuffer(uri_utils.uri_readbytes(impath[1]), np.uint8), 0)
 
         # mask = cv2.imread(impath[1], 0)
         mask = cv2.resize(mask, (0, 0),
@@ -128,16 +165,49 @@ def read_downsample_equalize_mask(
     return read_downsample_equalize_mask_uri(uri_impath, *args, **kwargs)
 
 
-def find_matches(fargs):
-    [impaths, ids, gids, args] = fargs
-
-    pim = read_downsample_equalize_mask_uri(
-            impaths[0],
-            args['downsample_scale'],
-            CLAHE_grid=args['CLAHE_grid'],
-            CLAHE_clip=args['CLAHE_clip'])
-    qim = read_downsample_equalize_mask_uri(
-            impaths[1],
+FEATURE_PARAMETER_KEYS = [
+        "downsample_scale", "CLAHE_grid", "CLAHE_clip",
+        "SIFT_nfeature", "SIFT_noctave", "SIFT_sigma"]
+
+MATCH_PARAMETER_KEYS = FEATURE_PARAMETER_KEYS + [
+        "ndiv", "matchMax", "RANSAC_outlier", "FLANN_ntree",
+        "FLANN_ncheck", "ratio_of_dist", "match_collection"]
+
+
+def feature_cache_path(impath, args):
+    """location of the cached features of a tile image
+
+    Parameters
+    ----------
+    impath : list of str
+        [imageUrl, maskUrl] of the tile
+    args : dict
+        module arguments containing feature_cache_dir and the
+        downsampling, CLAHE and SIFT parameters
+
+    Returns
+    -------
+    str
+        path to an .npz file unique to the image, mask and
+        feature extraction parameters
+    """
+    key = json.dumps(
+            [impath] + [args[k] for k in FEATURE_PARAMETER_KEYS])
+    fname = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz'
+    return os.path.join(args['feature_cache_dir'], fname)
+
+
+def extract_features(fargs):
+    """read, equalize and run SIFT on one tile image, storing keypoints
+    and descriptors in the feature cache unless already present
+    """
+    [impath, args] = fargs
+    fpath = feature_cache_path(impath, args)
+    if os.path.isfile(fpath):
+        return fpath
+
+    im = read_downsample_equalize_mask_uri(
+            impath,
             args['downsample_scale'],
             CLAHE_grid=args['CLAHE_grid'],
             CLAHE_clip=args['CLAHE_clip'])
@@ -148,37 +218,93 @@ def find_matches(fargs):
             sigma=args['SIFT_sigma'])
 
     # find the keypoints and descriptors
-    kp1, des1 = sift.detectAndCompute(pim, None)
-    kp2, des2 = sift.detectAndCompute(qim, None)
-
-    k1xy = np.array([np.array(k.pt) for k in kp1])
-    k2xy = np.array([np.array(k.pt) for k in kp2])
-
-    nr, nc = pim.shape
-    k1 = []
-    k2 = []
-    ransac_args = []
-    results = []
-    ndiv = args['ndiv']
-    for i in range(ndiv):
-        r = np.arange(nr*i/ndiv, nr*(i+1)/ndiv)
-        for j in range(ndiv):
-            c = np.arange(nc*j/ndiv, nc*(j+1)/ndiv)
-            k1ind = np.argwhere(
-                    (k1xy[:, 0] >= r.min()) &
-                    (k1xy[:, 0] <= r.max()) &
-                    (k1xy[:, 1] >= c.min()) &
-                    (k1xy[:, 1] <= c.max())).flatten()
-            ransac_args.append([k1xy, k2xy, des1, des2, k1ind, args])
-            results.append(ransac_chunk(ransac_args[-1]))
-
-    for result in results:
-        k1 += result[0]
-        k2 += result[1]
+    kp, des = sift.detectAndCompute(im, None)
+    kxy = np.array([k.pt for k in kp]).reshape(-1, 2)
+    if des is None:
+        des = np.zeros((0, 128), dtype='float32')
+
+    # write to a temporary file first to keep concurrent readers safe
+    with tempfile.NamedTemporaryFile(
+            dir=args['feature_cache_dir'], suffix='.npz',
+            delete=False) as f:
+        np.savez(f, kxy=kxy, des=des, shape=np.array(im.shape))
+    os.rename(f.name, fpath)
+    return fpath
+
+
+def load_features(fpath):
+    """load keypoint coordinates, descriptors and image shape
+    from the feature cache
+    """
+    with np.load(fpath) as f:
+        return f['kxy'], f['des'], tuple(f['shape'])
+
+
+def partition_keypoints(kxy, shape, ndiv):
+    """bucket keypoints into an ndiv x ndiv grid over an image
+
+    Parameters
+    ----------
+    kxy : numpy.ndarray
+        N x 2 array of keypoint x, y coordinates
+    shape : tuple
+        (rows, columns) of the image
+    ndiv : int
+        number of subdivisions along each image axis
+
+    Returns
+    -------
+    order : numpy.ndarray
+        keypoint indices sorted by (row-major) cell index
+    bounds : numpy.ndarray
+        ndiv * ndiv + 1 offsets into order, cell n spans
+        order[bounds[n]:bounds[n + 1]]
+    """
+    nr, nc = shape
+    col = np.clip(
+        np.floor(kxy[:, 0] * ndiv / nc).astype('int'), 0, ndiv - 1)
+    row = np.clip(
+        np.floor(kxy[:, 1] * ndiv / nr).astype('int'), 0, ndiv - 1)
+    cell = row * ndiv + col
+    order = np.argsort(cell, kind='mergesort')
+    bounds = np.zeros(ndiv * ndiv + 1, dtype='int')
+    bounds[1:] = np.cumsum(np.bincount(cell, minlength=ndiv * ndiv))
+    return order, bounds
+
+
+def find_matches(fargs):
+    [impaths, ids, gids, args] = fargs
+
+    k1xy, des1, pshape = load_features(feature_cache_path(impaths[0], args))
+    k2xy, des2, _ = load_features(feature_cache_path(impaths[1], args))
+
+    # keypoints sorted by grid cell, so that each cell is a slice
+    order, bounds = partition_keypoints(k1xy, pshape, args['ndiv'])
+    k1xy = k1xy[order]
+    des1 = des1[order]
+    ransac_args = [
+            [k1xy, k2xy, des1, des2, slice(bounds[i], bounds[i + 1]), args]
+            for i in range(bounds.size - 1)]
+
+    nthreads = min(args['chunk_threads'], len(ransac_args))
+    if nthreads > 1:
+        # FLANN and RANSAC release the GIL
+        tpool = ThreadPool(nthreads)
+        try:
+            results = tpool.map(ransac_chunk, ransac_args)
+        finally:
+            tpool.close()
+            tpool.join()
+    else:
+        results = [ransac_chunk(a) for a in ransac_args]
 
+    k1 = np.concatenate([result[0] for result in results])
+    k2 = np.concatenate([result[1] for result in results])
+
+    pm_dict = None
     if len(k1) >= 1:
-        k1 = np.array(k1) / args['downsample_scale']
-        k2 = np.array(k2) / args['downsample_scale']
+        k1 = k1 / args['downsample_scale']
+        k2 = k2 / args['downsample_scale']
 
         if k1.shape[0] > args['matchMax']:
             a = np.arange(k1.shape[0])
@@ -186,15 +312,9 @@ def find_matches(fargs):
             k1 = k1[a[0: args['matchMax']], :]
             k2 = k2[a[0: args['matchMax']], :]
 
-        render = renderapi.connect(**args['render'])
         pm_dict = make_pm(ids, gids, k1, k2)
 
-        renderapi.pointmatch.import_matches(
-          args['match_collection'],
-          [pm_dict],
-          render=render)
-
-    return [impaths, len(kp1), len(kp2), len(k1), len(k2)]
+    return [impaths, len(k1xy), len(k2xy), len(k1), len(k2), pm_dict, ids]
 
 
 def make_pm(ids, gids, k1, k2):
@@ -212,46 +332,395 @@ def make_pm(ids, gids, k1, k2):
     return pm
 
 
+def import_matches_with_retry(
+        match_collection, matches, render, session=None,
+        retries=5, backoff=1.0, logger=logging.getLogger()):
+    """import a batch of point matches, retrying with exponential
+    backoff if render refuses or fails the request
+    """
+    for attempt in range(retries + 1):
+        try:
+            return renderapi.pointmatch.import_matches(
+                match_collection, matches,
+                session=session, render=render)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait = backoff * 2 ** attempt
+            logger.warning(
+                "import of %d matches failed (%s), retrying in %.1f s" % (
+                    len(matches), str(e), wait))
+            time.sleep(wait)
+
+
+class MatchWriter(threading.Thread):
+    """thread buffering point match dicts and importing them to
+    a match collection in batches over a single http session
+
+    Parameters
+    ----------
+    render : renderapi.render.Render
+        render connection
+    match_collection : str
+        name of the point match collection
+    batch_size : int
+        number of point match dicts per import request
+    retries : int
+        number of retries of a failed import
+    backoff : float
+        initial wait in seconds between retries, doubled on each retry
+    ledger : PairLedger or None
+        ledger in which pairs are marked complete once imported
+    """
+    def __init__(self, render, match_collection, batch_size=1000,
+                 retries=5, backoff=1.0, ledger=None,
+                 logger=logging.getLogger()):
+        super(MatchWriter, self).__init__()
+        self.daemon = True
+        self.render = render
+        self.match_collection = match_collection
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.ledger = ledger
+        self.logger = logger
+        self.session = requests.Session()
+        self.queue = queue.Queue(maxsize=2 * batch_size)
+        self.count = 0
+        self.error = None
+
+    def put(self, pm):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(pm)
+
+    def flush(self, batch):
+        import_matches_with_retry(
+            self.match_collection, batch, self.render,
+            session=self.session, retries=self.retries,
+            backoff=self.backoff, logger=self.logger)
+        if self.ledger is not None:
+            self.ledger.add([(pm['pId'], pm['qId']) for pm in batch])
+        self.count += len(batch)
+        self.logger.debug("%d matches written to %s" % (
+            self.count, self.match_collection))
+
+    def run(self):
+        batch = []
+        done = False
+        while not done:
+            pm = self.queue.get()
+            done = pm is None
+            if not done:
+                batch.append(pm)
+                if len(batch) < self.batch_size:
+                    continue
+            if len(batch) > 0:
+                try:
+                    self.flush(batch)
+                except Exception as e:
+                    self.error = e
+                    # keep draining so that producers do not block
+                    while not done:
+                        done = self.queue.get() is None
+                batch = []
+        self.session.close()
+
+    def close(self):
+        """flush remaining matches and wait for the writer to finish"""
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+@renderapi.render.renderaccess
+def get_match_pairs_with_group(matchCollection, pgroup, owner=None,
+                               host=None, port=None, session=None,
+                               render=None, **kwargs):
+    """(pId, qId) of all matches with pGroupId == pgroup, requested
+    without the match points"""
+    request_url = renderapi.render.format_baseurl(host, port) + \
+        "/owner/%s/matchCollection/%s/pGroup/%s/matches" % (
+            owner, matchCollection, pgroup)
+    matches = renderapi.utils.get_json(
+        session, request_url, params={'excludeMatchDetails': 'true'},
+        stream=True)
+    return [(m['pId'], m['qId']) for m in matches]
+
+
+class PairLedger(object):
+    """sqlite record of the tile pairs for which matching completed
+
+    Pairs are stored unordered together with a hash of the matching
+    parameters, so that a ledger can be shared between runs with
+    different parameters.
+
+    Parameters
+    ----------
+    path : str
+        sqlite database file, created if it does not exist
+    parameter_hash : str
+        hash of the parameters the matches are derived with
+    """
+    def __init__(self, path, parameter_hash):
+        self.path = path
+        self.parameter_hash = parameter_hash
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS completed ("
+                "pId TEXT, qId TEXT, parameter_hash TEXT, "
+                "PRIMARY KEY (pId, qId, parameter_hash))")
+
+    @staticmethod
+    def hash_parameters(args):
+        key = json.dumps([args[k] for k in MATCH_PARAMETER_KEYS])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def add(self, pairs):
+        rows = [tuple(sorted(pair)) + (self.parameter_hash,)
+                for pair in pairs]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO completed VALUES (?, ?, ?)", rows)
+
+    def completed(self):
+        """set of sorted (pId, qId) tuples completed with the
+        parameters of this ledger"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT pId, qId FROM completed WHERE parameter_hash = ?",
+                (self.parameter_hash,)).fetchall()
+        return set(rows)
+
+    def seed_from_collection(self, render, match_collection, groupIds):
+        """mark all pairs with matches in a collection as completed
+
+        Parameters
+        ----------
+        render : renderapi.render.Render
+            render connection
+        match_collection : str
+            name of the point match collection
+        groupIds : iterable of str
+            pGroupIds to query
+
+        Returns
+        -------
+        int
+            number of pairs found in the collection
+        """
+        existing = set(renderapi.pointmatch.get_match_groupIds(
+            match_collection, render=render))
+        n = 0
+        for groupId in set(groupIds) & existing:
+            pairs = get_match_pairs_with_group(
+                match_collection, groupId, render=render)
+            self.add(pairs)
+            n += len(pairs)
+        return n
+
+    def close(self):
+        self.connection.close()
+
+
 def parse_tileids(tpjson, logger=logging.getLogger()):
     tile_ids = np.array(
                 [[m['p']['id'], m['q']['id']]
                     for m in tpjson['neighborPairs']])
 
-    unique_ids = np.unique(tile_ids.flatten())
-
-    # determine tile index per tile pair
+    return index_tileids(tile_ids, logger=logger)
+
+
+def index_tileids(tile_ids, logger=logging.getLogger()):
+    """unique tileIds and the index into them of each tile pair
+
+    Parameters
+    ----------
+    tile_ids : numpy.ndarray
+        N x 2 array of p and q tileIds
+
+    Returns
+    -------
+    unique_ids : numpy.ndarray
+        sorted unique tileIds
+    tile_index : numpy.ndarray
+        N x 2 int array such that unique_ids[tile_index] == tile_ids
+    """
+    tile_ids = np.asarray(tile_ids).reshape(-1, 2)
+    if tile_ids.shape[0] == 0:
+        logger.error('no tilepairs found')
+
+    unique_ids, tile_index = np.unique(tile_ids, return_inverse=True)
+
+    return unique_ids, tile_index.reshape(tile_ids.shape).astype('int')
+
+
+def stream_tilepairs(tilepair_file, chunk_size=2**20):
+    """iterate over the neighborPairs of a (gzipped) tile pair json
+    without loading the whole file
+
+    Parameters
+    ----------
+    tilepair_file : str
+        path to tile pair json, gzip compressed if ending in .gz
+    chunk_size : int
+        number of characters read at once
+
+    Yields
+    ------
+    dict
+        neighborPair with p and q tile descriptions
+    """
+    opener = gzip.open if tilepair_file.endswith('.gz') else io.open
+    decoder = json.JSONDecoder()
+    start = re.compile(r'"neighborPairs"\s*:\s*\[')
+    separator = re.compile(r'[\s,]*')
+
+    with opener(tilepair_file, 'rt') as f:
+        buf = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buf += chunk
+            m = start.search(buf)
+            if m is not None:
+                buf = buf[m.end():]
+                break
+            buf = buf[-64:]
+
+        pos = 0
+        while True:
+            pos = separator.match(buf, pos).end()
+            if pos < len(buf):
+                if buf[pos] == ']':
+                    return
+                try:
+                    pair, pos = decoder.raw_decode(buf, pos)
+                    yield pair
+                    continue
+                except ValueError:
+                    # object continues in the next chunk
+                    pass
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError(
+                    "unexpected end of tile pair file %s" % tilepair_file)
+            buf = buf[pos:] + chunk
+            pos = 0
+
+
+def load_tilepairs(tilepair_file, logger=logging.getLogger()):
+    """stream a tile pair json keeping only tileIds and groupIds
+
+    Returns
+    -------
+    unique_ids : numpy.ndarray
+        sorted unique tileIds
+    tile_index : numpy.ndarray
+        N x 2 int array indexing unique_ids per tile pair
+    groupIds : dict
+        mapping of tileId to groupId
+    """
+    tile_ids = []
+    groupIds = {}
+    for m in stream_tilepairs(tilepair_file):
+        tile_ids.append((m['p']['id'], m['q']['id']))
+        for k in ['p', 'q']:
+            groupIds[m[k]['id']] = m[k].get('groupId')
+
+    unique_ids, tile_index = index_tileids(tile_ids, logger=logger)
+    return unique_ids, tile_index, groupIds
+
+
+def pooled_session(size):
+    """requests session keeping up to size connections alive"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=size, pool_maxsize=size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_section_tilespecs(fargs):
+    [render, session, input_stack, groupId] = fargs
+    z = renderapi.stack.get_section_z_value(
+        input_stack, groupId, render=render, session=session)
+    return renderapi.resolvedtiles.get_resolved_tiles_from_z(
+        input_stack, z, render=render, session=session).tilespecs
+
+
+def get_tilespec(fargs):
+    [render, session, input_stack, tileId] = fargs
+    return renderapi.tilespec.get_tile_spec_raw(
+        input_stack, tileId, render=render, session=session)
+
+
+def load_tilespecs(render, input_stack, unique_ids, groupIds=None,
+                   nthreads=8, bulk_fetch_min_tiles=20):
+    """fetch the tilespecs of a set of tileIds
+
+    Sections contributing at least bulk_fetch_min_tiles tiles are
+    fetched as a whole, the remaining tiles individually. Requests are
+    made concurrently over a single pooled session.
+
+    Parameters
+    ----------
+    render : renderapi.render.Render
+        render connection
+    input_stack : str
+        stack containing the tiles
+    unique_ids : numpy.ndarray
+        tileIds to fetch
+    groupIds : dict or None
+        mapping of tileId to groupId (sectionId). If None, all
+        tiles are fetched individually
+    nthreads : int
+        number of concurrent requests
+    bulk_fetch_min_tiles : int
+        minimum number of tiles of a section to fetch it as a whole
+
+    Returns
+    -------
+    numpy.ndarray
+        tilespecs in the order of unique_ids
+    """
+    wanted = set(unique_ids)
+    bulk = []
+    if groupIds is not None:
+        tiles_per_group = {}
+        for tid in unique_ids:
+            tiles_per_group.setdefault(groupIds.get(tid), []).append(tid)
+        bulk = [g for g, tids in tiles_per_group.items()
+                if (g is not None) & (len(tids) >= bulk_fetch_min_tiles)]
+
+    session = pooled_session(nthreads)
+    tpool = ThreadPool(nthreads)
+    tilespecs = {}
     try:
-        tile_index = np.zeros(
-                        (tile_ids.shape[0], tile_ids.shape[1])
-                        ).astype('int')
-    except IndexError as e:
-        logger.error('%s : probably no tilepairs' % str(e))
-
-    for i in range(tile_ids.shape[0]):
-        for j in range(tile_ids.shape[1]):
-            tile_index[i, j] = np.argwhere(unique_ids == tile_ids[i, j])
-
-    return unique_ids, tile_index
-
-
-def load_pairjson(tilepair_file, logger=logging.getLogger()):
-    tpjson = []
-    try:
-        tpjson = json.load(open(tilepair_file, 'r'))
-    except TypeError as e:
-        logger.error(e)
-
-    return tpjson
-
-
-def load_tilespecs(render, input_stack, unique_ids):
-    tilespecs = []
-    for tid in unique_ids:
-        tilespecs.append(
-            renderapi.tilespec.get_tile_spec_raw(
-                input_stack, tid, render=render))
-
-    return np.array(tilespecs)
+        for section in tpool.imap_unordered(
+                get_section_tilespecs,
+                [[render, session, input_stack, g] for g in bulk]):
+            for t in section:
+                if t.tileId in wanted:
+                    tilespecs[t.tileId] = t
+
+        # sparse sections and tiles not found under their groupId
+        missing = [tid for tid in unique_ids if tid not in tilespecs]
+        for t in tpool.imap_unordered(
+                get_tilespec,
+                [[render, session, input_stack, tid] for tid in missing]):
+            tilespecs[t.tileId] = t
+    finally:
+        tpool.close()
+        tpool.join()
+        session.close()
+
+    return np.array([tilespecs[tid] for tid in unique_ids])
 
 
 class GeneratePointMatchesOpenCV(ArgSchemaParser):
@@ -260,14 +729,16 @@ class GeneratePointMatchesOpenCV(ArgSchemaParser):
 
     def run(self):
         render = renderapi.connect(**self.args['render'])
-        tpjson = load_pairjson(self.args['pairJson'], logger=self.logger)
-
-        unique_ids, tile_index = parse_tileids(tpjson, logger=self.logger)
+        unique_ids, tile_index, groupIds = load_tilepairs(
+                self.args['pairJson'], logger=self.logger)
 
         tilespecs = load_tilespecs(
                 render,
                 self.args['input_stack'],
-                unique_ids)
+                unique_ids,
+                groupIds=groupIds,
+                nthreads=self.args['tilespec_fetch_threads'],
+                bulk_fetch_min_tiles=self.args['bulk_fetch_min_tiles'])
 
         self.match_image_pairs(
                 tilespecs,
@@ -278,7 +749,70 @@ class GeneratePointMatchesOpenCV(ArgSchemaParser):
         if self.args['ncpus'] == -1:
             ncpus = multiprocessing.cpu_count()
 
+        args = dict(self.args)
+        # chunk threads run inside each of the ncpus pool workers
+        max_threads = max(1, multiprocessing.cpu_count() // ncpus)
+        if args['chunk_threads'] > max_threads:
+            self.logger.warning(
+                "limiting chunk_threads to %d for %d processes" % (
+                    max_threads, ncpus))
+            args['chunk_threads'] = max_threads
+        cleanup_cache = args['feature_cache_dir'] is None
+        if cleanup_cache:
+            args['feature_cache_dir'] = tempfile.mkdtemp()
+        elif not os.path.isdir(args['feature_cache_dir']):
+            os.makedirs(args['feature_cache_dir'])
+
+        ledger = None
+        todo = tile_index
+        if args['ledger_file'] is not None:
+            ledger = PairLedger(
+                args['ledger_file'], PairLedger.hash_parameters(args))
+            if args['seed_ledger_from_collection']:
+                n = ledger.seed_from_collection(
+                    renderapi.connect(**args['render']),
+                    args['match_collection'],
+                    {t.layout.sectionId for t in tilespecs})
+                self.logger.info(
+                    "%d pairs found in %s" % (n, args['match_collection']))
+            if args['resume']:
+                completed = ledger.completed()
+                tileIds = np.array([t.tileId for t in tilespecs])
+                done = np.array([
+                    tuple(sorted(pair)) in completed
+                    for pair in tileIds[tile_index]], dtype='bool')
+                todo = tile_index[~done]
+                self.logger.info(
+                    "resuming: skipping %d of %d completed pairs" % (
+                        np.count_nonzero(done), tile_index.shape[0]))
+
+        try:
+            if todo.shape[0] > 0:
+                self.match_cached_features(
+                    tilespecs, todo, args, ncpus, ledger=ledger)
+        finally:
+            if cleanup_cache:
+                shutil.rmtree(args['feature_cache_dir'], ignore_errors=True)
+            if ledger is not None:
+                ledger.close()
+
+        output = {}
+        output['collectionId'] = {}
+        output['collectionId']['owner'] = self.args['render']['owner']
+        output['collectionId']['name'] = self.args['match_collection']
+        output['pairCount'] = tile_index.shape[0]
+        self.output(output)
+
+    def match_cached_features(
+            self, tilespecs, tile_index, args, ncpus, ledger=None):
         with renderapi.client.WithPool(ncpus) as pool:
+            # features are extracted once per tile, not once per pair
+            used = np.unique(tile_index)
+            ffargs = [[[t.ip[0].imageUrl, t.ip[0].maskUrl], args]
+                      for t in tilespecs[used]]
+            for fpath in pool.imap_unordered(extract_features, ffargs):
+                self.logger.debug("features cached in %s" % fpath)
+
             index_list = range(tile_index.shape[0])
 
             fargs = []
@@ -295,20 +829,30 @@ class GeneratePointMatchesOpenCV(ArgSchemaParser):
                 ids = [t.tileId for t in tilespecs[tile_index[i]]]
                 gids = [t.layout.sectionId
                         for t in tilespecs[tile_index[i]]]
-                fargs.append([impaths, ids, gids, self.args])
-
-            for r in pool.imap_unordered(find_matches, fargs):
-                log = "\n%s\n%s\n" % (r[0][0], r[0][1])
-                log += "  (%d, %d) features found" % (r[1], r[2])
-                log += "  (%d, %d) matches made" % (r[3], r[4])
-                self.logger.debug(log)
-
-        output = {}
-        output['collectionId'] = {}
-        output['collectionId']['owner'] = self.args['render']['owner']
-        output['collectionId']['name'] = self.args['match_collection']
-        output['pairCount'] = tile_index.shape[0]
-        self.output(output)
+                fargs.append([impaths, ids, gids, args])
+
+            writer = MatchWriter(
+                renderapi.connect(**args['render']),
+                args['match_collection'],
+                batch_size=args['match_batch_size'],
+                retries=args['match_upload_retries'],
+                backoff=args['match_upload_backoff'],
+                ledger=ledger,
+                logger=self.logger)
+            writer.start()
+            try:
+                for r in pool.imap_unordered(find_matches, fargs):
+                    log = "\n%s\n%s\n" % (r[0][0], r[0][1])
+                    log += "  (%d, %d) features found" % (r[1], r[2])
+                    log += "  (%d, %d) matches made" % (r[3], r[4])
+                    self.logger.debug(log)
+                    if r[5] is not None:
+                        writer.put(r[5])
+                    elif ledger is not None:
+                        # nothing to import, pair is complete
+                        ledger.add([r[6]])
+            finally:
+                writer.close()
 
 
 if __name__ == '__main__':
@@ -233,6 +233,66 @@ class PointMatchOpenCVParameters(RenderParameters):
         default=-1,
         missing=-1,
         description="number of CPUs to use")
+    feature_cache_dir = Str(
+        required=False,
+        default=None,
+        missing=None,
+        description="directory in which SIFT features are cached "
+        "per tile image and feature parameters. Reused across runs "
+        "if given, otherwise a temporary directory is used")
+    match_batch_size = Int(
+        required=False,
+        default=1000,
+        missing=1000,
+        description="number of tile pair matches imported "
+        "to the match collection per request")
+    match_upload_retries = Int(
+        required=False,
+        default=5,
+        missing=5,
+        description="number of retries of a failed match import")
+    match_upload_backoff = Float(
+        required=False,
+        default=1.0,
+        missing=1.0,
+        description="seconds to wait before retrying a failed "
+        "match import, doubled on each retry")
+    chunk_threads = Int(
+        required=False,
+        default=1,
+        missing=1,
+        description="number of threads matching the ndiv x ndiv "
+        "cells of a tile pair concurrently in each of the ncpus "
+        "processes, limited to cpu_count // ncpus")
+    ledger_file = Str(
+        required=False,
+        default=None,
+        missing=None,
+        description="sqlite file recording the tile pairs matched "
+        "with the current parameters, used to resume interrupted runs")
+    resume = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description="skip tile pairs recorded as complete "
+        "in ledger_file")
+    seed_ledger_from_collection = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description="record tile pairs already present in "
+        "match_collection as complete in ledger_file before matching")
+    tilespec_fetch_threads = Int(
+        required=False,
+        default=8,
+        missing=8,
+        description="number of concurrent tilespec requests")
+    bulk_fetch_min_tiles = Int(
+        required=False,
+        default=20,
+        missing=20,
+        description="sections with at least this many tiles in the "
+        "tile pair file are fetched as a whole, others tile by tile")
 
 
 class SwapPointMatches(RenderParameters):
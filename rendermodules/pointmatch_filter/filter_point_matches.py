@@ -1,7 +1,12 @@
+import io
 import json
+import time
+import zipfile
 import renderapi
+import requests
 import numpy as np
 from rendermodules.module.render_module import RenderModule
+from rendermodules.residuals.compute_residuals import match_columns
 from .schemas import FilterSchema, FilterOutputSchema
 import logging
 
@@ -71,20 +76,102 @@ def filter_plot(fig, result_json, fs=14):
     ax.plot([ax.get_xlim()[0], tmax], [rmax, rmax], '--b', alpha=0.5)
 
 
+def fit_affine_batch(p, q, counts):
+    """least squares affine fits of many point sets at once
+
+    Each point set is centered, which decouples the translation and
+    leaves one 2 x 2 system of normal equations per set. Degenerate
+    sets are fit individually with AffineModel.fit, empty sets get
+    the identity with zero residual.
+
+    Parameters
+    ----------
+    p : numpy.ndarray
+        sum(counts) x 2 source points of all sets
+    q : numpy.ndarray
+        sum(counts) x 2 destination points of all sets
+    counts : numpy.ndarray
+        number of points in each set
+
+    Returns
+    -------
+    tvec : numpy.ndarray
+        len(counts) x 6 fit parameters ordered M00,M01,M10,M11,B0,B1
+    residuals : numpy.ndarray
+        sum of squared residuals of each fit
+    """
+    p = np.asarray(p, dtype=float)
+    q = np.asarray(q, dtype=float)
+    counts = np.asarray(counts, dtype=int)
+    empty = counts == 0
+    if len(counts) == 0 or empty.any():
+        # reduceat offsets need sets of at least one point
+        tvec = np.tile([1., 0., 0., 1., 0., 0.], (len(counts), 1))
+        residuals = np.zeros(len(counts))
+        if not empty.all():
+            tvec[~empty], residuals[~empty] = fit_affine_batch(
+                p, q, counts[~empty])
+        return tvec, residuals
+
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    idx = np.repeat(np.arange(len(counts)), counts)
+
+    pmean = np.add.reduceat(p, starts, axis=0) / counts[:, None]
+    qmean = np.add.reduceat(q, starts, axis=0) / counts[:, None]
+    pc = p - pmean[idx]
+    qc = q - qmean[idx]
+    # per set p^T p and p^T q
+    S = np.add.reduceat(pc[:, :, None] * pc[:, None, :], starts, axis=0)
+    C = np.add.reduceat(pc[:, :, None] * qc[:, None, :], starts, axis=0)
+
+    det = S[:, 0, 0] * S[:, 1, 1] - S[:, 0, 1] * S[:, 1, 0]
+    scale = S[:, 0, 0] * S[:, 1, 1]
+    ok = (counts >= 3) & (np.abs(det) > 1e-10 * scale)
+    M = np.zeros((len(counts), 2, 2))
+    M[ok] = np.transpose(np.linalg.solve(S[ok], C[ok]), (0, 2, 1))
+    t = qmean - np.einsum('kij,kj->ki', M, pmean)
+
+    tvec = np.column_stack([M.reshape(-1, 4), t])
+    for k in np.flatnonzero(~ok):
+        sl = slice(starts[k], starts[k] + counts[k])
+        tvec[k] = renderapi.transform.AffineModel.fit(p[sl], q[sl]).ravel()
+        M[k] = tvec[k, :4].reshape(2, 2)
+
+    fit = np.einsum('kij,kj->ki', M[idx], p) + tvec[idx, 4:]
+    residuals = np.add.reduceat(
+        np.sum((q - fit) ** 2, axis=1), starts)
+    return tvec, residuals
+
+
+_worker_connection = {}
+
+
+def init_worker(rpar):
+    """pool initializer connecting each worker to render once"""
+    _worker_connection['render'] = renderapi.connect(**rpar)
+    _worker_connection['session'] = requests.Session()
+
+
 def proc_job(fargs):
     [input_match_collection, output_match_collection,
-        input_stack, z, resmax, transmax, rpar, inverse] = fargs
+        input_stack, z, resmax, transmax, rpar, inverse,
+        write_changed_only] = fargs
 
-    render = renderapi.connect(**rpar)
+    render = _worker_connection.get('render')
+    if render is None:
+        render = renderapi.connect(**rpar)
+    session = _worker_connection.get('session')
     try:
         tspecs = renderapi.tilespec.get_tile_specs_from_z(
                 input_stack,
                 float(z),
-                render=render)
+                render=render,
+                session=session)
         matches = renderapi.pointmatch.get_matches_within_group(
                 input_match_collection,
                 tspecs[0].layout.sectionId,
-                render=render)
+                render=render,
+                session=session)
     except renderapi.errors.RenderError as e:
         logger.warning(str(e))
         return None
@@ -92,81 +179,69 @@ def proc_job(fargs):
     if len(matches) == 0:
         return None
 
-    tids = np.array([t.tileId for t in tspecs])
-
-    residuals = []
-    translations = []
-    counts = []
-    pids = [m['pId'] for m in matches]
-    qids = [m['qId'] for m in matches]
-    tf = renderapi.transform.AffineModel()
-
-    for m in matches:
-        A = np.transpose(np.array(m['matches']['p']))
-        B = np.transpose(np.array(m['matches']['q']))
-        tvec, res, _, _ = tf.fit(A, B, return_all=True)
-
-        pi = np.argwhere(tids == m['pId'])[0][0]
-        qi = np.argwhere(tids == m['qId'])[0][0]
-        dx = tspecs[pi].tforms[-1].B0 - tspecs[qi].tforms[-1].B0
-        dy = tspecs[pi].tforms[-1].B1 - tspecs[qi].tforms[-1].B1
-
-        residuals.append(res)
-        counts.append(len(m['matches']['w']))
-        translations.append(
-                np.sqrt(
-                    np.power(dx - tvec[4][0], 2.0) +
-                    np.power(dy - tvec[5][0], 2.0)))
-
-    residuals = np.array(residuals).squeeze()
-    counts = np.array(counts)
-    nres = np.round(np.sqrt(residuals/counts), 3)
-    translations = np.round(np.array(translations), 3)
-
-    w = []
-    cmax = float(counts.max())
+    tile_index = {t.tileId: i for i, t in enumerate(tspecs)}
+    B0 = np.array([t.tforms[-1].B0 for t in tspecs])
+    B1 = np.array([t.tforms[-1].B1 for t in tspecs])
+
+    # all pair fits of the section at once
+    pids, qids, counts, p, q = match_columns(matches)
+    tvec, residuals = fit_affine_batch(p, q, counts)
+
+    pi = np.array([tile_index[i] for i in pids])
+    qi = np.array([tile_index[i] for i in qids])
+    dx = B0[pi] - B0[qi]
+    dy = B1[pi] - B1[qi]
+
+    # matches without points have zero residual
+    nres = np.round(np.sqrt(residuals/np.maximum(counts, 1)), 3)
+    translations = np.round(
+            np.sqrt(
+                np.power(dx - tvec[:, 4], 2.0) +
+                np.power(dy - tvec[:, 5], 2.0)), 3)
+
+    w = np.ones(len(matches))
+    # solver will ignore
+    w[(nres > resmax) | (translations > transmax)] = 0.0
+    if inverse:
+        w = float(counts.max()) / np.maximum(counts, 1)
+
     updated_matches = []
 
     def new_match(match, new_w, copy=False):
         changed = not np.all(np.isclose(
-            np.array(new_w),
+            new_w,
             np.array(match['matches']['w'])))
         if (not copy) & (not changed):
             return None
 
         nmatch = dict(match)
-        nmatch['matches']['w'] = new_w
+        nmatch['matches'] = dict(match['matches'])
+        nmatch['matches']['w'] = new_w.tolist()
         return nmatch
 
-    for i in range(len(matches)):
-        w.append(1.0)
-        if (nres[i] > resmax) | (translations[i] > transmax):
-            # solver will ignore
-            w[-1] = 0.0
-        if inverse:
-            w.append(cmax/counts[i])
-        if output_match_collection is not None:
-            new_w = [w[-1]] * counts[i]
-            if(output_match_collection != input_match_collection):
-                # copy over everything, modified or not
-                updated_matches.append(new_match(matches[i], new_w, copy=True))
-            else:
-                # only copy over modified
-                nmatch = new_match(matches[i], new_w, copy=False)
-                if nmatch is not None:
-                    updated_matches.append(nmatch)
-
     if output_match_collection is not None:
+        # copy over everything, modified or not, to a new collection
+        # unless only modified matches were requested
+        copy = ((output_match_collection != input_match_collection) &
+                (not write_changed_only))
+        for i in range(len(matches)):
+            nmatch = new_match(
+                    matches[i], np.full(counts[i], w[i]), copy=copy)
+            if nmatch is not None:
+                updated_matches.append(nmatch)
+
         logger.info(
                 "updating weights for %d of %d matches for z=%d in %s" % (
                     len(updated_matches),
                     len(matches),
                     int(z),
                     output_match_collection))
-        renderapi.pointmatch.import_matches(
-                output_match_collection,
-                updated_matches,
-                render=render)
+        if len(updated_matches) > 0:
+            renderapi.pointmatch.import_matches(
+                    output_match_collection,
+                    updated_matches,
+                    render=render,
+                    session=session)
 
     result = {}
     result['z'] = z
@@ -185,6 +260,45 @@ def proc_job(fargs):
     return result
 
 
+filter_columns = ['pId', 'qId', 'nres', 'translation', 'count', 'weight']
+filter_column_types = {'pId': np.str_, 'qId': np.str_, 'count': int}
+
+
+def write_filter_npz(zf, result):
+    """add the filter results of one section to an open
+    zipfile.ZipFile as npz entries '<z>/<column>'"""
+    for col in filter_columns:
+        buf = io.BytesIO()
+        np.lib.format.write_array(buf, np.array(
+            [f[col] for f in result['filter']],
+            dtype=filter_column_types.get(col, float)))
+        zf.writestr('%s/%s.npy' % (result['z'], col), buf.getvalue())
+
+
+def read_filter_npz(fname):
+    """read filter output written in npz format
+
+    Parameters
+    ----------
+    fname : str
+        path to npz filter output
+
+    Returns
+    -------
+    dict
+        column name: numpy.ndarray over all matches of all sections,
+        with the z of each match in column 'z'
+    """
+    with np.load(fname) as data:
+        zs = sorted({k.split('/')[0] for k in data.files}, key=float)
+        columns = {col: [data['%s/%s' % (z, col)] for z in zs]
+                   for col in filter_columns}
+    out = {col: np.concatenate(v) for col, v in columns.items()}
+    out['z'] = np.repeat(
+        np.array(zs, dtype=float), [len(c) for c in columns['nres']])
+    return out
+
+
 class FilterMatches(RenderModule):
     default_schema = FilterSchema
     default_output_schema = FilterOutputSchema
@@ -200,19 +314,46 @@ class FilterMatches(RenderModule):
                 self.args['resmax'],
                 self.args['transmax'],
                 self.args['render'],
-                self.args['inverse_weighting']])
-
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
-            results = pool.map(proc_job, fargs)
-
-        with open(self.args['filter_output_file'], 'w') as f:
-
-            # using renderapi dump allows py3 numpy integer serialization
-
-            renderapi.utils.renderdump(
-                    [x for x in results if x is not None],
-                    f,
-                    indent=2)
+                self.args['inverse_weighting'],
+                self.args['write_changed_only']])
+
+        npz = self.args['filter_output_format'] == 'npz'
+        nsections = 0
+        nmatches = 0
+        t0 = time.time()
+        with renderapi.client.WithPool(
+                self.args['pool_size'], initializer=init_worker,
+                initargs=(self.args['render'],)) as pool, \
+                open(self.args['filter_output_file'], 'wb' if npz else 'w') as f:
+            # results are written per section as they arrive
+            if npz:
+                out = zipfile.ZipFile(f, 'w', allowZip64=True)
+                results = pool.imap_unordered(proc_job, fargs)
+            else:
+                f.write('[')
+                results = pool.imap(proc_job, fargs)
+            for result in results:
+                if result is None:
+                    continue
+                if npz:
+                    write_filter_npz(out, result)
+                else:
+                    if nsections > 0:
+                        f.write(',\n')
+                    # using renderapi dump allows py3 numpy integer serialization
+                    renderapi.utils.renderdump(result, f, indent=2)
+                nsections += 1
+                nmatches += len(result['filter'])
+                dt = max(time.time() - t0, 1e-6)
+                self.logger.info(
+                        "filtered %d/%d sections, %d matches "
+                        "(%0.2f sections/s, %0.1f matches/s)" % (
+                            nsections, len(fargs), nmatches,
+                            nsections / dt, nmatches / dt))
+            if npz:
+                out.close()
+            else:
+                f.write(']')
 
         with open(self.args['output_json'], 'w') as f:
             outj = {'filter_output_file': self.args['filter_output_file']}
@@ -1,4 +1,5 @@
 import argschema
+import marshmallow as mm
 from ..module.schemas import (RenderParameters, ZValueParameters,
                               ProcessPoolParameters)
 from argschema.fields import Bool, Str, Float, OutputFile
@@ -27,11 +28,26 @@ class FilterSchema(RenderParameters, ZValueParameters, ProcessPoolParameters):
     filter_output_file = OutputFile(
         required=True,
         description="location of json file with filter output")
+    filter_output_format = Str(
+        required=False,
+        default='json',
+        missing='json',
+        validator=mm.validate.OneOf(['json', 'npz']),
+        description=("format of filter_output_file. 'npz' stores "
+                     "pId, qId, nres, translation, count and weight "
+                     "columns per section as '<z>/<column>'"))
     inverse_weighting = Bool(
         required=True,
         default=False,
         missing=False,
         description='new weights weighted inverse to counts per tile-pair')
+    write_changed_only = Bool(
+        required=False,
+        default=False,
+        missing=False,
+        description=('only write matches whose weights changed, also when '
+                     'output_match_collection differs from '
+                     'input_match_collection'))
 
 
 class FilterOutputSchema(argschema.schemas.DefaultSchema):
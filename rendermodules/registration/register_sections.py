@@ -1,4 +1,5 @@
 import os
+import collections
 import numpy as np
 import renderapi
 import logging
@@ -6,7 +7,7 @@ from functools import partial
 from renderapi.transform import AffineModel, RigidModel, SimilarityModel
 from rendermodules.module.render_module import RenderModule
 from rendermodules.registration.schemas import RegisterSectionSchema, RegisterSectionOutputSchema
-from rendermodules.stack.consolidate_transforms import consolidate_transforms
+from rendermodules.stack.consolidate_transforms import consolidate_section_transforms
 
 example = {
     "render": {
@@ -35,6 +36,7 @@ def fit_model_to_points(render, ref_stack, moving_stack, match_collection, match
     ref_tspecs = renderapi.tilespec.get_tile_specs_from_z(ref_stack, ref_z, render=render)
     moving_tspecs = renderapi.tilespec.get_tile_specs_from_z(moving_stack, moving_z, render=render)
 
+    registered = collections.OrderedDict()
     for i, tspec in enumerate(ref_tspecs):
         pid = tspec.tileId
         pgroup = tspec.layout.sectionId
@@ -61,9 +63,13 @@ def fit_model_to_points(render, ref_stack, moving_stack, match_collection, match
         final_transform.estimate(B,A)
 
         tspecq.tforms.append(final_transform)
-        if consolidate:
-            newt = consolidate_transforms(tspecq.tforms, keep_ref_tforms=True)
-            tspecq.tforms = newt
+        registered[tspecq.tileId] = tspecq
+
+    if consolidate:
+        new_tforms_list = consolidate_section_transforms(
+            [ts.tforms for ts in registered.values()], keep_ref_tforms=True)
+        for ts, newt in zip(registered.values(), new_tforms_list):
+            ts.tforms = newt
     return moving_tspecs
 
 
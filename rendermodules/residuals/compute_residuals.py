@@ -23,46 +23,9 @@ def compute_residuals_within_group(render, stack, matchCollectionOwner, matchCol
                                stack, z, session=session)
     tforms = {ts.tileId: ts.tforms for ts in tilespecs}
 
-    # transformed_pts = np.zeros((1,2))
-    tile_residuals = {key: np.empty((0,1)) for key in tforms.keys()}
-    tile_rmse = {key: np.empty((0,1)) for key in tforms.keys()}
-    pt_match_positions = {key: np.empty((0,2)) for key in tforms.keys()}
-
     statistics = {}
-    for i, match in enumerate(allmatches):
-        pts_p = np.array(match['matches']['p'])
-        pts_q = np.array(match['matches']['q'])
-
-        if pts_p.shape[1] < min_points:
-            continue
-        try:
-            t_p = tforms[match['pId']][-1].tform(pts_p.T)
-            t_q = tforms[match['qId']][-1].tform(pts_q.T)
-        except KeyError:
-            continue
-        # if ((match['pId'] in tforms.keys()) and (match['qId'] in tforms.keys())):
-        # t_p = (tforms[match['pId']])[-1].tform(pts_p.T)
-        # t_q = (tforms[match['qId']])[-1].tform(pts_q.T)
-
-        # find the mean spatial location of the point matches
-        # needed for seam detection
-        # positions = [[(a[0]+b[0])/2, (a[1]+b[1])/2] for a,b in zip(t_p, t_q)]
-        # TODO add this
-        positions = (t_p + t_q) / 2.
-
-        res = np.linalg.norm(t_p - t_q, axis=1)
-        rmse = np.true_divide(res, res.shape[0])
-
-        tile_residuals[match['pId']] = np.append(tile_residuals[match['pId']], res)
-        tile_rmse[match['pId']] = np.append(tile_rmse[match['pId']], rmse)
-        pt_match_positions[match['pId']] = np.append(pt_match_positions[match['pId']], positions, axis=0)
-
-    # remove empty entries from these dicts
-    empty_keys = [k for k in tile_residuals if tile_residuals[k].size == 0]
-    for k in empty_keys:
-        tile_residuals.pop(k)
-        tile_rmse.pop(k)
-        pt_match_positions.pop(k)
+    tile_residuals, tile_rmse, pt_match_positions = compute_match_residuals(
+        allmatches, tforms, min_points=min_points)
 
     statistics['tile_rmse'] = tile_rmse
     statistics['z'] = z
@@ -73,6 +36,151 @@ def compute_residuals_within_group(render, stack, matchCollectionOwner, matchCol
 
     return statistics, allmatches
 
+def transform_points_by_tile(pts, tile_index, tile_tforms):
+    """apply the last transform of each tile once to all of its points
+
+    Parameters
+    ----------
+    pts : numpy.ndarray
+        N x 2 array of points
+    tile_index : numpy.ndarray
+        length N integer array indexing tile_tforms for each point
+    tile_tforms : list
+        list of transform lists, the last of which is applied
+
+    Returns
+    -------
+    numpy.ndarray
+        N x 2 array of transformed points
+    """
+    out = np.empty(pts.shape, dtype=float)
+    order = np.argsort(tile_index, kind='mergesort')
+    tiles, starts = np.unique(tile_index[order], return_index=True)
+    for t, idx in zip(tiles, np.split(order, starts[1:])):
+        out[idx] = tile_tforms[t][-1].tform(pts[idx])
+    return out
+
+
+def match_columns(allmatches):
+    """gather point matches into flat columns
+
+    Parameters
+    ----------
+    allmatches : list of dict
+        point matches as returned by render
+
+    Returns
+    -------
+    pIds : numpy.ndarray
+        p tileId of each match
+    qIds : numpy.ndarray
+        q tileId of each match
+    counts : numpy.ndarray
+        number of points in each match
+    p : numpy.ndarray
+        sum(counts) x 2 array of p points in match order
+    q : numpy.ndarray
+        sum(counts) x 2 array of q points in match order
+    """
+    pIds = np.array([m['pId'] for m in allmatches], dtype=object)
+    qIds = np.array([m['qId'] for m in allmatches], dtype=object)
+    p_pts = [np.asarray(m['matches']['p'], dtype=float).reshape(2, -1).T
+             for m in allmatches]
+    q_pts = [np.asarray(m['matches']['q'], dtype=float).reshape(2, -1).T
+             for m in allmatches]
+    counts = np.array([len(pts) for pts in p_pts], dtype=int)
+    p = np.concatenate(p_pts) if p_pts else np.empty((0, 2))
+    q = np.concatenate(q_pts) if q_pts else np.empty((0, 2))
+    return pIds, qIds, counts, p, q
+
+
+def compute_column_residuals(pIds, qIds, counts, p, q, tforms, min_points=1):
+    """compute point match residuals grouped by the p tile of each match
+    from columnar matches (see match_columns)
+
+    Parameters
+    ----------
+    pIds, qIds, counts, p, q : numpy.ndarray
+        columnar point matches
+    tforms : dict
+        tileId: list of transforms, the last of which is applied
+    min_points : int
+        matches with fewer points are ignored
+
+    Returns
+    -------
+    tile_residuals : dict
+        pId: residual of each point, in match order
+    tile_rmse : dict
+        pId: residual divided by the number of points in its match
+    pt_match_positions : dict
+        pId: N x 2 mean transformed position of each point pair
+    """
+    tileIds = list(tforms.keys())
+    tile_lookup = {tileId: i for i, tileId in enumerate(tileIds)}
+
+    counts = np.asarray(counts, dtype=int)
+    pi = np.array([tile_lookup.get(t, -1) for t in pIds], dtype=int)
+    qi = np.array([tile_lookup.get(t, -1) for t in qIds], dtype=int)
+    valid = (counts >= min_points) & (pi >= 0) & (qi >= 0)
+    if not np.any(valid):
+        return {}, {}, {}
+
+    # match and tile index of each point
+    point_valid = np.repeat(valid, counts)
+    p_idx = np.repeat(pi[valid], counts[valid])
+    q_idx = np.repeat(qi[valid], counts[valid])
+    npts = np.repeat(counts[valid], counts[valid])
+    tile_tforms = [tforms[tileId] for tileId in tileIds]
+
+    t_p = transform_points_by_tile(
+        np.asarray(p)[point_valid], p_idx, tile_tforms)
+    t_q = transform_points_by_tile(
+        np.asarray(q)[point_valid], q_idx, tile_tforms)
+
+    # find the mean spatial location of the point matches
+    # needed for seam detection
+    positions = (t_p + t_q) / 2.
+    res = np.linalg.norm(t_p - t_q, axis=1)
+    rmse = np.true_divide(res, npts)
+
+    # split by p tile, keeping match order within each tile
+    order = np.argsort(p_idx, kind='mergesort')
+    tiles, starts = np.unique(p_idx[order], return_index=True)
+    tile_residuals, tile_rmse, pt_match_positions = {}, {}, {}
+    for t, idx in zip(tiles, np.split(order, starts[1:])):
+        tileId = tileIds[t]
+        tile_residuals[tileId] = res[idx]
+        tile_rmse[tileId] = rmse[idx]
+        pt_match_positions[tileId] = positions[idx]
+    return tile_residuals, tile_rmse, pt_match_positions
+
+
+def compute_match_residuals(allmatches, tforms, min_points=1):
+    """compute point match residuals grouped by the p tile of each match
+
+    Parameters
+    ----------
+    allmatches : list of dict
+        point matches as returned by render
+    tforms : dict
+        tileId: list of transforms, the last of which is applied
+    min_points : int
+        matches with fewer points are ignored
+
+    Returns
+    -------
+    tile_residuals : dict
+        pId: residual of each point, in match order
+    tile_rmse : dict
+        pId: residual divided by the number of points in its match
+    pt_match_positions : dict
+        pId: N x 2 mean transformed position of each point pair
+    """
+    return compute_column_residuals(
+        *match_columns(allmatches), tforms=tforms, min_points=min_points)
+
+
 def compute_mean_tile_residuals(residuals):
     tile_mean = {}
     
@@ -1,5 +1,6 @@
 
 import os
+import time
 import renderapi
 import glob
 import numpy as np
@@ -7,7 +8,7 @@ from ..module.render_module import RenderModule, RenderModuleException
 from rendermodules.rough_align.schemas import (
         ApplyRoughAlignmentTransformParameters,
         ApplyRoughAlignmentOutputParameters)
-from rendermodules.stack.consolidate_transforms import consolidate_transforms
+from rendermodules.stack.consolidate_transforms import consolidate_section_transforms
 from rendermodules.rough_align.downsample_mask_handler \
         import polygon_list_from_mask
 from functools import partial
@@ -159,20 +160,224 @@ def filter_highres_with_masks(resolved_highres, tspec_lowres, mask_map):
             255 - maskim,
             transforms=tspec_lowres.tforms)
 
+    # only tiles whose bounding box overlaps the bounding box of a
+    # mask polygon can intersect it
+    tile_corners = [
+        t.bbox_transformed(reference_tforms=resolved_highres.transforms)
+        for t in resolved_highres.tilespecs]
+    tile_bounds = np.array([
+        np.hstack([tc.min(axis=0), tc.max(axis=0)])
+        for tc in tile_corners]).reshape(-1, 4)
+    mask_bounds = np.array([
+        (np.inf, np.inf, -np.inf, -np.inf) if p.is_empty else p.bounds
+        for p in mask_polygons]).reshape(-1, 4)
+    candidates = (
+        (tile_bounds[:, np.newaxis, 0] <= mask_bounds[np.newaxis, :, 2]) &
+        (tile_bounds[:, np.newaxis, 2] >= mask_bounds[np.newaxis, :, 0]) &
+        (tile_bounds[:, np.newaxis, 1] <= mask_bounds[np.newaxis, :, 3]) &
+        (tile_bounds[:, np.newaxis, 3] >= mask_bounds[np.newaxis, :, 1]))
+
     new_highres = []
-    for t in resolved_highres.tilespecs:
-        tc = t.bbox_transformed(
-                    reference_tforms=resolved_highres.transforms)
-        tpoly = Polygon(tc).buffer(0)
-        pint = [not p.intersects(tpoly) for p in mask_polygons]
-        if np.all(pint):
-        #for p in mask_polygons:
-        #    if not p.intersects(tpoly):
-                new_highres.append(t)
+    for t, tc, cand in zip(
+            resolved_highres.tilespecs, tile_corners, candidates):
+        if cand.any():
+            tpoly = Polygon(tc).buffer(0)
+            if any(mask_polygons[i].intersects(tpoly)
+                   for i in np.flatnonzero(cand)):
+                continue
+        new_highres.append(t)
 
     return new_highres
 
 
+def scale_lowres_transforms(tforms, scale, apply_scale=False):
+    """scale the transforms of a lowres tilespec to highres coordinates
+    (in place)"""
+    for i, tf in enumerate(tforms):
+        if isinstance(tf, renderapi.transform.leaf.AffineModel):
+            # apply_scale in montagescape stack means
+            #   translation components are correct, otherwise
+            #   nonhomogeneous are correct
+            if apply_scale:
+                tf.M[0:2, 0:2] *= scale
+            else:
+                tf.M[:2, -1] /= scale
+        elif isinstance(
+                tf, renderapi.transform.leaf.ThinPlateSplineTransform):
+            if apply_scale:
+                raise ApplyRoughAlignmentException(
+                    "apply_scale is not implemented for "
+                    "ThinPlateSplineTransform.")
+            else:
+                tforms[i] = tf.scale_coordinates(1./scale)
+        else:
+            raise ApplyRoughAlignmentException(
+                "apply rough is not implemented for {}".format(
+                    tf.className))
+    return tforms
+
+
+def stack_section_bounds(render, stack, zvalues, session=None):
+    """bounds of sections of a stack from a single sectionData request
+
+    sections without bounds in the section data are requested
+    with get_bounds_from_z
+
+    Returns
+    -------
+    dict
+        z: {'minX', 'minY', 'maxX', 'maxY'}, or the exception raised
+        by get_bounds_from_z for sections whose bounds cannot be found
+    """
+    bounds = {}
+    for sd in render.run(
+            renderapi.stack.get_stack_sectionData, stack, session=session):
+        if any(sd.get(k) is None for k in ['minX', 'minY', 'maxX', 'maxY']):
+            continue
+        b = bounds.setdefault(sd['z'], dict(sd))
+        for k, f in [('minX', min), ('minY', min), ('maxX', max), ('maxY', max)]:
+            b[k] = f(b[k], sd[k])
+
+    out = {}
+    for z in zvalues:
+        if z not in bounds:
+            try:
+                bounds[z] = render.run(
+                    renderapi.stack.get_bounds_from_z, stack, z,
+                    session=session)
+            except Exception as e:
+                bounds[z] = e
+        out[z] = bounds[z]
+    return out
+
+
+def rough_align_section(render,
+                        input_stack,
+                        prealigned_stack,
+                        lowres_stack,
+                        scale,
+                        mask_input_dir,
+                        update_lowres_with_masks,
+                        read_masks_from_lowres_stack,
+                        filter_montage_output_with_masks,
+                        mask_exts,
+                        Z,
+                        lowres_ts,
+                        sectionbounds,
+                        presectionbounds,
+                        apply_scale=False,
+                        consolidateTransforms=True,
+                        remap_section_ids=False,
+                        session=None):
+    """rough aligned highres tilespecs of a section
+
+    Parameters
+    ----------
+    Z : list
+        [z in the montage stack, z in the lowres stack]
+    lowres_ts : list of renderapi.tilespec.TileSpec
+        tilespecs of the section in the lowres stack
+    sectionbounds : dict
+        bounds of the section in input_stack
+    presectionbounds : dict
+        bounds of the section in prealigned_stack
+
+    Returns
+    -------
+    tilespecs : list of renderapi.tilespec.TileSpec
+        rough aligned tilespecs
+    sharedTransforms : list
+        shared transforms referenced by the tilespecs
+    timings : dict
+        seconds spent fetching, transforming and filtering the section
+    """
+    z = Z[0] # z value from the montage stack - to be mapped to the newz values in lowres stack
+    newz = Z[1] # z value in the lowres stack for this montage
+    timings = {'fetch': 0.0, 'transform': 0.0, 'filter': 0.0}
+
+    t0 = time.time()
+    mask_map = get_mask_paths(
+            mask_input_dir,
+            lowres_ts,
+            read_masks_from_lowres_stack)
+
+    if (not read_masks_from_lowres_stack) & \
+            update_lowres_with_masks:
+        add_masks_to_lowres(render, lowres_stack, newz, mask_map)
+
+    logger.debug('getting tilespecs from {} z={}'.format(input_stack, z))
+    resolved_highrests1 = render.run(
+        renderapi.resolvedtiles.get_resolved_tiles_from_z,
+        input_stack, z, session=session)
+    highres_ts1 = resolved_highrests1.tilespecs
+    sharedTransforms_highrests1 = resolved_highrests1.transforms
+    timings['fetch'] = time.time() - t0
+
+    t0 = time.time()
+    # get the lowres stack rough alignment transformation
+    tforms = scale_lowres_transforms(lowres_ts[0].tforms, scale, apply_scale)
+
+    tx = 0
+    ty = 0
+    if input_stack == prealigned_stack:
+        tx = -int(sectionbounds['minX'])  # - int(prestackbounds['minX'])
+        ty = -int(sectionbounds['minY'])  # - int(prestackbounds['minY'])
+    else:
+        tx = int(sectionbounds['minX']) - int(presectionbounds['minX'])
+        ty = int(sectionbounds['minY']) - int(presectionbounds['minY'])
+
+    translation_tform = renderapi.transform.AffineModel(B0=tx, B1=ty)
+
+    ftform = [translation_tform] + tforms
+
+    for t in highres_ts1:
+        for f in ftform:
+            t.tforms.append(f)
+        t.z = newz
+        if remap_section_ids:
+            t.layout.sectionId = "%s.0"%str(int(newz))
+    if consolidateTransforms:
+        new_tforms_list = consolidate_section_transforms(
+            [t.tforms for t in highres_ts1], sharedTransforms_highrests1,
+            keep_ref_tforms=True)
+        for t, newt in zip(highres_ts1, new_tforms_list):
+            t.tforms = newt
+    timings['transform'] = time.time() - t0
+
+    if filter_montage_output_with_masks:
+        t0 = time.time()
+        # tf.M[0:2, 0:2] /= scale
+
+        # prepend a scaling transformation to the scaled transforms
+        #   to map mask coordinates correctly
+        lowres_ts[0].tforms.insert(0, renderapi.transform.AffineModel(
+           M00=1./scale, M11=1./scale))
+
+        resolved_highrests1.tilespecs = highres_ts1
+        highres_ts1 = filter_highres_with_masks(
+                resolved_highrests1,
+                lowres_ts[0],
+                mask_map)
+        timings['filter'] = time.time() - t0
+
+    return highres_ts1, sharedTransforms_highrests1, timings
+
+
+def rough_align_section_job(render, section_args, section_kwargs, job):
+    """rough_align_section for a prefetched
+    (Z, lowres_ts, sectionbounds, presectionbounds) job, returning
+    (Z, result) with the exception as result instead of raising it"""
+    session = requests.session()
+    try:
+        return job[0], rough_align_section(
+            render, *(list(section_args) + list(job)),
+            session=session, **section_kwargs)
+    except Exception as e:
+        return job[0], e
+    finally:
+        session.close()
+
+
 def apply_rough_alignment(render,
                           input_stack,
                           prealigned_stack,
@@ -202,44 +407,6 @@ def apply_rough_alignment(render,
                             newz,
                             session=session)
 
-        mask_map = get_mask_paths(
-                mask_input_dir,
-                lowres_ts,
-                read_masks_from_lowres_stack)
-
-        if (not read_masks_from_lowres_stack) & \
-                update_lowres_with_masks:
-            add_masks_to_lowres(render, lowres_stack, newz, mask_map)
-
-        # get the lowres stack rough alignment transformation
-        tforms = lowres_ts[0].tforms
-
-        # if all_transforms:
-        #     tforms = consolidate_transforms(tforms)
-
-        # tf = tforms[-1]
-        for i, tf in enumerate(tforms):
-            if isinstance(tf, renderapi.transform.leaf.AffineModel):
-                # apply_scale in montagescape stack means
-                #   translation components are correct, otherwise
-                #   nonhomogeneous are correct
-                if apply_scale:
-                    tf.M[0:2, 0:2] *= scale
-                else:
-                    tf.M[:2, -1] /= scale
-            elif isinstance(
-                    tf, renderapi.transform.leaf.ThinPlateSplineTransform):
-                if apply_scale:
-                    raise ApplyRoughAlignmentException(
-                        "apply_scale is not implemented for "
-                        "ThinPlateSplineTransform.")
-                else:
-                    tforms[i] = tf.scale_coordinates(1./scale)
-            else:
-                raise ApplyRoughAlignmentException(
-                    "apply rough is not implemented for {}".format(
-                        tf.className))
-
         sectionbounds = render.run(
                                 renderapi.stack.get_bounds_from_z,
                                 input_stack,
@@ -252,57 +419,17 @@ def apply_rough_alignment(render,
                                     z,
                                     session=session)
 
-        tx = 0
-        ty = 0
-        if input_stack == prealigned_stack:
-            tx = -int(sectionbounds['minX'])  # - int(prestackbounds['minX'])
-            ty = -int(sectionbounds['minY'])  # - int(prestackbounds['minY'])
-        else:
-            tx = int(sectionbounds['minX']) - int(presectionbounds['minX'])
-            ty = int(sectionbounds['minY']) - int(presectionbounds['minY'])
-
-        translation_tform = renderapi.transform.AffineModel(B0=tx, B1=ty)
-
-        ftform = [translation_tform] + tforms
-        logger.debug('getting tilespecs from {} z={}'.format(lowres_stack, z))
-        """
-        highres_ts1 = render.run(
-                            renderapi.tilespec.get_tile_specs_from_z,
-                            input_stack,
-                            z,
-                            session=session)
-        """
-        resolved_highrests1 = render.run(
-            renderapi.resolvedtiles.get_resolved_tiles_from_z,
-            input_stack, z, session=session)
-        highres_ts1 = resolved_highrests1.tilespecs
-        sharedTransforms_highrests1 = resolved_highrests1.transforms
-
-        for t in highres_ts1:
-            for f in ftform:
-                t.tforms.append(f)
-            if consolidateTransforms:
-                newt = consolidate_transforms(
-                    t.tforms, sharedTransforms_highrests1,
-                    keep_ref_tforms=True)
-                t.tforms = newt
-            t.z = newz
-            if remap_section_ids:
-                t.layout.sectionId = "%s.0"%str(int(newz))
-
-        if filter_montage_output_with_masks:
-            # tf.M[0:2, 0:2] /= scale
-
-            # prepend a scaling transformation to the scaled transforms
-            #   to map mask coordinates correctly
-            lowres_ts[0].tforms.insert(0, renderapi.transform.AffineModel(
-               M00=1./scale, M11=1./scale))
-
-            resolved_highrests1.tilespecs = highres_ts1
-            highres_ts1 = filter_highres_with_masks(
-                    resolved_highrests1,
-                    lowres_ts[0],
-                    mask_map)
+        highres_ts1, sharedTransforms_highrests1, timings = \
+            rough_align_section(
+                render, input_stack, prealigned_stack, lowres_stack,
+                scale, mask_input_dir, update_lowres_with_masks,
+                read_masks_from_lowres_stack,
+                filter_montage_output_with_masks, mask_exts,
+                Z, lowres_ts, sectionbounds, presectionbounds,
+                apply_scale=apply_scale,
+                consolidateTransforms=consolidateTransforms,
+                remap_section_ids=remap_section_ids,
+                session=session)
 
         renderapi.client.import_tilespecs(
             output_stack, highres_ts1,
@@ -327,24 +454,6 @@ class ApplyRoughAlignmentTransform(RenderModule):
              zip(self.args['old_z'], self.args['new_z'])
              if a in allzvalues]
 
-        mypartial = partial(
-                        apply_rough_alignment,
-                        self.render,
-                        self.args['montage_stack'],
-                        self.args['prealigned_stack'],
-                        self.args['lowres_stack'],
-                        self.args['output_stack'],
-                        self.args['tilespec_directory'],
-                        self.args['scale'],
-                        self.args['mask_input_dir'],
-                        self.args['update_lowres_with_masks'],
-                        self.args['read_masks_from_lowres_stack'],
-                        self.args['filter_montage_output_with_masks'],
-                        self.args['mask_exts'],
-                        apply_scale=self.args['apply_scale'],
-                        consolidateTransforms=self.args['consolidate_transforms'],
-                        remap_section_ids=self.args['remap_section_ids'])
-
         # Create the output stack if it doesn't exist
         if self.args['output_stack'] not in self.render.run(
                 renderapi.render.get_stacks_by_owner_project):
@@ -362,14 +471,97 @@ class ApplyRoughAlignmentTransform(RenderModule):
                 renderapi.stack.get_full_stack_metadata,
                 self.args['lowres_stack'])['state']
 
+        # wall clock seconds of the stages run by this process and
+        # seconds summed over all pool workers of the section stages
+        timings = {k: 0.0 for k in
+                   ['prefetch', 'import', 'total', 'worker_fetch',
+                    'worker_transform', 'worker_filter']}
+
+        # prefetch lowres tilespecs and section bounds for all z
+        t0 = tstart = time.time()
+        newzs = set(b for a, b in Z)
+        lowres_specs = {}
+        for ts in self.render.run(
+                renderapi.tilespec.get_tile_specs_from_stack,
+                self.args['lowres_stack']):
+            if ts.z in newzs:
+                lowres_specs.setdefault(ts.z, []).append(ts)
+        oldzs = [a for a, b in Z]
+        sectionbounds = stack_section_bounds(
+                self.render, self.args['montage_stack'], oldzs)
+        presectionbounds = sectionbounds
+        if self.args['prealigned_stack'] != self.args['montage_stack']:
+            presectionbounds = stack_section_bounds(
+                    self.render, self.args['prealigned_stack'], oldzs)
+        # sections whose bounds cannot be found fail without a job
+        failed_zs = []
+        jobs = []
+        for z in Z:
+            bounds = (sectionbounds[z[0]], presectionbounds[z[0]])
+            errors = [b for b in bounds if isinstance(b, Exception)]
+            if errors:
+                failed_zs.append((errors[0], z))
+                continue
+            jobs.append((z, lowres_specs.get(z[1], [])) + bounds)
+        timings['prefetch'] = time.time() - t0
+
+        mypartial = partial(
+                        rough_align_section_job,
+                        self.render,
+                        (self.args['montage_stack'],
+                         self.args['prealigned_stack'],
+                         self.args['lowres_stack'],
+                         self.args['scale'],
+                         self.args['mask_input_dir'],
+                         self.args['update_lowres_with_masks'],
+                         self.args['read_masks_from_lowres_stack'],
+                         self.args['filter_montage_output_with_masks'],
+                         self.args['mask_exts']),
+                        {'apply_scale': self.args['apply_scale'],
+                         'consolidateTransforms':
+                             self.args['consolidate_transforms'],
+                         'remap_section_ids': self.args['remap_section_ids']})
+
+        batch = []
+        shared = {}
+
+        def import_batch():
+            t0 = time.time()
+            renderapi.client.import_tilespecs_parallel(
+                self.args['output_stack'], batch,
+                sharedTransforms=list(shared.values()) or None,
+                poolsize=self.args['pool_size'], render=self.render,
+                close_stack=False)
+            timings['import'] += time.time() - t0
+            del batch[:]
+            shared.clear()
+
+        # rough align sections in the pool, importing in batches
         with renderapi.client.WithPool(self.args['pool_size']) as pool:
-            results = pool.map(mypartial, Z)
+            for i, (z, result) in enumerate(
+                    pool.imap_unordered(mypartial, jobs)):
+                if isinstance(result, Exception):
+                    failed_zs.append((result, z))
+                    continue
+                tilespecs, sharedTransforms, section_timings = result
+                for k, v in section_timings.items():
+                    timings['worker_' + k] += v
+                batch += tilespecs
+                for tf in (sharedTransforms or []):
+                    shared[tf.transformId] = tf
+                if len(batch) >= self.args['import_batch_size']:
+                    import_batch()
+                logger.debug('rough aligned {} of {} sections'.format(
+                    i + 1, len(jobs)))
+            if batch:
+                import_batch()
+
+        timings['total'] = time.time() - tstart
+        logger.info('rough alignment timings (s): {}'.format(
+            ', '.join('{}: {:.2f}'.format(k, v) for k, v in timings.items())))
 
         # raise an exception if all the z values to apply alignment were not
-        if not all([r is None for r in results]):
-            failed_zs = [(result, z)
-                         for result, z in
-                         zip(results, Z) if result is not None]
+        if failed_zs:
             raise RenderModuleException(
                     "Failed to rough align z values {}".format(failed_zs))
 
@@ -390,7 +582,8 @@ class ApplyRoughAlignmentTransform(RenderModule):
 
         self.output({
             'zs': np.array(Z),
-            'output_stack': self.args['output_stack']})
+            'output_stack': self.args['output_stack'],
+            'timings': timings})
 
 
 if __name__ == "__main__":
@@ -10,7 +10,15 @@ import pathlib2 as pathlib
 import numpy as np
 import cv2
 from six.moves import urllib
-from shapely.geometry import Polygon, Point
+from shapely.geometry import Polygon
+import shapely
+
+try:
+    contains_xy = shapely.contains_xy
+except AttributeError:
+    # shapely < 2.0
+    import shapely.vectorized
+    contains_xy = shapely.vectorized.contains
 
 
 example = {
@@ -45,12 +53,10 @@ def polygon_list_from_mask(mask, transforms=None):
         shapely polygons which outline regions where mask is non-zero
         Render retains parts of image where mask==255
     """
-    # openCV >= 4.0:
-    # contours, _ = cv2.findContours(
-    #         mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    # openCV < 4.0:
-    _, contours, _ = cv2.findContours(
-            mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    # openCV < 4.0 returns (image, contours, hierarchy),
+    # openCV >= 4.0 (contours, hierarchy)
+    contours = cv2.findContours(
+            mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2]
     contours = [c.squeeze().astype('float') for c in contours]
     if transforms:
         for i in range(len(contours)):
@@ -76,10 +82,11 @@ def points_in_mask(mask, pts):
         0.0 = point is inside of zero-value mask region
         Render retains parts of image where mask==255
     """
+    x, y = np.array(pts, dtype=float).reshape(2, -1)
     mask_list = []
     for maskpoly in polygon_list_from_mask(mask):
-        mask_list += [1.0 if maskpoly.contains(Point(pt)) else 0.0
-                      for pt in np.array(pts).transpose()]
+        inside = contains_xy(maskpoly, x, y)
+        mask_list += np.where(inside, 1.0, 0.0).tolist()
     return mask_list
 
 
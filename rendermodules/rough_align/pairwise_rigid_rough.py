@@ -1,6 +1,7 @@
 import renderapi
 import numpy as np
 import json
+from multiprocessing.pool import ThreadPool
 from rendermodules.module.render_module import (
         StackTransitionModule,
         RenderModuleException)
@@ -47,17 +48,94 @@ def avg_residual(match, ptilespec, qtilespec):
     return res.mean()
 
 
-def tspecjob(collection, render, tilespecs, estimate=True):
+class MatchIndex(object):
+    """in-memory index of cross-section point matches keyed by
+    (pGroupId, qGroupId)
+
+    Matches are fetched in bulk, one matchesOutsideGroup request per
+    section pair, concurrently.  matchesOutsideGroup returns the matches
+    with the group on either side, so a match between two fetched groups
+    is returned twice and is only indexed once.  Pairs not found after
+    prefetching are fetched group to group on lookup.
+
+    Parameters
+    ----------
+    collection : str
+        point match collection name
+    render : renderapi.render.RenderClient
+        render connection
+    owner : str
+        match collection owner (render.DEFAULT_OWNER if None)
+    """
+    def __init__(self, collection, render, owner=None):
+        self.collection = collection
+        self.render = render
+        self.owner = owner
+        self.index = {}
+        self.indexed = set()
+        self.fetched_groups = set()
+
+    def add(self, matches):
+        for m in matches:
+            key = (m['pGroupId'], m['pId'], m['qGroupId'], m['qId'])
+            if key in self.indexed:
+                continue
+            self.indexed.add(key)
+            self.index.setdefault(
+                (m['pGroupId'], m['qGroupId']), []).append(m)
+
+    def _outside_group(self, groupId):
+        return renderapi.pointmatch.get_matches_outside_group(
+            self.collection, groupId, owner=self.owner, render=self.render)
+
+    def prefetch(self, group_pairs, nthreads=20):
+        """fetch all matches needed for a list of (groupId, groupId) pairs"""
+        groups = sorted(set(
+            min(str(a), str(b)) for a, b in group_pairs) -
+            self.fetched_groups)
+        if not groups:
+            return
+        tpool = ThreadPool(max(1, min(nthreads, len(groups))))
+        try:
+            for groupId, matches in zip(
+                    groups, tpool.imap(self._outside_group, groups)):
+                self.add(matches)
+                self.fetched_groups.add(groupId)
+        finally:
+            tpool.close()
+            tpool.join()
+
+    def group_matches(self, group0, group1):
+        """matches between two groups in either order"""
+        group0, group1 = str(group0), str(group1)
+        keys = [(group0, group1), (group1, group0)]
+        if not any(k in self.index for k in keys):
+            self.add(renderapi.pointmatch.get_matches_from_group_to_group(
+                self.collection, group0, group1,
+                owner=self.owner, render=self.render))
+            self.index.setdefault(keys[0], [])
+        return [m for k in keys for m in self.index.get(k, [])]
+
+    def tile_matches(self, tilespec0, tilespec1):
+        """matches between two tiles in either order"""
+        ids = set([tilespec0.tileId, tilespec1.tileId])
+        return [m for m in self.group_matches(
+                    tilespec0.layout.sectionId, tilespec1.layout.sectionId)
+                if set([m['pId'], m['qId']]) == ids]
+
+
+def tspecjob(collection, render, tilespecs, estimate=True, matches=None):
     result = {}
     result['tilespecs'] = tilespecs
 
-    matches = renderapi.pointmatch.get_matches_from_tile_to_tile(
-            collection,
-            tilespecs[0].layout.sectionId,
-            tilespecs[0].tileId,
-            tilespecs[1].layout.sectionId,
-            tilespecs[1].tileId,
-            render=render)
+    if matches is None:
+        matches = renderapi.pointmatch.get_matches_from_tile_to_tile(
+                collection,
+                tilespecs[0].layout.sectionId,
+                tilespecs[0].tileId,
+                tilespecs[1].layout.sectionId,
+                tilespecs[1].tileId,
+                render=render)
 
     if len(matches) != 1:
         estr = "\n  expected 1 matching tile pair, found %d for" % (
@@ -95,6 +173,12 @@ def tspecjob(collection, render, tilespecs, estimate=True):
     return result
 
 
+def pairjob(collection, render, estimate, job):
+    tilespecs, matches = job
+    return tspecjob(
+            collection, render, tilespecs, estimate=estimate, matches=matches)
+
+
 def get_zrange_with_skipped(gapfile, zin):
     if gapfile is None:
         return zin
@@ -108,6 +192,71 @@ def get_zrange_with_skipped(gapfile, zin):
     return zout
 
 
+def chain_transforms(M0, Ms):
+    """cumulative compositions M0.Ms[0], M0.Ms[0].Ms[1], ...
+
+    computed as a log-depth prefix scan over the stacked matrices
+
+    Parameters
+    ----------
+    M0 : numpy.ndarray
+        3 x 3 starting transform
+    Ms : numpy.ndarray
+        N x 3 x 3 pairwise transforms
+
+    Returns
+    -------
+    numpy.ndarray
+        N x 3 x 3 composed transforms
+    """
+    P = np.array(Ms, dtype=float).reshape(-1, 3, 3)
+    shift = 1
+    while shift < P.shape[0]:
+        P[shift:] = np.matmul(P[:-shift], P[shift:])
+        shift *= 2
+    return np.matmul(M0, P)
+
+
+def average_transforms(zs, dists, Ms):
+    """distance weighted average of the transforms estimated for each z
+
+    a transform estimated d sections away from its anchor gets weight
+    (dsum - d) / dsum, where dsum sums d over the estimates of that z.
+    Single estimates, or estimates that are all anchors, are kept.
+
+    Parameters
+    ----------
+    zs : numpy.ndarray
+        z value of each estimate
+    dists : numpy.ndarray
+        distance of each estimate from its anchor
+    Ms : numpy.ndarray
+        N x 3 x 3 transform of each estimate
+
+    Returns
+    -------
+    first : numpy.ndarray
+        index of the first estimate of each unique z, in z order
+    M : numpy.ndarray
+        averaged 3 x 3 transform of each unique z
+    """
+    dists = np.asarray(dists, dtype=float)
+    Ms = np.asarray(Ms, dtype=float).reshape(-1, 3, 3)
+    _, first, inv = np.unique(zs, return_index=True, return_inverse=True)
+    inv = inv.ravel()
+    count = np.bincount(inv)
+    dsum = np.bincount(inv, weights=dists)
+
+    d = dsum[inv]
+    w = np.divide(d - dists, d, out=np.zeros_like(d), where=d != 0)
+    M = np.zeros((first.size, 3, 3))
+    np.add.at(M, inv, w[:, np.newaxis, np.newaxis] * Ms)
+
+    keep = (count == 1) | (dsum == 0)
+    M[keep] = Ms[first[keep]]
+    return first, M
+
+
 def translate_to_positive(tilespecs, translation_buffer):
     xymin = np.array([
         t.bbox_transformed(
@@ -126,6 +275,9 @@ class PairwiseRigidRoughAlignment(StackTransitionModule):
     default_output_schema = PairwiseRigidOutputSchema
 
     def run(self):
+        self.match_index = MatchIndex(
+                self.args['match_collection'], self.render)
+
         z_overlap = self.get_overlapping_inputstack_zvalues(
                 zvalues=range(self.args['minZ'], self.args['maxZ'] + 1))
         self.args['zValues'] = np.array(get_zrange_with_skipped(
@@ -167,30 +319,25 @@ class PairwiseRigidRoughAlignment(StackTransitionModule):
                 "z_values": np.sort((self.args['zValues'][zfor])),
                 "anchor": anchor_specs[i]})
 
-        new_specs = []
+        specs = []
+        Ms = []
+        dists = []
         for c in clumps:
-            a = self.pairwise_estimate(c['anchor'], c['z_values'])
-            new_specs += a
+            cspecs, cMs, cdists = self.pairwise_estimate(
+                    c['anchor'], c['z_values'])
+            specs += cspecs
+            Ms.append(cMs)
+            dists.append(cdists)
 
-        nzs = np.array([n['spec'].z for n in new_specs])
-        unzs = np.unique(nzs)
+        first, M = average_transforms(
+                np.array([t.z for t in specs]),
+                np.concatenate(dists),
+                np.concatenate(Ms))
 
         averaged_new_specs = []
-        for unz in unzs:
-            ind = np.argwhere(nzs == unz).flatten()
-            if ind.size == 1:
-                averaged_new_specs.append(new_specs[ind[0]]['spec'])
-            else:
-                dsum = np.array([new_specs[i]['dist'] for i in ind]).sum()
-                if dsum == 0:
-                    averaged_new_specs.append(new_specs[ind[0]]['spec'])
-                else:
-                    M = np.zeros((3, 3))
-                    for i in ind:
-                        w = (dsum - new_specs[i]['dist']) / float(dsum)
-                        M += w * new_specs[i]['spec'].tforms[0].M
-                    averaged_new_specs.append(new_specs[ind[0]]['spec'])
-                    averaged_new_specs[-1].tforms[0].M = M
+        for i, m in zip(first, M):
+            averaged_new_specs.append(specs[i])
+            averaged_new_specs[-1].tforms[0].M = m
 
         if self.args['translate_to_positive']:
             averaged_new_specs = translate_to_positive(
@@ -207,21 +354,14 @@ class PairwiseRigidRoughAlignment(StackTransitionModule):
         tilespecs = renderapi.tilespec.get_tile_specs_from_stack(
                 self.output_stack, render=self.render)
 
-        check_func = partial(
-                tspecjob,
-                self.args['match_collection'],
-                self.render,
-                estimate=False)
         fargs = [[
                     tilespecs[i - 1],
                     tilespecs[i],
                     ] for i in range(1, len(tilespecs))]
+        results = self.pair_jobs(fargs, estimate=False)
 
-        with renderapi.client.WithPool(self.args['pool_size']) as pool:
-            result = {}
-            result['residuals'] = []
-            for r in pool.map(check_func, fargs):
-                    result['residuals'].append(r['avg_residual'])
+        result = {}
+        result['residuals'] = [r['avg_residual'] for r in results]
 
         zall = np.arange(
                 self.args['minZ'],
@@ -236,40 +376,64 @@ class PairwiseRigidRoughAlignment(StackTransitionModule):
         return result
 
     def pairwise_estimate(self, anchor_spec, z_values):
+        """tilespecs of z_values chained to anchor_spec
+
+        Returns
+        -------
+        tilespecs : list
+            anchor_spec followed by the tilespecs of z_values, which have
+            a placeholder RigidModel transform
+        Ms : numpy.ndarray
+            N x 3 x 3 chained transform of each tilespec
+        dists : numpy.ndarray
+            z distance of each tilespec from anchor_spec
+        """
         tilespecs = [anchor_spec]
-        for z in z_values:
-            tilespecs += renderapi.tilespec.get_tile_specs_from_z(
-                     self.args['input_stack'],
-                     z,
-                     render=self.render)
+        get_specs = partial(
+                renderapi.tilespec.get_tile_specs_from_z,
+                self.args['input_stack'],
+                render=self.render)
+        tpool = ThreadPool(max(1, min(self.args['pool_size'], len(z_values))))
+        try:
+            for specs in tpool.imap(get_specs, z_values):
+                tilespecs += specs
+        finally:
+            tpool.close()
+            tpool.join()
 
         # accumulate transforms (zs = Identity)
-        estimate_func = partial(
-                tspecjob,
-                self.args['match_collection'],
-                self.render,
-                estimate=True)
         fargs = [[
                     tilespecs[i - 1],
                     tilespecs[i],
                     ] for i in range(1, len(tilespecs))]
-
-        M = anchor_spec.tforms[0].M
-        new_tilespecs = [{
-            'spec': anchor_spec,
-            'dist': 0}]
+        results = self.pair_jobs(fargs, estimate=True)
+
+        Ms = np.concatenate([
+                anchor_spec.tforms[0].M[np.newaxis],
+                chain_transforms(
+                    anchor_spec.tforms[0].M,
+                    [r['transform'].M for r in results])])
+        dists = np.abs(np.array([t.z for t in tilespecs]) - anchor_spec.z)
+        for ts in tilespecs[1:]:
+            ts.tforms = [renderapi.transform.RigidModel()]
+
+        return tilespecs, Ms, dists.astype(int)
+
+    def pair_jobs(self, fargs, estimate=True):
+        """run tspecjob on tilespec pairs with matches from the shared
+        match index"""
+        self.match_index.prefetch(
+                [(a.layout.sectionId, b.layout.sectionId) for a, b in fargs],
+                nthreads=self.args['pool_size'])
+        func = partial(
+                pairjob,
+                self.args['match_collection'],
+                self.render,
+                estimate)
+        fargs = [[[a, b], self.match_index.tile_matches(a, b)]
+                 for a, b in fargs]
         with renderapi.client.WithPool(self.args['pool_size']) as pool:
-            for result in pool.map(estimate_func, fargs):
-                M = M.dot(result['transform'].M)
-                newtf = renderapi.transform.RigidModel()
-                newtf.M = M
-                ts = result['tilespecs'][1]
-                ts.tforms = [newtf]
-                new_tilespecs.append({
-                    'spec': renderapi.tilespec.TileSpec(json=ts.to_dict()),
-                    'dist': int(np.abs(ts.z - anchor_spec.z))})
-
-        return new_tilespecs
+            return pool.map(func, fargs)
 
 
 if __name__ == '__main__':
@@ -218,6 +218,12 @@ class ApplyRoughAlignmentTransformParameters(RenderParameters):
         required=False,
         default=['png', 'tif'],
         description="what kind of mask files to recognize")
+    import_batch_size = Int(
+        required=False,
+        default=5000,
+        missing=5000,
+        description=("number of rough aligned tilespecs to import "
+                     "into output_stack at once"))
     close_stack = argschema.fields.Bool(
         required=False, default=True,
         missing=True, description=(
@@ -339,6 +345,12 @@ class ApplyRoughAlignmentOutputParameters(DefaultSchema):
             description="list of z values that were applied to")
     output_stack = argschema.fields.Str(
             description="stack where applied transforms were set")
+    timings = argschema.fields.Dict(
+            required=False,
+            description="wall clock seconds of the prefetch, import and total "
+                        "stages of the rough alignment and seconds summed over "
+                        "all pool workers of the worker_fetch, worker_transform "
+                        "and worker_filter stages")
 
 
 class DownsampleMaskHandlerSchema(RenderParameters):
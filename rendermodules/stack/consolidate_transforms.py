@@ -32,19 +32,28 @@ def flatten_tforms(tforms):
     return flat_tforms
 
 
+def reference_index(ref_tforms):
+    """dict of reference transforms by transformId"""
+    if isinstance(ref_tforms, dict):
+        return ref_tforms
+    ref_index = {}
+    for mt in (ref_tforms or []):
+        ref_index.setdefault(mt.transformId, mt)
+    return ref_index
+
+
 def dereference_tforms(tforms, ref_tforms):
+    ref_index = reference_index(ref_tforms)
     deref_tforms = []
     for tf in tforms:
         if isinstance(tf, ReferenceTransform):
             try:
-                mtf = next(
-                    mt for mt in ref_tforms if mt.transformId == tf.refId)
-                deref_tforms.append(mtf)
-            except StopIteration as e:
+                deref_tforms.append(ref_index[tf.refId])
+            except KeyError as e:
                 raise RenderModuleException(
                     ("reference transform: {} not found in provided refererence transforms {}".format(
                                                                                                 tf.refId,
-                                                                                                ref_tforms)))
+                                                                                                list(ref_index.values()))))
         else:
             deref_tforms.append(tf)
     return deref_tforms
@@ -57,55 +66,129 @@ def flatten_and_dereference_tforms(tforms, ref_tforms):
     return deref_tforms
 
 
-def consolidate_transforms(tforms, ref_tforms=[], logger=logging.getLogger(),
-                           makePolyDegree=0, keep_ref_tforms=False):
-    # first flatten and dereference this transform list
-    tforms = (flatten_and_dereference_tforms(tforms, ref_tforms)
-              if not keep_ref_tforms else flatten_tforms(tforms))
-    tform_total = AffineModel()
-    start_index = 0
-    total_affines = 0
-    new_tform_list = []
-
-    for i, tform in enumerate(tforms):
-        try:
-            isaffine = 'AffineModel2D' in tform.className
-        except AttributeError:
-            isaffine = False
-        if isaffine:
-            total_affines += 1
-            tform_total = tform.concatenate(tform_total)
-            # tform_total.M=tform.M.dot(tform_total.M)
+def is_affine(tform):
+    try:
+        return 'AffineModel2D' in tform.className
+    except AttributeError:
+        return False
+
+
+def affine_tform(M, makePolyDegree=0):
+    """AffineModel (or Polynomial2DTransform of makePolyDegree > 0)
+    from a 3 x 3 matrix"""
+    tform = AffineModel(M[0, 0], M[0, 1], M[1, 0], M[1, 1], M[0, 2], M[1, 2])
+    if makePolyDegree > 0:
+        tform = Polynomial2DTransform().fromAffine(tform)
+        tform = tform.asorder(makePolyDegree)
+    return tform
+
+
+def consolidate_runs(tforms, logger=logging.getLogger()):
+    """combine runs of affines in a flat transform list
+
+    Returns
+    -------
+    list
+        3 x 3 matrix for each run of affines, the transform itself
+        for each other transform
+    """
+    runs = []
+    M = None
+    for tform in tforms:
+        if is_affine(tform):
+            M = tform.M if M is None else tform.M.dot(M)
         else:
             logger.debug('consolidate_transforms: non affine {}'.format(tform))
-            if total_affines > 0:
-                if makePolyDegree > 0:
-                    polyTform = Polynomial2DTransform().fromAffine(tform_total)
-                    polyTform = polyTform.asorder(makePolyDegree)
-                    new_tform_list.append(polyTform)
-                else:
-                    new_tform_list.append(tform_total)
-                tform_total = AffineModel()
-                total_affines = 0
-            new_tform_list.append(tform)
-    if total_affines > 0:
-        if makePolyDegree > 0:
-            polyTform = Polynomial2DTransform().fromAffine(tform_total)
-            polyTform = polyTform.asorder(makePolyDegree)
-            new_tform_list.append(polyTform)
+            if M is not None:
+                runs.append(M)
+                M = None
+            runs.append(tform)
+    if M is not None:
+        runs.append(M)
+    return runs
+
+
+def consolidate_section_transforms(tforms_list, ref_tforms=[],
+                                   logger=logging.getLogger(),
+                                   makePolyDegree=0, keep_ref_tforms=False):
+    """consolidate_transforms for the transform lists of many tiles
+
+    Tiles of a section mostly differ only in their first transform, so
+    the remainder of each transform list is consolidated once per
+    distinct remainder and the first affine of all tiles sharing it is
+    composed with it as one stacked matrix product.
+
+    Parameters
+    ----------
+    tforms_list : list of list of renderapi.transform.Transform
+        transform list of each tile
+    ref_tforms : list or dict
+        reference transforms, or a dict of them by transformId
+    logger : logging.Logger
+        logger
+    makePolyDegree : int
+        convert affines to Polynomial2DTransforms of this degree if > 0
+    keep_ref_tforms : bool
+        do not dereference ReferenceTransforms
+
+    Returns
+    -------
+    list of list of renderapi.transform.Transform
+        consolidated transform list of each tile
+    """
+    ref_index = None if keep_ref_tforms else reference_index(ref_tforms)
+
+    # group tiles by the transforms following their first affine
+    heads = []
+    groups = {}
+    for i, tforms in enumerate(tforms_list):
+        tforms = (flatten_and_dereference_tforms(tforms, ref_index)
+                  if not keep_ref_tforms else flatten_tforms(tforms))
+        head = tforms[0] if (tforms and is_affine(tforms[0])) else None
+        tail = tforms[1:] if head is not None else tforms
+        heads.append(head)
+        key = (head is not None,) + tuple(id(tf) for tf in tail)
+        if key not in groups:
+            groups[key] = (consolidate_runs(tail, logger), [])
+        groups[key][1].append(i)
+
+    new_tforms_list = [None] * len(tforms_list)
+    for runs, ind in groups.values():
+        rest = runs
+        if heads[ind[0]] is None:
+            firsts = [None] * len(ind)
         else:
-            new_tform_list.append(tform_total)
-    return new_tform_list
+            Ms = np.array([heads[i].M for i in ind])
+            if runs and isinstance(runs[0], np.ndarray):
+                Ms = np.matmul(runs[0], Ms)
+                rest = runs[1:]
+            firsts = [affine_tform(M, makePolyDegree) for M in Ms]
+        for i, first in zip(ind, firsts):
+            new_tforms = [] if first is None else [first]
+            new_tforms += [
+                affine_tform(r, makePolyDegree)
+                if isinstance(r, np.ndarray) else r for r in rest]
+            new_tforms_list[i] = new_tforms
+    return new_tforms_list
+
+
+def consolidate_transforms(tforms, ref_tforms=[], logger=logging.getLogger(),
+                           makePolyDegree=0, keep_ref_tforms=False):
+    return consolidate_section_transforms(
+        [tforms], ref_tforms, logger=logger, makePolyDegree=makePolyDegree,
+        keep_ref_tforms=keep_ref_tforms)[0]
 
 
 def process_z(render, stack, outstack, transform_slice, z):
     resolved_tiles = renderapi.resolvedtiles.get_resolved_tiles_from_z(
         stack, z, render=render)
 
-    for ts in resolved_tiles.tilespecs:
+    new_tforms_list = consolidate_section_transforms(
+        [ts.tforms[transform_slice] for ts in resolved_tiles.tilespecs],
+        resolved_tiles.transforms)
+    for ts, new_tforms in zip(resolved_tiles.tilespecs, new_tforms_list):
         #logger.debug('process_z_make_json: tileId {}'.format(ts.tileId))
-        ts.tforms[transform_slice] = consolidate_transforms(
-            ts.tforms[transform_slice], resolved_tiles.transforms)
+        ts.tforms[transform_slice] = new_tforms
         #logger.debug('consolatedate tformlist {}'.format(ts.tforms[0]))
 
     #logger.debug("tileid:{} transforms:{}".format(
@@ -1,3 +1,9 @@
+import calendar
+import os
+
+import botocore.exceptions
+from uri_handler.errors import UriHandlerException
+from uri_handler.storage import s3storage
 from uri_handler.utils._compat import urllib
 
 from uri_handler.utils.uri_utils import (
@@ -16,5 +22,40 @@ def uri_basename(uri, delimiter='/'):
     return p.split(delimiter)[-1]
 
 
+def uri_stat(uri):
+    """get modification time and size of the object at a uri
+
+    Parameters
+    ----------
+    uri : str
+        file or s3 uri
+
+    Returns
+    -------
+    tuple or None
+        (mtime in seconds since the epoch, size in bytes) or
+        None if the object does not exist
+    """
+    p = urllib.parse.urlparse(uri)
+    if p.scheme == 'file':
+        try:
+            st = os.stat(urllib.parse.unquote(p.path))
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+    elif p.scheme == 's3':
+        session, resource = s3storage.get_s3_session_resource_from_uri(uri)
+        bucket, key = s3storage.parse_s3_uri(uri)
+        obj = resource.Object(bucket, key)
+        try:
+            obj.load()
+        except botocore.exceptions.ClientError:
+            return None
+        return (calendar.timegm(obj.last_modified.utctimetuple()),
+                obj.content_length)
+    raise UriHandlerException("Unknown uri schema {}".format(p.scheme))
+
+
 __all__ = [
-    "uri_join", "uri_prefix", "uri_readbytes", "uri_writebytes"]
+    "uri_join", "uri_prefix", "uri_readbytes", "uri_writebytes",
+    "uri_stat"]